@@ -13,14 +13,131 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import logging
 import subprocess
 import re
 import time
 from RPLCD.i2c import CharLCD
 
+from instrumentation import timed
+
+logger = logging.getLogger(__name__)
+
 __version__ = 1.0
 
 
+class CGRAMManager(object):
+    """Leases the 8 HD44780 custom character slots to the screens
+
+    A screen asks for the bitmaps it draws with and gets a translation table from its own character codes
+    (``chr(0)`` for the first bitmap, ``chr(1)`` for the second...) to the slots holding them. Bitmaps already
+    resident are not uploaded again, missing ones replace the least recently used slots and are uploaded in runs
+    of consecutive slots. Slots leased in the current frame are pinned until :meth:`release`, so a second lease in
+    the same frame can not change cells already written.
+
+    :var self.resident: the bitmap held by every slot, None when unknown
+    """
+
+    slots = 8
+
+    # HD44780 set CGRAM address instruction
+    LCD_SETCGRAMADDR = 0x40
+
+    def __init__(self, lcd):
+        self.lcd = lcd
+        self.resident = [None] * self.slots
+
+        self._index = {}
+        self._last_used = [0] * self.slots
+        self._pinned = set()
+        self._tick = 0
+
+        # counters
+        self.leases = 0
+        self.uploads = 0
+        self.bytes_sent = 0
+
+    def lease(self, bitmaps):
+        """Make the bitmaps resident for the current frame
+
+        :param bitmaps: sequence of 8 rows bitmaps, at most 8
+        :return: dict translation table for str.translate, from the bitmap index to its slot
+        """
+        bitmaps = [tuple(bitmap) for bitmap in bitmaps]
+        if len(set(bitmaps)) > self.slots:
+            raise ValueError('{} custom characters requested, the LCD has {}'.format(len(bitmaps), self.slots))
+
+        self.leases += 1
+        self._tick += 1
+
+        missing = [bitmap for bitmap in dict.fromkeys(bitmaps) if bitmap not in self._index]
+        # pin the resident ones first so they are not picked for eviction
+        self._pinned.update(self._index[bitmap] for bitmap in bitmaps if bitmap in self._index)
+
+        uploads = {}
+        if missing:
+            free = sorted((slot for slot in range(self.slots) if slot not in self._pinned),
+                          key=lambda slot: (self.resident[slot] is not None, self._last_used[slot], slot))
+            if len(free) < len(missing):
+                raise ValueError('Not enough free custom characters in this frame')
+            for slot, bitmap in zip(free, missing):
+                old = self.resident[slot]
+                if old is not None:
+                    del self._index[old]
+                self.resident[slot] = bitmap
+                self._index[bitmap] = slot
+                self._pinned.add(slot)
+                uploads[slot] = bitmap
+            self._upload(uploads)
+
+        table = {}
+        for ndx, bitmap in enumerate(bitmaps):
+            slot = self._index[bitmap]
+            self._last_used[slot] = self._tick
+            if slot != ndx:
+                table[ndx] = slot
+        return table
+
+    def release(self):
+        """End of the frame, the slots can be evicted again"""
+        self._pinned.clear()
+
+    def invalidate(self):
+        """Forget the CGRAM content, after a controller reset"""
+        self.resident = [None] * self.slots
+        self._index = {}
+        self._pinned.clear()
+
+    def _upload(self, uploads):
+        """Write the bitmaps, consecutive slots share a single set address instruction
+
+        :param uploads: dict slot -> bitmap
+        """
+        slots = sorted(uploads)
+        runs = []
+        for slot in slots:
+            if runs and runs[-1][-1] == slot - 1:
+                runs[-1].append(slot)
+            else:
+                runs.append([slot])
+
+        # the CGRAM address auto increments, RPLCD only exposes one create_char per slot
+        batch = hasattr(self.lcd, 'command') and hasattr(self.lcd, '_send_data')
+        for run in runs:
+            if batch:
+                self.lcd.command(self.LCD_SETCGRAMADDR | run[0] << 3)
+                for slot in run:
+                    for row in uploads[slot]:
+                        self.lcd._send_data(row)
+                self.bytes_sent += 1 + 8 * len(run)
+            else:
+                for slot in run:
+                    self.lcd.create_char(slot, uploads[slot])
+                self.bytes_sent += 10 * len(run)
+            self.uploads += len(run)
+
+
+
 # TODO: Don't forget to add the rplcd user to i2c group
 class LCDScreen(object):
 
@@ -33,58 +150,144 @@ class LCDScreen(object):
                            backlight_enabled=True)
 
         self._lcd_width = lcd_width
+        self._lcd_rows = lcd_rows
+
+        # shadow copy of the DDRAM, one character per cell, used to write only the cells that changed
+        self._frame = [[' '] * lcd_width for _ in range(lcd_rows)]
+        # where the LCD cursor is after the last write, None when unknown
+        self._cursor = (0, 0)
 
-        self.prevStr = ''
+        # HD44780 bytes (cursor moves and characters) sent in total, in the current and in the last frame
+        self.bytes_sent = 0
+        self.frame_bytes = 0
+        self.last_frame_bytes = 0
 
-        # Create some custom characters
-        self.lcd.create_char(0, (0, 0, 0, 0, 0, 0, 0, 0))
-        self.lcd.create_char(1, (16, 24, 24, 24, 24, 24, 24, 16))
-        self.lcd.create_char(2, (1, 3, 3, 3, 3, 3, 3, 1))
-        self.lcd.create_char(3, (17, 27, 27, 27, 27, 27, 27, 17))
-        self.lcd.create_char(4, (31, 31, 0, 0, 0, 0, 0, 0))
-        self.lcd.create_char(5, (0, 0, 0, 0, 0, 0, 31, 31))
-        self.lcd.create_char(6, (31, 31, 0, 0, 0, 0, 0, 31))
-        self.lcd.create_char(7, (31, 0, 0, 0, 0, 0, 31, 31))
+        # custom characters are uploaded on demand, when a screen draws with them
+        self.cgram = CGRAMManager(self.lcd)
 
         self.lcd.backlight_enabled = True
-        self.lcd.clear()
+        self.clear()
         self.print_line(welcome_text, 0, align='CENTER')
         self.print_line(__version__, 1, align='CENTER')
+        self.end_frame()
         self.lcd.home()
+        self._cursor = (0, 0)
 
-    def print_line(self, text, line=0, align='LEFT'):
-        """Checks the string, if different than last call, update screen.
+    @property
+    def width(self):
+        return self._lcd_width
+
+    @property
+    def rows(self):
+        return self._lcd_rows
+
+    def clear(self):
+        """Clear the display and reset the shadow framebuffer
+
+        :return:
+        """
+        self.lcd.clear()
+        self._frame = [[' '] * self._lcd_width for _ in range(self._lcd_rows)]
+        self._cursor = (0, 0)
+        self._count(1)
+
+    def end_frame(self, blink=False):
+        """Close the current frame and return how many bytes it sent to the LCD
+
+        :param blink: bool toggle the backlight, it is switched back on by the first frame without
+        :return: int
+        """
+        self.cgram.release()
+
+        backlight = not self.lcd.backlight_enabled if blink else True
+        if backlight != self.lcd.backlight_enabled:
+            self.lcd.backlight_enabled = backlight
+            self._count(1)
+
+        self.last_frame_bytes = self.frame_bytes
+        self.frame_bytes = 0
+        logger.debug('LCD frame: %d bytes', self.last_frame_bytes)
+        return self.last_frame_bytes
+
+    def _count(self, nbytes):
+        self.bytes_sent += nbytes
+        self.frame_bytes += nbytes
+
+    def align_text(self, text, align='LEFT'):
+        """Pad or truncate the text to the LCD width
+
+        :param text:
+        :param align:
+        :return: str
+        """
+        if not isinstance(text, str):
+            text = str(text)
+
+        text_length = len(text)
+        if text_length < self._lcd_width:
+            blank_space = self._lcd_width - text_length
+            if align == 'LEFT':
+                text = text + ' ' * blank_space
+            elif align == 'RIGHT':
+                text = ' ' * blank_space + text
+            else:
+                text = ' ' * (blank_space // 2) + text + ' ' * (blank_space - blank_space // 2)
+        else:
+            text = text[:self._lcd_width]
+
+        return text
+
+    @timed('lcd.print_line')
+    def print_line(self, text, line=0, align='LEFT', glyphs=None):
+        """Compare the line with the shadow framebuffer and write only the runs of cells that changed.
 
         :param text:
         :param line:
         :param align:
-        :return:
+        :param glyphs: custom characters used by the text, ``chr(n)`` is drawn with the n-th bitmap
+        :return: int bytes sent to the LCD
         """
+        sent = 0
+        if glyphs:
+            uploaded = self.cgram.bytes_sent
+            text = str(text).translate(self.cgram.lease(glyphs))
+            sent = self.cgram.bytes_sent - uploaded
+            if sent:
+                # the upload moved the address counter out of the DDRAM
+                self._cursor = None
 
-        if isinstance(text, float):
-            text = str(text)
-            
-        text = text.encode('utf-8')
-
-        if self.prevStr != text:  # Oh what a shitty way around actually learning the ins and outs of encoding chars...
-            # Display string has changed, update LCD
-            #self.lcd.clear()
-
-            text_length = len(text)
-            if text_length < self._lcd_width:
-                blank_space = self._lcd_width - text_length
-                if align == 'LEFT':
-                    text = text + b' ' * blank_space
-                elif align == 'RIGHT':
-                    text = b' ' * blank_space + text
+        text = self.align_text(text, align)
+        shadow = self._frame[line]
+        width = self._lcd_width
+
+        col = 0
+        while col < width:
+            if shadow[col] == text[col]:
+                col += 1
+                continue
+
+            # extend the run over single unchanged cells, rewriting one cell costs the same as moving the cursor
+            start = col
+            end = col + 1
+            while end < width:
+                if shadow[end] != text[end]:
+                    end += 1
+                elif end + 1 < width and shadow[end + 1] != text[end + 1]:
+                    end += 2
                 else:
-                    text = b' ' * (blank_space // 2) + text + b' ' * (blank_space - blank_space // 2)
-            else:
-                text = text[:self._lcd_width]
+                    break
+
+            if self._cursor != (line, start):
+                self.lcd.cursor_pos = (line, start)
+                sent += 1
 
-            self.lcd.cursor_pos = (line, 0)
+            self.lcd.write_string(text[start:end])
+            sent += end - start
+            shadow[start:end] = text[start:end]
 
-            self.lcd.write_string(text.decode('utf-8'))
-            # Save so we can test if screen changed between calls, don't update if not needed to reduce LCD flicker
-            self.prevStr = text
+            # past the last column the controller wraps the cursor, let the next run position it again
+            self._cursor = (line, end) if end < width else None
+            col = end
 
+        self._count(sent)
+        return sent
@@ -13,37 +13,32 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-from typing import Tuple, Union, Any
-import psutil
+import logging
+import math
 import time
 import datetime
-from itertools import cycle
 
 from LCDScreen import LCDScreen
+from glyphs import BigClock, Sparkline
 
 from libs.vcgencmd_pi import VcgencmdParser
 from libs.ntpq import NtpqParser
 from libs.chrony import ChronyParser
-from libs.gpsd import Gpsd, NoFixError
+from libs.gpsd import Gpsd, GpsResponse, NoFixError
+
+from libs.daemons import ntp_daemon_detector
+
+from collectors import SnapshotStore, Collectors, ChronyCollector, GpsdCollector, ThermalCollector, \
+    PsutilCollector, NtpDaemonCollector
+from fleet import FleetTable, FleetCollector, FleetView
+from alerts import AlertEngine, default_rules
 
 from tools import humanize_file_size, normalize_timespec, human_time
-from decorators import class_register_screen, register_screen
-
-# Define digit pairs from 00 to 61 (yes 61 because of leap seconds)
-digits = [
-    [24341, 25351], [24120, 25120], [24161, 25370], [24161, 25171], [24301, 25141],
-    [24360, 25171], [24360, 25371], [24141, 25101], [24361, 25371], [24341, 25141],
-    [2241, 2251], [2020, 2020], [2061, 2270], [2061, 2071], [2201, 2041],
-    [2260, 2071], [2260, 2271], [2041, 2001], [2261, 2271], [2241, 2041],
-    [6341, 27251], [6120, 27020], [6161, 27270], [6161, 27071], [6301, 27041],
-    [6360, 27071], [6360, 27271], [6141, 27001], [6361, 27271], [6341, 27041],
-    [6341, 7351], [6120, 7120], [6161, 7370], [6161, 7171], [6301, 7141],
-    [6360, 7171], [6360, 7371], [6141, 7101], [6361, 7371], [6341, 7141],
-    [20341, 4351], [20120, 4120], [20161, 4370], [20161, 4171], [20301, 4141],
-    [20360, 4171], [20360, 4371], [20141, 4101], [20361, 4371], [20341, 4141],
-    [26241, 7351], [26020, 7120], [26061, 7370], [26061, 7171], [26201, 7141],
-    [26260, 7171], [26260, 7371], [26041, 7101], [26261, 7371], [26241, 7141],
-    [26241, 27351], [26020, 27120]]
+from decorators import class_register_screen, register_screen, screens_for_daemon
+from scheduler import RotationScheduler
+from instrumentation import timed, histogram
+
+logger = logging.getLogger(__name__)
 
 
 @class_register_screen
@@ -52,147 +47,349 @@ class Screens(object):
 
     """
 
-    # what NTP daemons list to be search by
-    ntp_daemons_list = ['ntpq', 'chronyd']
-
-    # NTP daemon currently running
+    # NTP daemon currently running, set by class_register_screen
     ntp_daemon_running = None
 
     lcd_screen = None
 
-    screen_exceptions = []
-    cycle_exceptions = []
-
-    current_timer_cycle_delay = 0
     current_running_method = ''
 
-    screen_current = ()
     screen_method = ''
+    # alert screen shown instead of the rotation
+    screen_alert = None
+    # rotation screens shown between two showings of a standing alert, and those left before the next one
+    alert_every = 3
+    alert_countdown = 0
+    # seconds the current screen stays, from its screen_time
     screen_option_time = 5
+    # monotonic times the current screen ends and has to be rendered again on its refresh
+    screen_until = 0.0
+    screen_refresh_at = None
+    # snapshot the current screen was last rendered from
+    screen_rendered = None
+    # snapshot sources the current screen reads, None redraws it on every tick
+    screen_sources = None
+    # frames rendered since the current screen came up
+    screen_frames = 0
+    # last frame handed to the LCD
+    screen_frame = None
+    # toggle the backlight with every frame of the current screen, set by the screen when it renders
+    screen_blink = False
+
+    def __init__(self, lcd_screen=None, shared=None, refresh_interval=1.0, maximum_stratum=15):
+        """
+        :param lcd_screen: LCDScreen the screens are shown on, the default 16x2 at 0x27 on bus 1 when None
+        :param shared: Screens of another display, its parsers, collectors and snapshot store are reused
+        :param refresh_interval: float seconds between two frames of the screens declaring neither a refresh nor
+            their sources
+        :param maximum_stratum: int highest stratum without an alert
+        """
+        self.lcd_screen = lcd_screen or LCDScreen("Atomic Clock NTP")
+        self.refresh_interval = refresh_interval
+        self.maximum_stratum = maximum_stratum
+
+        # big digits clock used by big_time_view, the 20x4 layout adds the date
+        self.big_clock = BigClock(layout='20x4' if self.lcd_screen.rows >= 4 and self.lcd_screen.width >= 20
+                                  else '16x2')
 
-    def __init__(self):
-        self.lcd_screen = LCDScreen("Atomic Clock NTP")
+        if shared is not None:
+            # one data collection layer for all the displays
+            self._share_collectors(shared)
+        else:
+            self._init_collectors()
+
+        # one latency histogram per screen, created once
+        self.screen_histograms = {method[0].split('.')[1]: histogram('screen.' + method[0].split('.')[1])
+                                  for method in self.methods_registered}
+
+        # every display rotates on its own
+        self.scheduler = RotationScheduler(self.methods_ordered)
+        self._init_screen_state()
+
+        # callables waking up the loop of this display, a source of the current screen was published or an alert
+        # was raised or cleared
+        self.wakeup_listeners = []
+        self.store.listeners.append(self.on_publish)
+
+        # load initial screen
+        self.load_screen()
 
+    def _init_collectors(self):
         self.vcgencmd = VcgencmdParser()
-        self.gpsd = Gpsd()
+        self.gpsd = Gpsd(autostart=False)
         self.chrony = ChronyParser()
         self.ntpq = NtpqParser()
 
-        self.screens_iter = cycle(self.methods_ordered)
+        # the screens only read this store, the collectors fill it from their own threads or tasks
+        self.store = SnapshotStore()
+        self.collectors = Collectors(self.store, [
+            NtpDaemonCollector(ntp_daemon_detector),
+            ChronyCollector(self.chrony, ntp_daemon_detector),
+            GpsdCollector(self.gpsd),
+            ThermalCollector(self.vcgencmd),
+            PsutilCollector(),
+        ])
+
+        # trend graphs, fed by every publish and not only while their screen is shown
+        self.sparklines = {
+            'chrony': Sparkline(),
+            'gpsd': Sparkline(period=60, high=12),
+            'psutil': Sparkline(period=60, minimum_range=1.0),
+        }
+        self.store.listeners.append(self.update_sparklines)
+
+        # threshold rules checked on every published sample
+        self.alerts = AlertEngine(default_rules(self.chrony.maximum_divergence_tolerated, self.maximum_stratum))
+        self.store.listeners.append(self.alerts.update)
+
+    def _share_collectors(self, shared):
+        self.vcgencmd = shared.vcgencmd
+        self.gpsd = shared.gpsd
+        self.chrony = shared.chrony
+        self.ntpq = shared.ntpq
+        self.store = shared.store
+        self.collectors = shared.collectors
+        self.sparklines = shared.sparklines
+        self.alerts = shared.alerts
+
+    def _init_screen_state(self):
+        # the stability screens show the next averaging time every time they come up
+        self.adev_tau_ndx = -1
+        self.tdev_tau_ndx = -1
+
+        self.alerts.listeners.append(self.on_alert)
+
+    def on_alert(self, rule, active):
+        """Show alert_view while a rule is active, AlertEngine listener
+
+        :param rule: Rule
+        :param active: bool
+        :return:
+        """
+        if self.alerts.active():
+            if active:
+                # a rule that fires brings the alert back once the current screen is over
+                self.alert_countdown = 0
+            self.scheduler.raise_alert('alert_view')
+        else:
+            self.scheduler.clear_alert('alert_view')
+        self.wake()
 
-        # load initial screen
-        self.load_screen()
+    def on_publish(self, source, value):
+        """Wake up the display loop when the current screen reads the published source, SnapshotStore listener
 
-    def add_screen_exception(self, screen, cycles=5):
+        :param source: str
+        :param value: the published value
+        :return:
         """
+        sources = self.screen_sources
+        if sources is None or source in sources:
+            self.wake()
+
+    def wake(self):
+        for listener in self.wakeup_listeners:
+            listener()
 
-        :param screen:
-        :param cycles:
+    def add_screen_exception(self, screen, cycles=5):
+        """Leave a screen out of the rotation
+
+        :param screen: str screen method name
+        :param cycles: int rotations to skip it, for ever when negative
         :return:
         """
-        if len(self.screen_exceptions):
-            for exception in self.screen_exceptions:
-                if screen == exception[0]:
-                    break
-                else:
-                    self.screen_exceptions.append([screen, cycles, 0])
-        else:
-            self.screen_exceptions.append([screen, cycles, 0])
+        self.scheduler.skip(screen, cycles)
+
+    def set_ntp_daemon(self, ntp_daemon):
+        """Swap the rotation for the screens of another NTP daemon, the rotation continues after the current screen
 
-    def process_screen(self):
+        :param ntp_daemon: str daemon name or None
+        :return:
         """
+        self.methods_ordered = screens_for_daemon(self.methods_registered, ntp_daemon)
+        self.scheduler.set_screens(self.methods_ordered)
+        self.ntp_daemon_running = ntp_daemon
+        logger.info('NTP daemon changed to {}, {} screens in rotation'.format(ntp_daemon, len(self.methods_ordered)))
+
+    def update_sparklines(self, source, value):
+        """Shift the latest sample of the source in its sparkline, SnapshotStore listener
 
+        :param source: str
+        :param value: the published value
         :return:
         """
+        if source == 'chrony':
+            stderr, chrony = value
+            if not stderr and 'last_offset' in chrony:
+                self.sparklines['chrony'].update(abs(float(chrony['last_offset'])))
+        elif source == 'gpsd':
+            self.sparklines['gpsd'].update(value.sats_valid)
+        elif source == 'psutil':
+            self.sparklines['psutil'].update(value['loadavg'][0])
+
+    def load_screen(self, now=None):
+        """Move to the next screen of the rotation
+
+        :param now: float monotonic time
+        :return:
+        """
+
+        ntp_daemon = self.store.snapshot().get('ntp_daemon', self.ntp_daemon_running)
+        if ntp_daemon != self.ntp_daemon_running:
+            self.set_ntp_daemon(ntp_daemon)
 
-        screen_current = next(self.screens_iter)
-        screen_method = screen_current[0].split('.')[1]
-        screen_option_flash = screen_current[1].get('flash', False)
+        # keep the current screen when every screen is skipped
+        self.show_screen(self.scheduler.next() or self.screen_method, now)
 
-        # check if is any exception is present
-        if len(self.screen_exceptions) > 0:
-            for ndx, screen in enumerate(self.screen_exceptions):
-                method, cycles_to_skip, cycles_count = screen
+    def show_screen(self, screen_method, now=None):
+        """Make a screen the current one, it is rendered on the next frame
+
+        :param screen_method: str
+        :param now: float monotonic time
+        :return:
+        """
+        now = time.monotonic() if now is None else now
+        options = self.scheduler.options.get(screen_method, {})
+
+        self.screen_method = screen_method
+        self.screen_option_time = options.get('screen_time', 5)
+        self.screen_until = now + self.screen_option_time
+        self.screen_sources = options.get('sources')
+        self.screen_rendered = None
+        self.screen_refresh_at = None
+        self.screen_frames = 0
+        self.screen_blink = False
+
+    def screen_due(self, now):
+        """Whether the current screen can look different than when it was last rendered
+
+        :param now: float monotonic time
+        :return: bool
+        """
+        if self.screen_rendered is None or self.screen_sources is None:
+            return True
+        if self.screen_refresh_at is not None and now >= self.screen_refresh_at:
+            return True
+        updated, rendered = self.store.snapshot().updated, self.screen_rendered.updated
+        return any(updated.get(source) != rendered.get(source) for source in self.screen_sources)
+
+    def next_wakeup(self, now=None):
+        """When the loop has to run again without any new data: the screen ends or refreshes
+
+        :param now: float monotonic time
+        :return: float monotonic time
+        """
+        now = time.monotonic() if now is None else now
+        if self.screen_sources is None:
+            return now + self.refresh_interval
 
-                # check if the current screen is in exceptions
-                # if not return the screen
-                if method == screen_method:
-                    # check if is permanent, if not means that is timed by cycles
-                    if cycles_to_skip < 0:
-                        #self.process_screen()
-                        continue
-                    else:
-                        # if the screen is exception and the exception not reached to end, increment a new cycle
-                        if cycles_count <= cycles_to_skip:
-                            self.screen_exceptions[ndx][2] += 1
-                        else:
-                            # @TODO: print in log or cli the screen removed from exception
-                            self.screen_exceptions.pop(ndx)
-                            # check if the screen is flash mode
-        if screen_option_flash:
-            self.add_screen_exception(screen_method, -1)
+        wakeup = self.screen_until
+        if self.screen_refresh_at is not None:
+            wakeup = min(wakeup, self.screen_refresh_at)
+        return wakeup
 
-        return screen_current
+    def render_screen(self, now=None):
+        """Execute the current screen method on the latest snapshot
 
-    def load_screen(self):
+        :param now: float monotonic time
+        :return: the two lines returned by the screen
         """
+        now = time.monotonic() if now is None else now
+        refresh = self.scheduler.options.get(self.screen_method, {}).get('refresh')
 
+        snap = self.store.snapshot()
+        start = time.perf_counter_ns()
+        try:
+            return getattr(self, self.screen_method)(snap)
+        finally:
+            self.screen_histograms[self.screen_method].observe_ns(time.perf_counter_ns() - start)
+            self.screen_frames += 1
+            self.screen_rendered = snap
+            # on the wall clock boundaries, a clock changes on the second
+            self.screen_refresh_at = now + refresh - time.time() % refresh if refresh else None
+
+    @timed('write_screen')
+    def write_screen(self, frame, blink=False):
+        """Write a rendered frame on the LCD, the rows the frame does not use are blanked
+
+        :param frame: the lines returned by render_screen()
+        :param blink: bool toggle the backlight with this frame, the screen_blink of the frame
         :return:
         """
+        line0_align = 'CENTER' if len(frame[0]) == 2 else frame[0][2]
+
+        rows = set()
+        for line in frame:
+            # an optional 4th item lists the custom characters the line is drawn with
+            self.lcd_screen.print_line(line[0], line[1], align=line0_align,
+                                       glyphs=line[3] if len(line) > 3 else None)
+            rows.add(line[1])
+        for row in range(self.lcd_screen.rows):
+            if row not in rows:
+                self.lcd_screen.print_line('', row)
+        self.lcd_screen.end_frame(blink)
+
+    @timed('display_screen')
+    def display_screen(self):
+        self.write_screen(self.render_screen(), self.screen_blink)
 
-        current_screen = self.process_screen()
-        self.screen_method = current_screen[0].split('.')[1]
-        #self.screen_option_time = current_screen[1].get('screen_time')
+    def next_frame(self, now=None):
+        """Switch the screen when it is over and render it when its data or its refresh time says so
 
-    def display_screen(self):
-        # execute the screen method
-        line0, line1 = getattr(self, self.screen_method)()
+        :param now: float monotonic time
+        :return: the frame to display or None when the LCD already shows it, written with ``screen_blink``
+        """
+        now = time.monotonic() if now is None else now
+
+        alert = self.scheduler.alert()
+        if alert != self.screen_alert:
+            # an alert is shown on this tick, once cleared the rotation resumes on the screen it interrupted
+            interrupted = self.screen_method == self.screen_alert
+            self.screen_alert = alert
+            if alert is not None or interrupted:
+                self.show_screen(alert or self.scheduler.current or self.screen_method, now)
+        elif now >= self.screen_until:
+            if alert is not None and self.screen_method == alert:
+                # a standing alert lets the rotation go on for alert_every screens before it comes back
+                self.alert_countdown = self.alert_every
+                self.load_screen(now)
+            elif alert is not None and self.alert_countdown <= 1:
+                self.show_screen(alert, now)
+            else:
+                if alert is not None:
+                    self.alert_countdown -= 1
+                self.load_screen(now)
 
-        line0_align = 'CENTER' if len(line0) == 2 else line0[2]
+        if not self.screen_due(now):
+            return None
 
-        self.lcd_screen.print_line(line0[0], line0[1], align=line0_align)
-        self.lcd_screen.print_line(line1[0], line1[1], align=line0_align)
+        frame = self.render_screen(now)
+        if frame == self.screen_frame and not self.screen_blink:
+            # the LCD already shows it
+            return None
+        self.screen_frame = frame
+        return frame
 
+    @timed('loop_screens')
     def loop_screens(self):
-        if self.current_timer_cycle_delay >= self.screen_option_time:
-            self.current_timer_cycle_delay = 0
-            self.load_screen()
-        else:
-            self.current_timer_cycle_delay += 1
-            self.display_screen()
+        frame = self.next_frame()
+        if frame is not None:
+            self.write_screen(frame, self.screen_blink)
 
-    @staticmethod
-    @register_screen(order=1)
-    def big_time_view() -> Tuple[Tuple[bytes, int], Tuple[bytes, int]]:
+    @register_screen(order=1, refresh=1.0, sources=())
+    def big_time_view(self, snap):
         """Shows custom large local time on LCD
 
         :return:
         """
+        bitmaps = self.big_clock.font.bitmaps
 
-        hrs = int(time.strftime("%H"))
-        minutes = int(time.strftime("%M"))
-        sec = int(time.strftime("%S"))
-
-        # Build string representing top and bottom rows
-        line_1 = "0" + str(digits[hrs][0]).zfill(5) + str(digits[minutes][0]).zfill(5) + str(digits[sec][0]).zfill(5)
-        line_2 = "0" + str(digits[hrs][1]).zfill(5) + str(digits[minutes][1]).zfill(5) + str(digits[sec][1]).zfill(5)
+        return tuple((line, row, 'CENTER', bitmaps) for row, line in enumerate(self.big_clock.render()))
 
-        # Convert strings from digits into pointers to custom character
-        i = 0
-        _line_1 = ""
-        _line_2 = ""
-        while i < len(line_1):
-            _line_1 = _line_1 + chr(int(line_1[i]))
-            _line_2 = _line_2 + chr(int(line_2[i]))
-            i += 1
-
-        return (_line_1, 0), (_line_2, 1)
-
-    @register_screen(order=2)
-    def gps_time(self):
+    @register_screen(order=2, sources=('gpsd', ))
+    def gps_time(self, snap):
 
         try:
-            gpsd = self.gpsd.get_current()
+            gpsd = snap.get('gpsd', GpsResponse())
             gps_datetime = gpsd.get_time()
             gps_date = gps_datetime.strftime("%d-%m-%Y")
             gps_time = gps_datetime.strftime("%H:%M:%S")
@@ -210,58 +407,62 @@ class Screens(object):
 
         return (l1, 0), (l2, 1)
 
-    @register_screen(order=3)
-    def psutil_cpu_freq(self):
-        cpu_freq = psutil.cpu_freq()
+    @register_screen(order=3, sources=('psutil', ))
+    def psutil_cpu_freq(self, snap):
+        # psutil has no frequency on the systems without cpufreq
+        cpu_freq = snap.get('psutil', {}).get('cpu_freq')
 
         l1 = "CPU Frequency".format()
-        l2 = "{:d}[{:d}]Mhz".format(int(cpu_freq.current), int(cpu_freq.max))
+        l2 = "{:d}[{:d}]Mhz".format(int(cpu_freq.current), int(cpu_freq.max)) if cpu_freq is not None else '--'
 
         return (l1, 0), (l2, 1)
 
-    @register_screen(order=4)
-    def psutil_cpu_load(self):
-        cpu_load = psutil.getloadavg()
+    @register_screen(order=4, sources=('psutil', ))
+    def psutil_cpu_load(self, snap):
+        cpu_load = snap.get('psutil', {}).get('loadavg')
 
-        l1 = "CPU Load".format(cpu_load[0])
-        l2 = "{0}/{1}/{2}".format(cpu_load[0], cpu_load[1], cpu_load[2])
+        l1 = "CPU Load".format()
+        l2 = "{0}/{1}/{2}".format(cpu_load[0], cpu_load[1], cpu_load[2]) if cpu_load is not None else '--'
 
         return (l1, 0), (l2, 1)
 
-    @register_screen(order=5)
-    def psutil_network_counters(self):
-        net = psutil.net_io_counters(pernic=True)
-        interface = net.get('eth0')
+    @register_screen(order=5, sources=('psutil', ))
+    def psutil_network_counters(self, snap):
+        # None when the interface is missing
+        interface = snap.get('psutil', {}).get('net_io')
+        if interface is None:
+            return ("U:--", 0), ("D:--", 1)
 
         l1 = "U:{0}".format(humanize_file_size(interface[0]))
         l2 = "D:{0}".format(humanize_file_size(interface[1]))
 
         return (l1, 0), (l2, 1)
 
-    @register_screen(order=6)
-    def vcgencmd_measure_temp(self):
-        stderr, gpu_temp = self.vcgencmd.measure_temp()
-        psutil_sensors_temperature = psutil.sensors_temperatures()
-        current_cpu_temp = psutil_sensors_temperature.get('cpu_thermal')[0].current
-
-        hight_cpu_temp = psutil_sensors_temperature.get('cpu_thermal')[0].high
-        critical_cpu_temp = psutil_sensors_temperature.get('cpu_thermal')[0].critical
+    @register_screen(order=6, sources=('thermal', ))
+    def vcgencmd_measure_temp(self, snap):
+        thermal = snap.get('thermal') or {}
+        stderr, gpu_temp = thermal.get('gpu', ('', {}))
+        # None without thermal zone nor hwmon sensor
+        cpu = thermal.get('cpu')
 
         state_cpu_temp = None
-        if hight_cpu_temp:
-            state_cpu_temp = 'H'
-        elif critical_cpu_temp:
-            state_cpu_temp = 'C'
-
-        l1 = "CPU: {:.1f}{}C".format(current_cpu_temp, chr(223))
-        l2 = "GPU: {:.1f}{}C".format(gpu_temp.get('measure_temp'), chr(223))
+        if cpu is None:
+            l1 = "CPU: --"
+        else:
+            if cpu.high:
+                state_cpu_temp = 'H'
+            elif cpu.critical:
+                state_cpu_temp = 'C'
+            l1 = "CPU: {:.1f}{}C".format(cpu.current, chr(223))
+        gpu = gpu_temp.get('measure_temp')
+        l2 = "GPU: {:.1f}{}C".format(gpu, chr(223)) if gpu is not None and not math.isnan(gpu) else "GPU: --"
         if state_cpu_temp:
             l2 = l2 + " " + state_cpu_temp
         return (l1, 0), (l2, 1)
 
-    @register_screen(order=7)
-    def chrony_status(self):
-        stderr, chrony = self.chrony.chrony_tracking()
+    @register_screen(order=7, sources=('chrony', ))
+    def chrony_status(self, snap):
+        stderr, chrony = snap.get('chrony', ('', {}))
 
         reference_name = chrony.get('reference_name')
         clock_status = chrony.get('clock_status')
@@ -270,8 +471,8 @@ class Screens(object):
         l2 = '{clock_status}'.format(clock_status=clock_status)
         return (l1, 0), (l2, 1)
 
-    @register_screen(order=8)
-    def chrony_root_delay(self):
+    @register_screen(order=8, sources=('chrony', ))
+    def chrony_root_delay(self, snap):
         """This is the total of the network path delays to the stratum-1 computer from which the computer is ultimately
         synchronised. In certain extreme situations, this value can be negative.
         (This can arise in a symmetric peer arrangement where the computers’ frequencies are not tracking each other
@@ -279,50 +480,53 @@ class Screens(object):
 
         :return:
         """
-        stderr, chrony = self.chrony.chrony_tracking()
+        stderr, chrony = snap.get('chrony', ('', {}))
 
         reference_name = chrony.get('reference_name')
         root_delay = chrony.get('root_delay')
-        root_root_dispersion = chrony.get('root_dispersion')
-
-        _root_delay = normalize_timespec(float(root_delay))
-        _root_root_dispersion = normalize_timespec(float(root_root_dispersion))
 
         l1 = '{} Root Delay'.format(reference_name)
-        l2 = '{root_delay} {root_delay_unit}'.format(root_delay=int(_root_delay[0]),
-                                                    root_delay_unit=_root_delay[1])
+        if root_delay is None:
+            # chronyc failed or has not been read yet
+            l2 = '--'
+        else:
+            _root_delay = normalize_timespec(float(root_delay))
+            l2 = '{root_delay} {root_delay_unit}'.format(root_delay=int(_root_delay[0]),
+                                                        root_delay_unit=_root_delay[1])
         return (l1, 0, 'CENTER'), (l2, 1, 'CENTER')
 
-    @register_screen(order=9)
-    def chrony_root_dispersion(self):
+    @register_screen(order=9, sources=('chrony', ))
+    def chrony_root_dispersion(self, snap):
         """This is the total dispersion accumulated through all the computers back to the stratum-1 computer from
         which the computer is ultimately synchronised. Dispersion is due to system clock resolution,
         statistical measurement variations etc.
 
         :return:
         """
-        stderr, chrony = self.chrony.chrony_tracking()
+        stderr, chrony = snap.get('chrony', ('', {}))
 
         reference_name = chrony.get('reference_name')
-        root_delay = chrony.get('root_delay')
         root_root_dispersion = chrony.get('root_dispersion')
 
-        _root_delay = normalize_timespec(float(root_delay))
-        _root_root_dispersion = normalize_timespec(float(root_root_dispersion))
-
         l1 = '{} Root Disper'.format(reference_name)
-        l2 = '{root_root_dispersion} {root_root_dispersion_unit}'.format(
-            root_root_dispersion=int(_root_root_dispersion[0]),
-            root_root_dispersion_unit=chr(228)+"s" if _root_root_dispersion[1] == 'µs' else _root_root_dispersion[1])
+        if root_root_dispersion is None:
+            # chronyc failed or has not been read yet
+            l2 = '--'
+        else:
+            _root_root_dispersion = normalize_timespec(float(root_root_dispersion))
+            unit = _root_root_dispersion[1]
+            l2 = '{root_root_dispersion} {root_root_dispersion_unit}'.format(
+                root_root_dispersion=int(_root_root_dispersion[0]),
+                root_root_dispersion_unit=chr(228)+"s" if unit == 'µs' else unit)
         return (l1, 0, 'CENTER'), (l2, 1, 'CENTER')
 
-    @register_screen(order=10)
-    def chrony_last_offset(self):
+    @register_screen(order=10, sources=('chrony', ))
+    def chrony_last_offset(self, snap):
         """This is the estimated local offset on the last clock update.
 
         :return:
         """
-        stderr, chrony = self.chrony.chrony_tracking()
+        stderr, chrony = snap.get('chrony', ('', {}))
 
         reference_name = chrony.get('reference_name')
         last_offset = chrony.get('last_offset', 0.0)
@@ -334,13 +538,13 @@ class Screens(object):
                                                  last_off_unit=chr(228)+"s" if last_off[1] == 'µs' else last_off[1])
         return (l1, 0), (l2, 1)
 
-    @register_screen(order=11)
-    def chrony_rms_offset(self):
+    @register_screen(order=11, sources=('chrony', ))
+    def chrony_rms_offset(self, snap):
         """This is a long-term average of the offset value.
 
         :return:
         """
-        stderr, chrony = self.chrony.chrony_tracking()
+        stderr, chrony = snap.get('chrony', ('', {}))
 
         reference_name = chrony.get('reference_name')
         rms_offset = chrony.get('rms_offset', 0.0)
@@ -352,8 +556,8 @@ class Screens(object):
                                                rms_off_unit=chr(228)+"s" if rms_off[1] == 'µs' else rms_off[1])
         return (l1, 0), (l2, 1)
 
-    @register_screen(order=12)
-    def chrony_system_time(self):
+    @register_screen(order=12, sources=('chrony', ))
+    def chrony_system_time(self, snap):
         """In normal operation, chronyd never steps the system clock, because any jump in the timescale can have
         adverse consequences for certain application programs. Instead, any error in the system clock is corrected by
         slightly speeding up or slowing down the system clock until the error has been removed,
@@ -365,7 +569,7 @@ class Screens(object):
 
         :return:
         """
-        stderr, chrony = self.chrony.chrony_tracking()
+        stderr, chrony = snap.get('chrony', ('', {}))
 
         reference_name = chrony.get('reference_name')
         system_time = chrony.get('system_time', 0.0)
@@ -377,8 +581,8 @@ class Screens(object):
 
         return (l1, 0), (l2, 1)
 
-    @register_screen(order=13)
-    def chrony_frequency(self):
+    @register_screen(order=13, sources=('chrony', ))
+    def chrony_frequency(self, snap):
         """The ‘frequency’ is the rate by which the system’s clock would be would be wrong if chronyd was not
         correcting it. It is expressed in ppm (parts per million). For example, a value of 1ppm would mean that when
         the system’s clock thinks it has advanced 1 second, it has actually advanced by 1.000001 seconds relative to
@@ -386,7 +590,7 @@ class Screens(object):
 
         :return:
         """
-        stderr, chrony = self.chrony.chrony_tracking()
+        stderr, chrony = snap.get('chrony', ('', {}))
 
         reference_name = chrony.get('reference_name')
         frequency = chrony.get('frequency', 0.0)
@@ -396,8 +600,8 @@ class Screens(object):
 
         return (l1, 0), (l2, 1)
 
-    @register_screen(order=14)
-    def chrony_residual_freq(self):
+    @register_screen(order=14, sources=('chrony', ))
+    def chrony_residual_freq(self, snap):
         """This shows the ‘residual frequency’ for the currently selected reference source.
         This reflects any difference between what the measurements from the reference source indicate the frequency
         should be and the frequency currently being used. The reason this is not always zero is that a smoothing
@@ -409,7 +613,7 @@ class Screens(object):
 
         :return:
         """
-        stderr, chrony = self.chrony.chrony_tracking()
+        stderr, chrony = snap.get('chrony', ('', {}))
 
         reference_name = chrony.get('reference_name')
         residual_freq = chrony.get('residual_freq', 0.0)
@@ -419,13 +623,13 @@ class Screens(object):
 
         return (l1, 0), (l2, 1)
 
-    @register_screen(order=15)
-    def chrony_skew(self):
+    @register_screen(order=15, sources=('chrony', ))
+    def chrony_skew(self, snap):
         """This is the estimated error bound on the frequency.
 
         :return:
         """
-        stderr, chrony = self.chrony.chrony_tracking()
+        stderr, chrony = snap.get('chrony', ('', {}))
 
         reference_name = chrony.get('reference_name')
         skew = chrony.get('skew', 0.0)
@@ -435,18 +639,20 @@ class Screens(object):
 
         return (l1, 0), (l2, 1)
 
-    @register_screen(order=16)
-    def gpsd_stats(self):
-        stats = self.gpsd.get_current()
+    @register_screen(order=16, sources=('gpsd', ))
+    def gpsd_stats(self, snap):
+        stats = snap.get('gpsd', GpsResponse())
         mode = stats.get_mode()
 
         l1 = "{} {}[{}]".format(mode, stats.sats, stats.sats_valid)
         l2 = 'H:{:.2f} P:{:.2f}'.format(stats.hdop, stats.pdop)
         return (l1, 0), (l2, 1)
 
-    @register_screen(order=17)
-    def psutil_boot_time(self):
-        boot_time = psutil.boot_time()
+    @register_screen(order=17, refresh=1.0, sources=())
+    def psutil_boot_time(self, snap):
+        boot_time = snap.get('psutil', {}).get('boot_time')
+        if boot_time is None:
+            return ("Boot since".format(), 0), ('--', 1)
         datetime_boot_time = datetime.datetime.fromtimestamp(boot_time)
 
         boot_time_delta = datetime.datetime.now() - datetime_boot_time
@@ -455,5 +661,200 @@ class Screens(object):
         l2 = '{}'.format(human_time(seconds=int(boot_time_delta.seconds)))
         return (l1, 0), (l2, 1)
 
+    @register_screen(order=18, refresh=1.0, sources=())
+    def chrony_adev(self, snap):
+        """Allan deviation at one averaging time, of the offset (O) and of the integrated frequency (F).
+        The averaging times are multiples of the chronyd update interval.
+
+        :return:
+        """
+        results = self.chrony.stability.results()
+        if not self.screen_frames:
+            self.adev_tau_ndx += 1
+        stats = results[self.adev_tau_ndx % len(results)]
+
+        l1 = 'ADEV t={:g}s'.format(stats['tau'])
+        if not stats['n']:
+            l2 = 'collecting'
+        else:
+            # single digit exponents, both values fit on 16 columns
+            l2 = 'O{:.1e} F{:.1e}'.format(stats['adev'], stats['frequency_adev']).replace('e-0', 'e-')
+        return (l1, 0), (l2, 1)
+
+    @register_screen(order=19, refresh=1.0, sources=())
+    def chrony_tdev_mtie(self, snap):
+        """Time deviation and maximum time interval error of the offset at one averaging time
+
+        :return:
+        """
+        results = self.chrony.stability.results()
+        if not self.screen_frames:
+            self.tdev_tau_ndx += 1
+        stats = results[self.tdev_tau_ndx % len(results)]
+
+        lines = []
+        for name in ('tdev', 'mtie'):
+            if math.isnan(stats[name]):
+                lines.append('{} {:g}s --'.format(name.upper(), stats['tau']))
+                continue
+            value = normalize_timespec(stats[name])
+            lines.append('{} {:g}s {}{}'.format(name.upper(), stats['tau'], int(value[0]),
+                                                chr(228)+"s" if value[1] == 'µs' else value[1]))
+        return (lines[0], 0), (lines[1], 1)
+
+    @register_screen(order=20, sources=('chrony', ))
+    def chrony_offset_graph(self, snap):
+        """Absolute last offset of the last 16 clock updates
+
+        :return:
+        """
+        sparkline = self.sparklines['chrony']
+
+        if sparkline.last is None:
+            l1 = 'Offset'
+        else:
+            offset = normalize_timespec(sparkline.last)
+            l1 = 'Offset {}{}'.format(int(offset[0]), chr(228)+"s" if offset[1] == 'µs' else offset[1])
+        return (l1, 0, 'LEFT'), (sparkline.render(), 1, 'LEFT', sparkline.bitmaps)
+
+    @register_screen(order=21, sources=('gpsd', ))
+    def gpsd_sats_graph(self, snap):
+        """Satellites used in the fix, highest count of every minute over the last 16 minutes
+
+        :return:
+        """
+        stats = snap.get('gpsd', GpsResponse())
+        sparkline = self.sparklines['gpsd']
+
+        l1 = 'Sats {}/{}'.format(stats.sats_valid, stats.sats)
+        return (l1, 0, 'LEFT'), (sparkline.render(), 1, 'LEFT', sparkline.bitmaps)
+
+    @register_screen(order=22, sources=('psutil', ))
+    def psutil_load_graph(self, snap):
+        """1 minute load average, highest value of every minute over the last 16 minutes
+
+        :return:
+        """
+        sparkline = self.sparklines['psutil']
+
+        cpu_load = snap.get('psutil', {}).get('loadavg')
+
+        l1 = 'Load {:.2f}'.format(cpu_load[0]) if cpu_load is not None else 'Load --'
+        return (l1, 0, 'LEFT'), (sparkline.render(), 1, 'LEFT', sparkline.bitmaps)
+
+    @register_screen(order=23, weight=0, priority=10, refresh=1.0, sources=('chrony', 'gpsd', 'thermal'))
+    def alert_view(self, snap):
+        """Most important active alert, shown before the rotation as soon as a rule fires
 
+        :return:
+        """
+        active = self.alerts.active()
+        if not active:
+            self.screen_blink = False
+            return ('No alert', 0), ('', 1)
+
+        rule = active[0]
+        # goes to the LCD thread with the frame, the screen does not touch the LCD
+        self.screen_blink = rule.blink
+
+        l1 = 'ALERT {}'.format(rule.name) if len(active) == 1 else 'ALERT {} +{}'.format(rule.name, len(active) - 1)
+        return (l1, 0), (rule.describe(), 1)
+
+
+@class_register_screen
+class FleetScreens(Screens):
+    """Screens of the fleet aggregator, rendered from the latest status datagram of every node
+
+    The aggregator runs no collector of its own but the fleet receiver, several displays can share it like the
+    local screens.
+    """
+
+    def __init__(self, lcd_screen=None, shared=None, refresh_interval=1.0, address='0.0.0.0', port=9124,
+                 stale_after=5.0):
+        """
+        :param address: str address the status datagrams are received on
+        :param port: int
+        :param stale_after: float seconds without a datagram before a node is shown as down
+        """
+        self.address = address
+        self.port = port
+        self.stale_after = stale_after
+
+        super().__init__(lcd_screen, shared, refresh_interval)
+
+    def _init_collectors(self):
+        self.fleet = FleetTable(self.stale_after)
+        self.store = SnapshotStore()
+        self.collectors = Collectors(self.store, [FleetCollector(self.fleet, self.address, self.port)])
+
+    def _share_collectors(self, shared):
+        self.fleet = shared.fleet
+        self.store = shared.store
+        self.collectors = shared.collectors
+
+    def _init_screen_state(self):
+        # position of the node shown by fleet_node, it moves to the next node every time the screen comes up
+        self.fleet_node_ndx = -1
+
+    @staticmethod
+    def _offset(seconds):
+        if math.isnan(seconds):
+            return '--'
+        offset = normalize_timespec(seconds)
+        return '{}{}'.format(int(offset[0]), chr(228)+"s" if offset[1] == 'µs' else offset[1])
+
+    @register_screen(order=1, sources=('fleet', ))
+    def fleet_summary(self, snap):
+        fleet = snap.get('fleet', FleetView())
+
+        l1 = 'Fleet {}/{} up'.format(len(fleet.up), len(fleet.nodes))
+        l2 = 'Unsync {} Nofix {}'.format(len(fleet.unsynced), len(fleet.no_fix))
+        return (l1, 0), (l2, 1)
+
+    @register_screen(order=2, sources=('fleet', ))
+    def fleet_worst_offset(self, snap):
+        """Node with the largest absolute offset of the system clock
+
+        :return:
+        """
+        worst = snap.get('fleet', FleetView()).worst
+
+        if worst is None:
+            return ('Worst offset', 0), ('no node', 1)
+        l1 = 'Worst {}'.format(worst.node)
+        l2 = '{} S{}'.format(self._offset(worst.system_time), worst.stratum)
+        return (l1, 0), (l2, 1)
+
+    @register_screen(order=3, sources=('fleet', ))
+    def fleet_no_fix(self, snap):
+        """Nodes without a 2D or 3D GPS fix
+
+        :return:
+        """
+        fleet = snap.get('fleet', FleetView())
+
+        l1 = 'No fix {}/{}'.format(len(fleet.no_fix), len(fleet.up))
+        l2 = ' '.join(status.node for status in fleet.no_fix) if fleet.no_fix else 'all fixed'
+        return (l1, 0), (l2, 1)
+
+    @register_screen(order=4, sources=('fleet', ))
+    def fleet_node(self, snap):
+        """Status of one node, the next one every time the screen comes up
+
+        :return:
+        """
+        fleet = snap.get('fleet', FleetView())
+
+        if not fleet.nodes:
+            return ('Fleet', 0), ('waiting nodes', 1)
+        if not self.screen_frames:
+            self.fleet_node_ndx += 1
+        status = fleet.nodes[self.fleet_node_ndx % len(fleet.nodes)]
+
+        if status not in fleet.up:
+            return ('{} S{}'.format(status.node, status.stratum), 0), ('down', 1)
+        l1 = '{} S{}'.format(status.node, status.stratum)
+        fix = '{}D'.format(status.gps_mode) if status.gps_mode >= 2 else 'NF'
+        l2 = '{} {} {}/{}'.format(self._offset(status.system_time), fix, status.sats_used, status.sats)
+        return (l1, 0), (l2, 1)
 
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import threading
+
+from instrumentation import counter
+
+logger = logging.getLogger(__name__)
+
+
+class Rule(object):
+    """Threshold on one value of a data source, with hysteresis
+
+    The rule fires when the value reaches ``raise_at`` and clears only once it is back to ``clear_at``, a value
+    hovering around the threshold does not flap the alert. When ``raise_at`` is below ``clear_at`` the low values
+    are the bad ones.
+
+        Rule('stratum', 'chrony', lambda value: int(value[1]['stratum']), raise_at=16, clear_at=15, text='Stratum {:g}')
+    """
+
+    def __init__(self, name, source, extract, raise_at, clear_at, text, priority=0, blink=False):
+        """
+        :param name: str
+        :param source: str SnapshotStore source the rule watches
+        :param extract: callable published value -> float, or None when the sample says nothing about the rule
+        :param raise_at: float
+        :param clear_at: float
+        :param text: str format of the second alert line, gets the value
+        :param priority: int the most important active rule is shown
+        :param blink: bool blink the backlight while the rule is active
+        """
+        self.name = name
+        self.source = source
+        self.extract = extract
+        self.raise_at = raise_at
+        self.clear_at = clear_at
+        self.text = text
+        self.priority = priority
+        self.blink = blink
+
+        self.active = False
+        self.value = None
+
+    def check(self, published):
+        """Evaluate a fresh sample
+
+        :param published: the value published by the source
+        :return: bool True when the rule changed state
+        """
+        try:
+            value = self.extract(published)
+        except (KeyError, IndexError, TypeError, ValueError, AttributeError):
+            value = None
+        if value is None:
+            return False
+
+        self.value = value
+        if self.raise_at >= self.clear_at:
+            active = value > self.clear_at if self.active else value >= self.raise_at
+        else:
+            active = value < self.clear_at if self.active else value <= self.raise_at
+
+        if active == self.active:
+            return False
+        self.active = active
+        return True
+
+    def describe(self):
+        return self.text.format(self.value)
+
+
+def _chrony(field, convert=float):
+    def extract(value):
+        stderr, tracking = value
+        if stderr or not tracking:
+            return None
+        return convert(tracking[field])
+    return extract
+
+
+def _cpu_margin(limit):
+    # degrees above the limit reported with the temperature, the rule compares it with 0
+    def extract(value):
+        cpu = value.get('cpu')
+        if cpu is None or getattr(cpu, limit) is None:
+            return None
+        return cpu.current - getattr(cpu, limit)
+    return extract
+
+
+def _gps_mode():
+    # mode 0 is gpsd without any report yet or a lost stream, None a source that never published. Only a drop
+    # from a 2D/3D fix is a lost fix, a host without gpsd or a receiver that never had a fix says nothing
+    fixed = False
+
+    def extract(value):
+        nonlocal fixed
+        mode = value.mode if value is not None else 0
+        fixed = fixed or mode >= 2
+        return mode if fixed else None
+    return extract
+
+
+def default_rules(maximum_offset=1.0, maximum_stratum=15):
+    """
+    :param maximum_offset: float seconds, ChronyParser.maximum_divergence_tolerated
+    :param maximum_stratum: int highest stratum without an alert, 15 only raises it on an unsynchronised server
+    :return: list[Rule]
+    """
+    return [
+        Rule('offset', 'chrony', _chrony('system_time', lambda value: abs(float(value))),
+             raise_at=maximum_offset, clear_at=maximum_offset / 2, text='{:.3g}s', priority=3, blink=True),
+        Rule('stratum', 'chrony', _chrony('stratum', int), raise_at=maximum_stratum + 1, clear_at=maximum_stratum,
+             text='Stratum {:g}', priority=1),
+        Rule('unsynced', 'chrony', _chrony('leap_status', lambda value: int(value == 'Not synchronised')),
+             raise_at=1, clear_at=0, text='Not synchronised', priority=3, blink=True),
+        Rule('gps_fix', 'gpsd', _gps_mode(), raise_at=2, clear_at=3, text='GPS mode {}', priority=2),
+        Rule('temp_crit', 'thermal', _cpu_margin('critical'), raise_at=0.0, clear_at=-5.0,
+             text='CPU {:+.1f}' + chr(223) + 'C crit', priority=4, blink=True),
+        Rule('temp_high', 'thermal', _cpu_margin('high'), raise_at=0.0, clear_at=-5.0,
+             text='CPU {:+.1f}' + chr(223) + 'C high', priority=2),
+    ]
+
+
+class AlertEngine(object):
+    """Check the rules of a source on every value it publishes, SnapshotStore listener
+
+    Only the rules of the published source run, each rule keeps its own state, a sample costs a few comparisons.
+    The listeners are called with (rule, active) when a rule fires or clears, from the publishing thread and one
+    at a time.
+
+        engine = AlertEngine(default_rules())
+        store.listeners.append(engine.update)
+        engine.listeners.append(lambda rule, active: ...)
+    """
+
+    def __init__(self, rules=None):
+        self.rules = {}
+        for rule in rules if rules is not None else default_rules():
+            self.rules.setdefault(rule.source, []).append(rule)
+
+        self.listeners = []
+        self._lock = threading.Lock()
+        self.fired = counter('alerts.fired')
+
+    def update(self, source, value):
+        """
+        :param source: str
+        :param value: the published value
+        :return:
+        """
+        rules = self.rules.get(source)
+        if not rules:
+            return
+
+        # the sources publish from their own threads, the listeners see the transitions in order
+        with self._lock:
+            for rule in rules:
+                if not rule.check(value):
+                    continue
+                if rule.active:
+                    self.fired.inc()
+                    logger.warning('Alert {}: {}'.format(rule.name, rule.describe()))
+                else:
+                    logger.info('Alert {} cleared'.format(rule.name))
+                for listener in self.listeners:
+                    listener(rule, rule.active)
+
+    def active(self):
+        """
+        :return: list[Rule] the active rules, the most important first
+        """
+        return sorted((rule for rules in self.rules.values() for rule in rules if rule.active),
+                      key=lambda rule: -rule.priority)
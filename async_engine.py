@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import asyncio
+import concurrent.futures
+import logging
+
+from loop_timer import TickStats
+
+logger = logging.getLogger(__name__)
+
+
+class DisplayWriter(object):
+    """Writes the frames of one display from its own thread
+
+    A single thread owns the display, frames that arrive while it is busy replace the pending one. Every display
+    has its own writer, a slow bus does not delay the frames of the others.
+    """
+
+    def __init__(self, screens, loop):
+        self.screens = screens
+        self.loop = loop
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='lcd')
+        self._future = None
+        self._pending = None
+
+        self.dropped_frames = 0
+
+    def write(self, frame, blink=False):
+        if self._future is not None and not self._future.done():
+            # the bus is still busy with the previous frame, only the newest frame is worth writing
+            if self._pending is not None:
+                self.dropped_frames += 1
+            self._pending = (frame, blink)
+            return
+
+        self._pending = None
+        self._future = self._executor.submit(self.screens.write_screen, frame, blink)
+        self._future.add_done_callback(self._written)
+
+    def _written(self, future):
+        # runs in the LCD thread, hand the pending frame back to the event loop
+        if future.exception():
+            logger.error('LCD write failed: {}'.format(future.exception()))
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._flush_pending)
+
+    def _flush_pending(self):
+        if self._pending is not None:
+            (frame, blink), self._pending = self._pending, None
+            self.write(frame, blink)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+class AsyncEngine(object):
+    """asyncio runtime for the display loop
+
+    Every collector of ``screens.collectors`` runs as its own task, ``chronyc`` and ``vcgencmd`` through
+    ``asyncio.create_subprocess_exec`` and gpsd with ``asyncio.open_connection``. The render tick only formats the
+    latest snapshot and hands the LCD write to a dedicated executor thread, a stalled chronyc or gpsd can no
+    longer freeze the clock.
+
+    Several displays sharing the same collectors each get their own render loop and their own writer thread. A
+    render loop sleeps until its screen ends or refreshes, or until a source the screen shows is published.
+
+        screens = Screens()
+        AsyncEngine(screens).run()
+    """
+
+    def __init__(self, screens):
+        """
+        :param screens: Screens or a list of Screens sharing their collectors
+        """
+        self.displays = list(screens) if isinstance(screens, (list, tuple)) else [screens]
+        self.screens = self.displays[0]
+
+        self._writers = []
+        self._tasks = []
+        self._loop = None
+
+        # render tick statistics, woken counts the ticks started by new data or an alert
+        self.ticks = 0
+        self.woken = 0
+        self.timing = TickStats('render')
+        self.max_render = 0.0
+
+    async def render_loop(self, screens, writer):
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+        # the sources publish from the loop or from executor threads
+        screens.wakeup_listeners.append(lambda: loop.call_soon_threadsafe(wakeup.set))
+
+        while True:
+            wakeup.clear()
+            start = loop.time()
+            self.ticks += 1
+
+            try:
+                frame = screens.next_frame(start)
+                if frame is not None:
+                    writer.write(frame, screens.screen_blink)
+            except Exception:
+                logger.exception('Screen render failed')
+
+            self.max_render = max(self.max_render, loop.time() - start)
+
+            # sleep until the screen ends or refreshes, or until a source it shows is published
+            deadline = screens.next_wakeup(loop.time())
+            try:
+                await asyncio.wait_for(wakeup.wait(), max(deadline - loop.time(), 0))
+                self.woken += 1
+            except asyncio.TimeoutError:
+                self.timing.record(loop.time() - deadline)
+
+    async def main(self):
+        self._loop = asyncio.get_running_loop()
+        self._writers = [DisplayWriter(screens, self._loop) for screens in self.displays]
+        self._tasks = self.screens.collectors.tasks() + [
+            asyncio.create_task(self.render_loop(screens, writer), name='render-{}'.format(ndx))
+            for ndx, (screens, writer) in enumerate(zip(self.displays, self._writers))
+        ]
+        try:
+            await asyncio.gather(*self._tasks)
+        finally:
+            for task in self._tasks:
+                task.cancel()
+
+    def run(self):
+        try:
+            asyncio.run(self.main())
+        finally:
+            for writer in self._writers:
+                writer.shutdown()
+
+    def stats(self):
+        """Render tick statistics, times in seconds
+
+        :return: dict
+        """
+        return dict(self.timing.stats(), **{
+            'ticks': self.ticks,
+            'woken': self.woken,
+            'max_render': self.max_render,
+            'dropped_frames': sum(writer.dropped_frames for writer in self._writers),
+        })
@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Stand-ins for the hardware and the daemons, so every code path can run on any machine.
+
+    CharLCD     records the DDRAM content and counts the bytes written instead of talking I2C
+    FakeShell   replays recorded chronyc, vcgencmd and ntpq outputs for SubprocessShell.shell_run
+    FakeChronyd UDP server replaying a recorded cmdmon tracking reply
+    FakeNtpd    UDP server answering NTP mode 6 READSTAT and READVAR requests
+    FakeGpsd    TCP server streaming recorded gpsd reports
+    FakeFleetNode publishes the fleet status datagrams of a made up timeserver
+    thermal_tree writes a /sys/class/thermal lookalike for ThermalZones
+"""
+
+import collections
+import json
+import os
+import socket
+import struct
+import subprocess
+import threading
+import time
+
+# recorded outputs, keyed by the command line given to SubprocessShell.shell_run
+recorded_commands = {
+    '/usr/bin/chronyc -c tracking':
+        b'47505300,GPS,1,1633000000.500000000,0.000001200,-0.000000350,0.000000410,-12.345,0.001,0.020,'
+        b'0.001000000,0.000025000,16.0,Normal\n',
+    '/usr/bin/vcgencmd measure_temp': b"temp=47.2'C\n",
+    'ntpq -pn':
+        b'     remote           refid      st t when poll reach   delay   offset  jitter\n'
+        b'==============================================================================\n'
+        b'*127.127.20.0    .GPS.            0 l    3   16  377    0.000   -0.002   0.004\n'
+        b'+192.168.1.10    .PPS.            1 u   33   64  377    0.412    0.015   0.011\n',
+    'ntpq -c rv':
+        b'associd=0 status=0615 leap_none, sync_ntp, 1 event, clock_sync,\n'
+        b'version="ntpd 4.2.8p15", processor="armv7l", system="Linux", leap=00, stratum=1,\n'
+        b'precision=-20, rootdelay=0.000, rootdisp=1.045, refid=GPS, reftime=e5c1a1a1.00000000,\n'
+        b'clock=e5c1a1a5.00000000, peer=1, tc=4, mintc=3, offset=-0.001812, frequency=-12.345,\n'
+        b'sys_jitter=0.003814, clk_jitter=0.002, clk_wander=0.001, tai=37, leapsec=201701010000,\n'
+        b'expire=202206280000\n',
+}
+
+# cmdmon tracking reply recorded from chronyd (refclock GPS, stratum 1), the sequence number is patched in
+recorded_tracking_reply = bytes.fromhex(
+    '06020000002100050000000000000000000000000000000000000000'
+    '47505300000000000000000000000000000000000000000000010000'
+    '0000000061559a401dcd6500dca10fb0d944185ed8dc1df90b3a7ae1'
+    'f083126ff8a3d70af083126fe4d1b7170c800000')
+
+# ntpd mode 6 variables, system (association 0) and peers, as sent on the wire
+recorded_ntpd_variables = {
+    0: 'version="ntpd 4.2.8p15@1.3728-o", processor="armv7l", system="Linux/5.10.63-v7+", leap=00, stratum=1, '
+       'precision=-20, rootdelay=0.000, rootdisp=1.045, refid=GPS, reftime=0xe5c1a1a1.00000000, '
+       'clock=0xe5c1a1a5.00000000, peer=38121, tc=4, mintc=3, offset=-0.001812, frequency=-12.345, '
+       'sys_jitter=0.003814, clk_jitter=0.002, clk_wander=0.001, tai=37, leapsec=0xdcf2ac00, '
+       'expire=0xe66d6c00',
+    38121: 'srcadr=127.127.20.0, srcport=123, dstadr=127.0.0.1, dstport=123, leap=00, stratum=0, '
+           'precision=-20, rootdelay=0.000, rootdisp=0.000, refid=GPS, reftime=0xe5c1a1a2.00000000, '
+           'rec=0xe5c1a1a2.00000000, reach=0xff, unreach=0, hmode=3, pmode=4, hpoll=4, ppoll=4, headway=0, '
+           'flash=0x0, keyid=0, offset=-0.002, delay=0.000, dispersion=0.938, jitter=0.004, xleave=0.000, '
+           'filtdelay= 0.00 0.00 0.00 0.00 0.00 0.00 0.00 0.00, '
+           'filtoffset= -0.00 0.00 -0.01 0.00 0.00 0.01 -0.00 0.00, '
+           'filtdisp= 0.00 0.95 1.90 2.85 3.80 4.75 5.70 6.65',
+    38122: 'srcadr=192.168.1.10, srcport=123, dstadr=192.168.1.2, dstport=123, leap=00, stratum=1, '
+           'precision=-20, rootdelay=0.000, rootdisp=0.214, refid=PPS, reftime=0xe5c1a181.00000000, '
+           'rec=0xe5c1a181.00000000, reach=0xff, unreach=0, hmode=3, pmode=4, hpoll=6, ppoll=6, headway=0, '
+           'flash=0x0, keyid=0, offset=0.015, delay=0.412, dispersion=1.201, jitter=0.011, xleave=0.040, '
+           'filtdelay= 0.41 0.43 0.40 0.41 0.44 0.42 0.41 0.40, '
+           'filtoffset= 0.02 0.01 0.01 0.02 0.01 0.02 0.01 0.02, '
+           'filtdisp= 0.00 0.95 1.90 2.85 3.80 4.75 5.70 6.65',
+}
+
+# peer status words, the GPS is the system peer and the LAN server a candidate
+recorded_ntpd_statuses = {38121: 0x961a, 38122: 0x941a}
+
+gpsd_reports = [
+    {'class': 'SKY', 'device': '/dev/ttyAMA0', 'hdop': 0.92, 'vdop': 1.21, 'pdop': 1.52,
+     'satellites': [{'PRN': n, 'el': 40, 'az': 10 * n, 'ss': 35, 'used': n % 3 != 0} for n in range(1, 12)]},
+    {'class': 'TPV', 'device': '/dev/ttyAMA0', 'mode': 3, 'time': '2021-10-01T12:00:00.000Z', 'ept': 0.005,
+     'lat': 44.4268, 'lon': 26.1025, 'alt': 82.3, 'epx': 2.1, 'epy': 2.8, 'epv': 5.2, 'track': 0.0,
+     'speed': 0.02, 'climb': 0.0, 'eps': 0.3},
+]
+
+
+def thermal_tree(root, zones=(('cpu-thermal', 47236), )):
+    """Write a /sys/class/thermal lookalike, one thermal_zoneN directory per zone
+
+    :param root: str directory to create the tree in
+    :param zones: sequence of (type, millidegrees)
+    :return: str root
+    """
+    for ndx, (zone_type, temp) in enumerate(zones):
+        zone = os.path.join(root, 'thermal_zone{}'.format(ndx))
+        os.makedirs(zone, exist_ok=True)
+        for name, value in (('type', zone_type), ('temp', temp), ('trip_point_0_type', 'critical'),
+                            ('trip_point_0_temp', 110000), ('trip_point_1_type', 'passive'),
+                            ('trip_point_1_temp', 80000)):
+            with open(os.path.join(zone, name), 'w') as f:
+                f.write('{}\n'.format(value))
+    return root
+
+
+class Counters(object):
+    """Subprocesses and sockets created while a benchmark runs"""
+
+    def __init__(self):
+        self.subprocesses = 0
+        self.sockets = 0
+        self.lcd_bytes = 0
+
+    def reset(self):
+        self.subprocesses = 0
+        self.sockets = 0
+        self.lcd_bytes = 0
+
+    def as_dict(self):
+        return {'subprocesses': self.subprocesses, 'sockets': self.sockets, 'lcd_bytes': self.lcd_bytes}
+
+
+counters = Counters()
+
+
+class CharLCD(object):
+    """RPLCD.i2c.CharLCD replacement, keeps the DDRAM in memory"""
+
+    def __init__(self, i2c_expander='PCF8574', address=0x27, port=1, cols=16, rows=2, **kwargs):
+        self.cols = cols
+        self.rows = rows
+        self.ddram = [[' '] * cols for _ in range(rows)]
+        self.cgram = [None] * 8
+        self._cgram_address = 0
+        self._pos = (0, 0)
+        self.backlight_enabled = True
+
+    def create_char(self, location, bitmap):
+        self.cgram[location] = tuple(bitmap)
+        counters.lcd_bytes += 10
+
+    def command(self, value):
+        # only the set CGRAM address instruction is used directly
+        self._cgram_address = value & 0x3F
+        counters.lcd_bytes += 1
+
+    def _send_data(self, value):
+        slot, row = divmod(self._cgram_address, 8)
+        bitmap = list(self.cgram[slot] or (0, ) * 8)
+        bitmap[row] = value
+        self.cgram[slot] = tuple(bitmap)
+        self._cgram_address = (self._cgram_address + 1) & 0x3F
+        counters.lcd_bytes += 1
+
+    def clear(self):
+        self.ddram = [[' '] * self.cols for _ in range(self.rows)]
+        self._pos = (0, 0)
+        counters.lcd_bytes += 1
+
+    def home(self):
+        self._pos = (0, 0)
+        counters.lcd_bytes += 1
+
+    @property
+    def cursor_pos(self):
+        return self._pos
+
+    @cursor_pos.setter
+    def cursor_pos(self, value):
+        self._pos = value
+        counters.lcd_bytes += 1
+
+    def write_string(self, value):
+        for char in value:
+            row, col = self._pos
+            self.ddram[row][col] = char
+            col += 1
+            if col == self.cols:
+                row, col = (row + 1) % self.rows, 0
+            self._pos = (row, col)
+        counters.lcd_bytes += len(value)
+
+    def lines(self):
+        return [''.join(row) for row in self.ddram]
+
+
+class FakeShell(object):
+    """SubprocessShell replacement answering with the recorded outputs"""
+
+    platform_settings = {}
+
+    def __init__(self, outputs=None):
+        self.outputs = dict(recorded_commands, **(outputs or {}))
+
+    def shell_run(self, cmd):
+        counters.subprocesses += 1
+        return b'', self.outputs.get(cmd, b'')
+
+
+class FakeChronyd(object):
+    """UDP server answering every cmdmon request with the recorded tracking reply"""
+
+    def __init__(self, reply=recorded_tracking_reply):
+        self.reply = reply
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.requests = 0
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _serve(self):
+        while True:
+            try:
+                request, addr = self.sock.recvfrom(1024)
+            except OSError:
+                return
+            self.requests += 1
+            # answer with the sequence number of the request
+            sequence = request[8:12]
+            try:
+                self.sock.sendto(self.reply[:16] + sequence + self.reply[20:], addr)
+            except OSError:
+                # stopped while answering
+                return
+
+    def stop(self):
+        self.sock.close()
+
+
+class FakeNtpd(object):
+    """UDP server speaking enough of the NTP mode 6 protocol for ntpq, replies longer than a fragment are split"""
+
+    fragment_size = 468
+    header = struct.Struct('!BBHHHHH')
+
+    def __init__(self, variables=None, statuses=None):
+        self.variables = variables or recorded_ntpd_variables
+        self.statuses = statuses or recorded_ntpd_statuses
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.requests = 0
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _serve(self):
+        while True:
+            try:
+                request, addr = self.sock.recvfrom(1024)
+            except OSError:
+                return
+            self.requests += 1
+            _, opcode, sequence, _, association, _, _ = self.header.unpack_from(request)
+            try:
+                for packet in self._replies(opcode & 0x1F, sequence, association):
+                    self.sock.sendto(packet, addr)
+            except OSError:
+                # stopped while answering
+                return
+
+    def _replies(self, opcode, sequence, association):
+        if opcode == 1:
+            data = b''.join(struct.pack('!HH', a, s) for a, s in self.statuses.items())
+            status = 0x0615
+        elif opcode == 2 and association in self.variables:
+            data = self.variables[association].encode('ascii')
+            status = self.statuses.get(association, 0x0615)
+        else:
+            # error bit, bad association
+            return [self.header.pack(0x16, 0xC0 | opcode, sequence, 3 << 8, association, 0, 0)]
+
+        packets = []
+        for offset in range(0, len(data), self.fragment_size):
+            chunk = data[offset:offset + self.fragment_size]
+            more = 0x20 if offset + self.fragment_size < len(data) else 0
+            packets.append(self.header.pack(0x16, 0x80 | more | opcode, sequence, status, association, offset,
+                                            len(chunk)) + chunk + b'\x00' * (-len(chunk) % 4))
+        # out of order, like a busy network would deliver them
+        return packets[::-1]
+
+    def stop(self):
+        self.sock.close()
+
+
+class FakeGpsd(object):
+    """TCP server speaking enough of the gpsd protocol for the watch stream"""
+
+    def __init__(self, reports=None, rate=1.0):
+        self.reports = reports or gpsd_reports
+        self.rate = rate
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(4)
+        self.port = self.sock.getsockname()[1]
+        self.connections = 0
+        self._running = True
+
+    def start(self):
+        threading.Thread(target=self._serve, daemon=True).start()
+        return self
+
+    def _serve(self):
+        while self._running:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self._client, args=(conn,), daemon=True).start()
+
+    def _client(self, conn):
+        stream = conn.makefile('rw')
+        try:
+            stream.write(json.dumps({'class': 'VERSION', 'release': '3.22', 'proto_major': 3}) + '\n')
+            stream.flush()
+            stream.readline()
+            stream.write(json.dumps({'class': 'DEVICES', 'devices': [
+                {'path': '/dev/ttyAMA0', 'driver': 'u-blox', 'bps': 9600}]}) + '\n')
+            stream.write(json.dumps({'class': 'WATCH', 'enable': True, 'json': True}) + '\n')
+            while self._running:
+                for report in self.reports:
+                    stream.write(json.dumps(report) + '\n')
+                stream.flush()
+                time.sleep(1.0 / self.rate)
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def stop(self):
+        self._running = False
+        self.sock.close()
+
+
+FakeGpsFix = collections.namedtuple('FakeGpsFix', ['mode', 'sats', 'sats_valid'])
+FakeTemperature = collections.namedtuple('FakeTemperature', ['label', 'current', 'high', 'critical'])
+
+
+class FakeFleetNode(object):
+    """Timeserver sending its fleet status to an aggregator, change ``offset``, ``gps_mode`` or ``stratum`` while
+    it runs to simulate a drifting clock or a lost fix"""
+
+    def __init__(self, node, port, host='127.0.0.1', offset=1e-6, stratum=1, gps_mode=3, sats=11, interval=0.1):
+        self.node = node
+        self.target = (host, port)
+        self.offset = offset
+        self.stratum = stratum
+        self.gps_mode = gps_mode
+        self.sats = sats
+        self.interval = interval
+        self.sequence = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._running = True
+
+    def snapshot(self):
+        # the parts of a collectors Snapshot read by fleet.encode_status
+        tracking = dict(zip(('stratum', 'system_time', 'last_offset', 'rms_offset', 'frequency', 'skew',
+                             'root_delay', 'leap_status'),
+                            (str(self.stratum), str(self.offset), str(self.offset), '0.000000410', '-12.345',
+                             '0.020', '0.000001000', 'Normal')))
+        return {
+            'chrony': ('', tracking),
+            'gpsd': FakeGpsFix(self.gps_mode, self.sats, self.sats - 2 if self.gps_mode >= 2 else 0),
+            'thermal': {'cpu': FakeTemperature('cpu-thermal', 47.2, None, None)},
+        }
+
+    def send(self):
+        from fleet import encode_status
+
+        self.sequence += 1
+        self.sock.sendto(encode_status(self.snapshot(), self.node, self.sequence), self.target)
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def _run(self):
+        while self._running:
+            try:
+                self.send()
+            except OSError:
+                return
+            time.sleep(self.interval)
+
+    def stop(self):
+        self._running = False
+        self.sock.close()
+
+
+def sensors_temperatures(fahrenheit=False):
+    """psutil.sensors_temperatures() of a Raspberry Pi"""
+    shwtemp = collections.namedtuple('shwtemp', ['label', 'current', 'high', 'critical'])
+    return {'cpu_thermal': [shwtemp('', 47.2, None, None)]}
+
+
+_socket = socket.socket
+_popen_init = subprocess.Popen.__init__
+
+
+class _CountingSocket(_socket):
+
+    def __init__(self, *args, **kwargs):
+        counters.sockets += 1
+        super().__init__(*args, **kwargs)
+
+
+def _counting_popen_init(self, *args, **kwargs):
+    counters.subprocesses += 1
+    _popen_init(self, *args, **kwargs)
+
+
+def install_counters():
+    """Count every socket and subprocess created from now on"""
+    socket.socket = _CountingSocket
+    subprocess.Popen.__init__ = _counting_popen_init
+
+
+def uninstall_counters():
+    socket.socket = _socket
+    subprocess.Popen.__init__ = _popen_init
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""Benchmark the registered screens, the display path and the parsers without any hardware.
+
+    python3 -m benchmarks.run                           # print the results
+    python3 -m benchmarks.run --save baseline.json      # store them as the baseline
+    python3 -m benchmarks.run --compare baseline.json   # compare with a baseline, exit 1 on regressions
+
+The LCD, chronyd, chronyc, ntpd, ntpq, vcgencmd and gpsd are replaced by the fakes in benchmarks.fakes.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import fakes
+
+try:
+    import RPLCD.i2c
+except ImportError:
+    # no RPLCD outside of the Pi, the fake LCD does not need it
+    import types
+    sys.modules['RPLCD'] = types.ModuleType('RPLCD')
+    sys.modules['RPLCD.i2c'] = types.ModuleType('RPLCD.i2c')
+    sys.modules['RPLCD.i2c'].CharLCD = fakes.CharLCD
+
+import psutil
+
+from libs.daemons import ntp_daemon_detector
+
+# detect nothing on the benchmark host, every screen stays registered
+ntp_daemon_detector.running = ntp_daemon_detector.CHRONYD
+ntp_daemon_detector.detected_at = time.monotonic()
+
+import LCDScreen
+from Screens import Screens
+from glyphs import BigClock
+from fleet import FleetTable, encode_status
+from scheduler import RotationScheduler
+from stability import StabilityAccumulator
+from libs.chrony import ChronyParser, ChronyCmdmon
+from libs.gpsd import Gpsd, GpsResponse
+from libs.ntpq import NtpqParser, NtpControl
+from libs.vcgencmd_pi import VcgencmdParser, ThermalZones, VideoCoreMailbox
+
+
+class Benchmark(object):
+    """Times a callable and reports latency percentiles, allocations and side effects per call"""
+
+    def __init__(self, iterations=2000, warmup=50):
+        self.iterations = iterations
+        self.warmup = warmup
+        self.results = {}
+
+    @staticmethod
+    def percentile(sorted_values, pct):
+        index = min(int(round(pct / 100.0 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+        return sorted_values[index]
+
+    def run(self, name, func, iterations=None, warmup=None):
+        iterations = iterations or self.iterations
+        warmup = self.warmup if warmup is None else warmup
+
+        for _ in range(warmup):
+            func()
+
+        fakes.counters.reset()
+        timings = []
+        perf_counter_ns = time.perf_counter_ns
+        for _ in range(iterations):
+            start = perf_counter_ns()
+            func()
+            timings.append(perf_counter_ns() - start)
+        side_effects = fakes.counters.as_dict()
+
+        # allocations are measured apart, tracemalloc slows down every call
+        allocation_runs = max(iterations // 10, 1)
+        tracemalloc.start()
+        blocks = sys.getallocatedblocks()
+        tracemalloc.reset_peak()
+        current, _ = tracemalloc.get_traced_memory()
+        for _ in range(allocation_runs):
+            func()
+        _, peak = tracemalloc.get_traced_memory()
+        blocks = sys.getallocatedblocks() - blocks
+        tracemalloc.stop()
+
+        timings.sort()
+        result = {
+            'iterations': iterations,
+            'mean_us': sum(timings) / len(timings) / 1000.0,
+            'p50_us': self.percentile(timings, 50) / 1000.0,
+            'p90_us': self.percentile(timings, 90) / 1000.0,
+            'p99_us': self.percentile(timings, 99) / 1000.0,
+            'max_us': timings[-1] / 1000.0,
+            'alloc_peak_bytes': max(peak - current, 0),
+            'alloc_blocks_per_call': blocks / allocation_runs,
+        }
+        for key, value in side_effects.items():
+            result['{}_per_call'.format(key)] = value / iterations
+        self.results[name] = result
+        return result
+
+
+def build_environment():
+    """Wire the fakes in place of the hardware and the daemons
+
+    :return: (Screens, dict) the screens instance and the fake servers
+    """
+    fakes.install_counters()
+
+    servers = {
+        'chronyd': fakes.FakeChronyd().start(),
+        'gpsd': fakes.FakeGpsd(rate=10).start(),
+        'ntpd': fakes.FakeNtpd().start(),
+    }
+
+    LCDScreen.CharLCD = fakes.CharLCD
+    psutil.sensors_temperatures = fakes.sensors_temperatures
+    ChronyParser.shell = fakes.FakeShell()
+    VcgencmdParser.shell = fakes.FakeShell()
+    NtpqParser.shell = fakes.FakeShell()
+
+    screens = Screens()
+    screens.chrony.cmdmon = ChronyCmdmon(socket_path=None, port=servers['chronyd'].port)
+    screens.gpsd.port = servers['gpsd'].port
+    screens.ntpq.control = NtpControl(port=servers['ntpd'].port)
+    screens.vcgencmd.thermal_zones = ThermalZones(fakes.thermal_tree(tempfile.mkdtemp(prefix='thermal')))
+    screens.vcgencmd.mailbox = VideoCoreMailbox('/nonexistent/vcio')
+
+    # fill the snapshot store once, the screens are pure functions of it
+    for collector in screens.collectors:
+        collector.start(screens.store)
+        collector.publish(screens.store, collector.collect())
+    screens.gpsd.connected.wait(2)
+    time.sleep(0.3)
+
+    return screens, servers
+
+
+def run_benchmarks(bench):
+    screens, servers = build_environment()
+    snap = screens.store.snapshot()
+
+    for method_name, _ in screens.methods_ordered:
+        method = getattr(screens, method_name.split('.')[1])
+        bench.run('screen.{}'.format(method_name.split('.')[1]), lambda method=method: method(snap))
+
+    bench.run('Screens.display_screen', screens.display_screen)
+    bench.run('Screens.loop_screens', screens.loop_screens)
+
+    # a rotation of 200 weighted screens, a tenth of them skipped for a few cycles
+    scheduler = RotationScheduler([('screen_{}'.format(n), {'order': n, 'weight': 1 + n % 3}) for n in range(200)])
+
+    def scheduler_next():
+        name = scheduler.next()
+        if name.endswith('0'):
+            scheduler.skip(name, 2)
+    bench.run('RotationScheduler.next.200_screens', scheduler_next, iterations=10000)
+
+    lcd = screens.lcd_screen
+    bench.run('LCDScreen.print_line.unchanged', lambda: lcd.print_line('12:00:00', 0, align='CENTER'))
+    texts = ['12:00:{:02d}'.format(sec) for sec in range(60)]
+    state = {'n': 0}
+
+    def print_line_changed():
+        state['n'] += 1
+        lcd.print_line(texts[state['n'] % 60], 0, align='CENTER')
+    bench.run('LCDScreen.print_line.changed', print_line_changed)
+
+    chrony = screens.chrony
+    clock_data = fakes.recorded_commands['/usr/bin/chronyc -c tracking'].decode('utf-8').strip().split(',')
+    bench.run('ChronyParser.parse_tracking', lambda: chrony.parse_tracking('', clock_data))
+    bench.run('ChronyParser.read_tracking.cmdmon', chrony.read_tracking, iterations=500)
+    chrony.use_cmdmon = False
+    bench.run('ChronyParser.read_tracking.chronyc', chrony.read_tracking)
+    chrony.use_cmdmon = True
+    bench.run('ChronyParser.chrony_tracking.cached', chrony.chrony_tracking)
+    tracking = chrony.parse_tracking('', clock_data)
+    bench.run('AlertEngine.update.chrony', lambda: screens.alerts.update('chrony', tracking))
+
+    vcgencmd = screens.vcgencmd
+    bench.run('VcgencmdParser.measure_temp', vcgencmd.measure_temp)
+    bench.run('ThermalZones.cpu', vcgencmd.thermal_zones.cpu)
+
+    ntpq = screens.ntpq
+    bench.run('NtpControl.system_and_peers', ntpq.control.system_and_peers, iterations=500)
+    bench.run('NtpqParser.ntpq_pn.cached', ntpq.ntpq_pn, iterations=500)
+    bench.run('NtpqParser.ntpq_rv.cached', ntpq.ntpq_rv, iterations=500)
+    ntpq.use_control = False
+    bench.run('NtpqParser.ntpq_pn.ntpq', ntpq.ntpq_pn)
+    bench.run('NtpqParser.ntpq_rv.ntpq', ntpq.ntpq_rv)
+    ntpq.use_control = True
+
+    sky, tpv = fakes.gpsd_reports
+    bench.run('GpsResponse.from_reports', lambda: GpsResponse.from_reports(tpv, sky))
+    gpsd = Gpsd(autostart=False)
+    bench.run('Gpsd.feed.tpv', lambda: gpsd.feed(tpv))
+    bench.run('Gpsd.get_current', screens.gpsd.get_current)
+
+    big_clock = BigClock()
+    bench.run('BigClock.render', big_clock.render)
+
+    # a day of 1Hz offsets, white phase noise around 1us
+    rng = random.Random(1)
+    day = [rng.gauss(0, 1e-6) for _ in range(86400)]
+    samples = iter(day * 2)
+    accumulator = StabilityAccumulator()
+    bench.run('StabilityAccumulator.add', lambda: accumulator.add(next(samples)), iterations=10000)
+    bench.run('StabilityAccumulator.extend.24h_1Hz', lambda: StabilityAccumulator().extend(day), iterations=5,
+              warmup=1)
+    bench.run('ClockStability.results', screens.chrony.stability.results)
+
+    fleet = FleetTable()
+    nodes = [fakes.FakeFleetNode('ts{:02d}'.format(n), 9124, offset=n * 1e-6) for n in range(32)]
+    datagrams = itertools.cycle([encode_status(node.snapshot(), node.node, sequence)
+                                 for sequence in range(1, 101) for node in nodes])
+    bench.run('FleetTable.receive', lambda: fleet.receive(next(datagrams)), iterations=10000)
+    bench.run('FleetTable.view.32_nodes', fleet.view)
+    for node in nodes:
+        node.stop()
+
+    for server in servers.values():
+        server.stop()
+    screens.gpsd.stop()
+    fakes.uninstall_counters()
+
+    return bench.results
+
+
+def compare(results, baseline, threshold):
+    """Print the p50 ratio against the baseline
+
+    :return: list[str] names of the benchmarks slower than the threshold
+    """
+    regressions = []
+    print('{:<45} {:>10} {:>10} {:>8}'.format('benchmark', 'base p50', 'p50', 'ratio'))
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            print('{:<45} {:>10} {:>10.1f} {:>8}'.format(name, '-', result['p50_us'], 'new'))
+            continue
+        ratio = result['p50_us'] / base['p50_us'] if base['p50_us'] else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = ' !'
+        print('{:<45} {:>10.1f} {:>10.1f} {:>8.2f}{}'.format(name, base['p50_us'], result['p50_us'], ratio, flag))
+    return regressions
+
+
+def print_results(results):
+    print('{:<45} {:>9} {:>9} {:>9} {:>9} {:>9} {:>6} {:>6} {:>6}'.format(
+        'benchmark', 'p50 us', 'p90 us', 'p99 us', 'max us', 'alloc B', 'proc', 'sock', 'lcd B'))
+    for name, result in results.items():
+        print('{:<45} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9d} {:>6.2f} {:>6.2f} {:>6.1f}'.format(
+            name, result['p50_us'], result['p90_us'], result['p99_us'], result['max_us'],
+            result['alloc_peak_bytes'], result['subprocesses_per_call'], result['sockets_per_call'],
+            result['lcd_bytes_per_call']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hardware free benchmarks of the screens and the parsers')
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--save', metavar='JSON', help='store the results as a baseline')
+    parser.add_argument('--compare', metavar='JSON', help='compare the results with a baseline')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='p50 slowdown ratio reported as a regression (default 0.25 = 25%%)')
+    args = parser.parse_args()
+
+    results = run_benchmarks(Benchmark(iterations=args.iterations))
+    print_results(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'iterations': args.iterations,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
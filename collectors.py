@@ -0,0 +1,435 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import asyncio
+import json
+import logging
+import threading
+import time
+import types
+
+import psutil
+
+from libs.chrony import ChronyCmdmonError
+from instrumentation import histogram, counter
+from tools import SubprocessShell
+
+logger = logging.getLogger(__name__)
+
+# commands of the asyncio collectors, the limits and the single flight are shared with every SubprocessShell
+command_runner = SubprocessShell()
+
+
+class Snapshot(object):
+    """Immutable view of everything the collectors published
+
+    :var self.version: incremented on every publish
+    :var self.data: mapping source name -> last published value
+    :var self.updated: mapping source name -> time.monotonic() of the last publish
+    """
+
+    __slots__ = ('version', 'data', 'updated')
+
+    def __init__(self, version=0, data=None, updated=None):
+        object.__setattr__(self, 'version', version)
+        object.__setattr__(self, 'data', types.MappingProxyType(dict(data or {})))
+        object.__setattr__(self, 'updated', types.MappingProxyType(dict(updated or {})))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Snapshot is read-only")
+
+    def __getitem__(self, source):
+        return self.data[source]
+
+    def __contains__(self, source):
+        return source in self.data
+
+    def __repr__(self):
+        return "<Snapshot v{} {}>".format(self.version, sorted(self.data))
+
+    def get(self, source, default=None):
+        return self.data.get(source, default)
+
+    def age(self, source):
+        """Seconds since the source was last published, None if it never was
+
+        :param source: str
+        :return: float
+        """
+        updated = self.updated.get(source)
+        return None if updated is None else time.monotonic() - updated
+
+
+class SnapshotStore(object):
+    """Thread safe, versioned store the collectors publish into
+
+    Readers get the current :class:`Snapshot` with a single attribute read, publishing builds a new snapshot so a
+    reader never sees a half updated one.
+    """
+
+    def __init__(self):
+        self._snapshot = Snapshot()
+        self._condition = threading.Condition()
+
+        # callables receiving (source, value) after every publish, called from the publishing thread
+        self.listeners = []
+
+    def publish(self, source, value):
+        """Publish a new value for a source
+
+        :param source: str
+        :param value: any immutable value
+        :return: int the new version
+        """
+        with self._condition:
+            current = self._snapshot
+            data = dict(current.data)
+            updated = dict(current.updated)
+            data[source] = value
+            updated[source] = time.monotonic()
+            self._snapshot = Snapshot(current.version + 1, data, updated)
+            self._condition.notify_all()
+            version = self._snapshot.version
+
+        for listener in self.listeners:
+            listener(source, value)
+        return version
+
+    def snapshot(self):
+        """
+        :return: Snapshot
+        """
+        return self._snapshot
+
+    def wait(self, version, timeout=None):
+        """Block until a snapshot newer than ``version`` is published
+
+        :param version: int
+        :param timeout: float seconds
+        :return: Snapshot the current snapshot, possibly not newer if the wait timed out
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._snapshot.version > version, timeout)
+            return self._snapshot
+
+
+async def run_command(*argv, timeout=5.0):
+    """Run a command without a shell and return its output
+
+    :param argv: program and arguments
+    :param timeout: float seconds before the command is killed
+    :return: (bytes, bytes) stderr, stdout
+    """
+    return await command_runner.arun(*argv, timeout=timeout)
+
+
+class Collector(object):
+    """One data source, sampled every ``interval`` seconds and published under ``name``
+
+    Subclasses implement :meth:`collect`, a blocking call used by the thread runner. The asyncio runner calls
+    :meth:`acollect`, which defaults to running :meth:`collect` in the default executor.
+    """
+
+    name = None
+    interval = 1.0
+
+    # kill a command that did not finish after this many seconds
+    command_timeout = 5.0
+
+    def collect(self):
+        raise NotImplementedError
+
+    def instrument(self):
+        """Latency histogram and error counter of this collector"""
+        if not hasattr(self, '_histogram'):
+            self._histogram = histogram('collector.{}'.format(self.name))
+            self._errors = counter('collector.{}.errors'.format(self.name))
+        return self._histogram, self._errors
+
+    async def acollect(self):
+        return await asyncio.get_running_loop().run_in_executor(None, self.collect)
+
+    def publish(self, store, value):
+        # a cached source returns the same object until it changes, do not bump the version for it
+        if value is not store.snapshot().get(self.name):
+            store.publish(self.name, value)
+
+    def start(self, store):
+        """Called once by the thread runner before the first collect()"""
+
+    def stop(self):
+        """Called once by the thread runner when it stops"""
+
+    async def arun(self, store):
+        hist, errors = self.instrument()
+        while True:
+            start = time.perf_counter_ns()
+            try:
+                self.publish(store, await self.acollect())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                errors.inc()
+                logger.exception('{} collector failed'.format(self.name))
+            hist.observe_ns(time.perf_counter_ns() - start)
+            await asyncio.sleep(self.interval)
+
+
+class NtpDaemonCollector(Collector):
+    """Which NTP daemon is running, checked again on a slow cadence"""
+
+    name = 'ntp_daemon'
+    interval = 60.0
+
+    def __init__(self, detector):
+        self.detector = detector
+
+    def collect(self):
+        return self.detector.detect(force=True)
+
+
+class ChronyCollector(Collector):
+    """chronyd tracking report, read through the ChronyParser tracking cache"""
+
+    name = 'chrony'
+    interval = 1.0
+
+    not_running = ('chronyd is not running', {})
+
+    def __init__(self, chrony, detector=None):
+        self.chrony = chrony
+        self.detector = detector
+
+    def _other_daemon(self):
+        # do not poll chronyd while another NTP daemon is known to be running
+        return self.detector is not None and self.detector.running not in (None, self.detector.CHRONYD)
+
+    def collect(self):
+        if self._other_daemon():
+            return self.not_running
+        return self.chrony.chrony_tracking()
+
+    async def acollect(self):
+        if self._other_daemon():
+            return self.not_running
+
+        chrony = self.chrony
+        cache = chrony.tracking_cache
+
+        if cache.expired():
+            report = None
+            if chrony.use_cmdmon:
+                try:
+                    # a single local datagram exchange, bounded by the cmdmon timeout
+                    clock_data = await asyncio.get_running_loop().run_in_executor(None, chrony.cmdmon.tracking)
+                    report = chrony.parse_tracking('', clock_data)
+                except ChronyCmdmonError:
+                    pass
+
+            if report is None:
+                stderr, stdout = await run_command(chrony.chronyc_path, '-c', 'tracking',
+                                                   timeout=self.command_timeout)
+                report = chrony.parse_tracking(stderr.decode('UTF-8'), stdout.decode('utf-8').strip().split(','))
+
+            cache.put(*report)
+            if report[0]:
+                return report
+
+        return cache.get()
+
+
+class GpsdCollector(Collector):
+    """gpsd watch stream, every TPV/SKY report publishes a new GpsResponse"""
+
+    name = 'gpsd'
+    interval = 1.0
+
+    reconnect_delay = 1.0
+    reconnect_delay_max = 30.0
+
+    def __init__(self, gpsd):
+        self.gpsd = gpsd
+        self._store = None
+
+    def _on_update(self, response):
+        if self._store is not None:
+            self.publish(self._store, response)
+
+    def collect(self):
+        return self.gpsd.get_current()
+
+    def start(self, store):
+        self._store = store
+        self.gpsd.listeners.append(self._on_update)
+        self.gpsd.start()
+
+    def stop(self):
+        self.gpsd.stop()
+        if self._on_update in self.gpsd.listeners:
+            self.gpsd.listeners.remove(self._on_update)
+
+    async def arun(self, store):
+        gpsd = self.gpsd
+        self._store = store
+        gpsd.listeners.append(self._on_update)
+        delay = self.reconnect_delay
+
+        while True:
+            writer = None
+            try:
+                reader, writer = await asyncio.open_connection(gpsd.host, gpsd.port)
+                welcome = json.loads(await reader.readline())
+                if welcome['class'] != "VERSION":
+                    raise Exception("Unexpected data received as welcome. Is the server a gpsd 3 server?")
+                writer.write(b'?WATCH={"enable":true,"json":true}\n')
+                await writer.drain()
+                gpsd.connects += 1
+                gpsd.connected.set()
+                delay = self.reconnect_delay
+
+                while True:
+                    raw = await reader.readline()
+                    if not raw:
+                        break
+                    gpsd.feed(json.loads(raw))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.debug("gpsd stream error: {}".format(e))
+            finally:
+                gpsd.connected.clear()
+                if writer:
+                    writer.close()
+
+            # publishes the empty response through _on_update
+            gpsd.reset()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.reconnect_delay_max)
+
+
+class ThermalCollector(Collector):
+    """GPU temperature from the VideoCore mailbox (vcgencmd when it is missing) and the SoC thermal zone
+
+    Publishes ``{'gpu': (stderr, {'measure_temp': float}), 'cpu': Temperature or None}``, Temperature has the
+    fields of the psutil sensors.
+    """
+
+    name = 'thermal'
+    interval = 5.0
+
+    def __init__(self, vcgencmd):
+        self.vcgencmd = vcgencmd
+
+    def cpu_thermal(self):
+        temperature = self.vcgencmd.thermal_zones.cpu()
+        if temperature is not None:
+            return temperature
+        # no thermal zones, walk hwmon
+        sensors = psutil.sensors_temperatures().get('cpu_thermal')
+        return sensors[0] if sensors else None
+
+    def gpu_temp(self, stderr, stdout):
+        try:
+            return self.vcgencmd.parse_measure_temp(stderr, stdout)
+        except AttributeError:
+            # vcgencmd missing or not answering, keep the screen alive
+            return stderr.decode('UTF-8') or 'Unexpected vcgencmd output', {'measure_temp': float('nan')}
+
+    def collect(self):
+        gpu = self.vcgencmd.gpu_temp()
+        if gpu is None:
+            gpu = self.gpu_temp(*self.vcgencmd.shell.shell_run(self.vcgencmd.vcgencmd_bin + ' measure_temp'))
+        return {'gpu': gpu, 'cpu': self.cpu_thermal()}
+
+    async def acollect(self):
+        # a single ioctl and a pread, not worth an executor
+        gpu = self.vcgencmd.gpu_temp()
+        if gpu is None:
+            gpu = self.gpu_temp(*await run_command(self.vcgencmd.vcgencmd_bin, 'measure_temp',
+                                                   timeout=self.command_timeout))
+        return {'gpu': gpu, 'cpu': self.cpu_thermal()}
+
+
+class PsutilCollector(Collector):
+    """CPU frequency, load average, network counters and boot time"""
+
+    name = 'psutil'
+    interval = 1.0
+
+    interface = 'eth0'
+
+    def __init__(self):
+        # does not change while the system is up
+        self.boot_time = psutil.boot_time()
+
+    def collect(self):
+        return {
+            'cpu_freq': psutil.cpu_freq(),
+            'loadavg': psutil.getloadavg(),
+            'net_io': psutil.net_io_counters(pernic=True).get(self.interface),
+            'boot_time': self.boot_time,
+        }
+
+
+class Collectors(object):
+    """Runs a set of collectors, each on its own thread or asyncio task, publishing into one SnapshotStore"""
+
+    def __init__(self, store, collectors):
+        self.store = store
+        self.collectors = list(collectors)
+        self._threads = []
+        self._stop = threading.Event()
+
+    def __iter__(self):
+        return iter(self.collectors)
+
+    def _run(self, collector):
+        hist, errors = collector.instrument()
+        while not self._stop.is_set():
+            start = time.perf_counter_ns()
+            try:
+                collector.publish(self.store, collector.collect())
+            except Exception:
+                errors.inc()
+                logger.exception('{} collector failed'.format(collector.name))
+            hist.observe_ns(time.perf_counter_ns() - start)
+            self._stop.wait(collector.interval)
+
+    def start(self):
+        """Start one daemon thread per collector"""
+        self._stop.clear()
+        for collector in self.collectors:
+            collector.start(self.store)
+            thread = threading.Thread(target=self._run, args=(collector,),
+                                      name='collector-{}'.format(collector.name), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for collector in self.collectors:
+            collector.stop()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def tasks(self):
+        """Create one asyncio task per collector, to be called from a running event loop
+
+        :return: list[asyncio.Task]
+        """
+        return [asyncio.create_task(collector.arun(self.store), name=collector.name)
+                for collector in self.collectors]
@@ -13,63 +13,77 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
-import psutil
+from libs.daemons import ntp_daemon_detector
+
+# screen method name prefix of every NTP daemon
+ntp_daemon_screens = {
+    'chronyd': 'chrony_',
+    'ntpd': 'ntpq_',
+}
+
+# screens registered by register_screen, grouped by the qualified name of the class defining them
+_registered_screens = {}
 
 
 def class_register_screen(cls) -> type:
-    """
+    """Collect the screens registered while the class body was executed and order them.
+
+    When an NTP daemon is detected the screens of the other daemons are left out.
 
     :param cls:
     :return:
     """
     cls._propdict = {}
-    cls.methods_ordered = []
 
-    # what NTP daemons list to be search by
-    ntp_daemons_list = ['ntpq', 'chronyd']
-    ntp_daemon = ntp_daemons_list
+    for method_name, args in _registered_screens.pop(cls.__qualname__, []):
+        cls._propdict["{}.{}".format(cls.__name__, method_name)] = args
 
-    # NTP daemon currently running
-    ntp_daemon_running = None
+    # all the screens, the rotation is filtered from it again when the NTP daemon changes
+    cls.methods_registered = sorted(cls._propdict.items(), key=lambda x: x[1]['order'])
 
-    # check if in the current deploy is running chrony or ntpq
-    for proc in psutil.process_iter(['name']):
-        proc_name = proc.info.get('name')
-        if proc.info.get('name') in ntp_daemons_list:
-            ntp_daemon_running = proc_name
-            break
+    # check if in the current deploy is running chrony or ntpd
+    cls.ntp_daemon_running = ntp_daemon_detector.detect()
+    cls.methods_ordered = screens_for_daemon(cls.methods_registered, cls.ntp_daemon_running)
 
-    for method_name in dir(cls):
-        method = getattr(cls, method_name)
-        if hasattr(method, '_args') and ('order' in method._args.keys()):
-            cls._propdict.update(
-                {"{}.{}".format(cls.__name__, method_name): method._args})
+    return cls
 
-    if ntp_daemon_running:
-        ntp_daemon.remove(ntp_daemon_running)
-        for key, val in cls._propdict.copy().items():
-            daemon = key.split('.')[1]
-            if daemon.startswith(ntp_daemon[0]):
-                cls._propdict.pop(key, None)
 
-    cls.methods_ordered = sorted(cls._propdict.items(), key=lambda x: x[1]['order'])
+def screens_for_daemon(methods, ntp_daemon_running):
+    """Leave out the screens of the NTP daemons that are not running.
 
-    return cls
+    :param methods: list of (name, args) registered screens
+    :param ntp_daemon_running: str daemon name or None to keep every screen
+    :return: list of (name, args)
+    """
+    if not ntp_daemon_running:
+        return list(methods)
+
+    excluded = tuple(prefix for daemon, prefix in ntp_daemon_screens.items() if daemon != ntp_daemon_running)
+    return [method for method in methods if not method[0].split('.')[1].startswith(excluded)]
 
 
-def register_screen(order, screen_time=5, *args, **kwargs):
+def register_screen(order, screen_time=5, priority=0, weight=1, refresh=None, sources=None, *args, **kwargs):
     """Define the default attributes for registered screen methods.
 
     :param order: int Order for each screen
     :param screen_time: int Time of each screen
+    :param priority: int Alerts of a higher priority are shown first
+    :param weight: int Times the screen comes up in one rotation, 0 shows it only as an alert
+    :param refresh: float Seconds between two renders of a screen changing with the time, on the wall clock
+    :param sources: tuple Snapshot sources the screen reads, it is rendered again only when one of them is
+        published or on its refresh, None renders it on every tick of the display
+    :param flash: bool set if the screen is shown only once
     :param dynamic: bool set if the screen is updated every cycle
     :param args:
     :param kwargs:
     :return:
     """
     def wrapper(func):
-        kwargs.update({'order': order, 'screen_time': screen_time})
+        kwargs.update({'order': order, 'screen_time': screen_time, 'priority': priority, 'weight': weight,
+                       'refresh': refresh, 'sources': sources})
         func.args = args
         func._args = kwargs
+        owner, _, method_name = func.__qualname__.rpartition('.')
+        _registered_screens.setdefault(owner, []).append((method_name, kwargs))
         return func
     return wrapper
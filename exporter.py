@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# chrony tracking fields exported as gauges: field, metric name, help
+chrony_gauges = [
+    ('stratum', 'rplcd_chrony_stratum', 'Stratum of the local clock'),
+    ('ref_time_(utc)', 'rplcd_chrony_reference_time_seconds', 'Time of the last measurement from the reference'),
+    ('system_time', 'rplcd_chrony_system_time_seconds', 'Offset between the system clock and NTP time'),
+    ('last_offset', 'rplcd_chrony_last_offset_seconds', 'Estimated local offset on the last clock update'),
+    ('rms_offset', 'rplcd_chrony_rms_offset_seconds', 'Long-term average of the offset'),
+    ('frequency', 'rplcd_chrony_frequency_ppm', 'Rate by which the system clock would be wrong without chronyd'),
+    ('residual_freq', 'rplcd_chrony_residual_frequency_ppm', 'Residual frequency of the current reference'),
+    ('skew', 'rplcd_chrony_skew_ppm', 'Estimated error bound on the frequency'),
+    ('root_delay', 'rplcd_chrony_root_delay_seconds', 'Network path delay to the stratum-1 computer'),
+    ('root_dispersion', 'rplcd_chrony_root_dispersion_seconds', 'Dispersion accumulated back to stratum-1'),
+    ('update_interval', 'rplcd_chrony_update_interval_seconds', 'Interval between the last two clock updates'),
+]
+
+
+def _value(value):
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsRenderer(object):
+    """Render a collectors Snapshot in the Prometheus text exposition format
+
+    The text only depends on the snapshot, it is rendered once per snapshot version and every scrape in between
+    gets the same bytes. A scrape never reaches chronyd, gpsd or any command.
+    """
+
+    def __init__(self, store, interface='eth0'):
+        self.store = store
+        self.interface = interface
+        self._version = None
+        self._body = b''
+        self._lock = threading.Lock()
+        self.renders = 0
+        self.scrapes = 0
+
+    def body(self):
+        """
+        :return: bytes
+        """
+        self.scrapes += 1
+        snap = self.store.snapshot()
+        if snap.version != self._version:
+            with self._lock:
+                if snap.version != self._version:
+                    self._body = self.render(snap).encode('utf-8')
+                    self._version = snap.version
+                    self.renders += 1
+        return self._body
+
+    def render(self, snap):
+        lines = []
+
+        def gauge(name, help_text, samples):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} gauge'.format(name))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(name, labels, _value(value)))
+
+        def counter(name, help_text, samples):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} counter'.format(name))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(name, labels, _value(value)))
+
+        gauge('rplcd_snapshot_version', 'Version of the collected data snapshot', [('', snap.version)])
+
+        # monotonic publish times converted to unix time
+        offset = time.time() - time.monotonic()
+        gauge('rplcd_source_updated_seconds', 'Unix time of the last update of every data source',
+              [('{{source="{}"}}'.format(_label(source)), updated + offset)
+               for source, updated in sorted(snap.updated.items())])
+
+        stderr, tracking = snap.get('chrony', ('', {}))
+        if tracking:
+            gauge('rplcd_chrony_up', 'Whether the last tracking report was read', [('', 0 if stderr else 1)])
+            for field, name, help_text in chrony_gauges:
+                try:
+                    gauge(name, help_text, [('', float(tracking[field]))])
+                except (KeyError, ValueError):
+                    continue
+            gauge('rplcd_chrony_reference_info', 'Current reference', [(
+                '{{reference_id="{}",reference_name="{}"}}'.format(
+                    _label(tracking.get('reference_id', '')), _label(tracking.get('reference_name', ''))), 1)])
+            gauge('rplcd_chrony_leap_status', 'Leap status', [(
+                '{{status="{}"}}'.format(_label(tracking.get('leap_status', ''))), 1)])
+        elif 'chrony' in snap:
+            gauge('rplcd_chrony_up', 'Whether the last tracking report was read', [('', 0)])
+
+        gps = snap.get('gpsd')
+        if gps is not None:
+            gauge('rplcd_gps_mode', 'GPS fix mode, 0=no value, 1=no fix, 2=2D fix, 3=3D fix', [('', gps.mode)])
+            gauge('rplcd_gps_satellites', 'GPS satellites', [
+                ('{state="visible"}', gps.sats), ('{state="used"}', gps.sats_valid)])
+            gauge('rplcd_gps_dop', 'GPS dilution of precision', [
+                ('{type="h"}', gps.hdop), ('{type="v"}', gps.vdop), ('{type="p"}', gps.pdop)])
+
+        thermal = snap.get('thermal')
+        if thermal is not None:
+            samples = []
+            if thermal.get('cpu') is not None:
+                samples.append(('{sensor="cpu"}', thermal['cpu'].current))
+            if thermal.get('gpu') is not None:
+                samples.append(('{sensor="gpu"}', thermal['gpu'][1].get('measure_temp', float('nan'))))
+            gauge('rplcd_temperature_celsius', 'SoC temperatures', samples)
+
+        system = snap.get('psutil')
+        if system is not None:
+            gauge('rplcd_load_average', 'System load average', [
+                ('{{period="{}"}}'.format(period), value)
+                for period, value in zip(('1m', '5m', '15m'), system['loadavg'])])
+            if system.get('cpu_freq') is not None:
+                gauge('rplcd_cpu_frequency_mhz', 'CPU frequency', [
+                    ('{type="current"}', system['cpu_freq'].current), ('{type="max"}', system['cpu_freq'].max)])
+            if system.get('net_io') is not None:
+                interface = _label(self.interface)
+                counter('rplcd_network_transmit_bytes_total', 'Bytes sent',
+                        [('{{interface="{}"}}'.format(interface), system['net_io'][0])])
+                counter('rplcd_network_receive_bytes_total', 'Bytes received',
+                        [('{{interface="{}"}}'.format(interface), system['net_io'][1])])
+            gauge('rplcd_boot_time_seconds', 'Unix time of the system boot', [('', system['boot_time'])])
+
+        lines.append('')
+        return '\n'.join(lines)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    renderer = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics':
+            body = self.renderer.body()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+        elif self.path == '/':
+            body = b'<html><body><a href="/metrics">metrics</a></body></html>'
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+        else:
+            body = b'Not found\n'
+            self.send_response(404)
+            self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+
+class MetricsExporter(object):
+    """Embedded HTTP server exposing the collected data on /metrics
+
+        exporter = MetricsExporter(screens.store, port=9123)
+        exporter.start()
+    """
+
+    def __init__(self, store, address='0.0.0.0', port=9123):
+        self.renderer = MetricsRenderer(store)
+        handler = type('BoundMetricsHandler', (MetricsHandler,), {'renderer': self.renderer})
+        self.server = ThreadingHTTPServer((address, port), handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='metrics-exporter', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
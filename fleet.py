@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""Status of a fleet of timeservers on one display.
+
+Every node publishes a fixed size binary datagram with its chrony tracking and gpsd fix at a fixed cadence, the
+aggregator keeps the latest datagram of every node and the fleet screens are rendered from that table.
+
+    node:       FleetPublisher(screens.store, [('10.0.0.1', 9124)]).start()
+    aggregator: python3 main.py --fleet-listen 9124
+"""
+
+import asyncio
+import logging
+import math
+import socket
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from collectors import Collector
+from libs.chrony import ChronyCmdmon
+from instrumentation import counter
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'RPTS'
+VERSION = 1
+
+# magic, version, flags, sequence, node, sent (unix time), system_time, last_offset, rms_offset, frequency, skew,
+# root_delay, temperature, stratum, leap status, gps mode, satellites visible, satellites used
+status_datagram = struct.Struct('!4sBBI16sdfffffffBBBBB')
+
+# flags
+CHRONY_UP = 0x01
+GPS_PRESENT = 0x02
+
+leap_status = ChronyCmdmon.leap_status
+
+NodeStatus = namedtuple('NodeStatus', [
+    'node', 'sequence', 'sent', 'received', 'flags', 'system_time', 'last_offset', 'rms_offset', 'frequency',
+    'skew', 'root_delay', 'temperature', 'stratum', 'leap_status', 'gps_mode', 'sats', 'sats_used'])
+
+
+def _float(mapping, field):
+    try:
+        return float(mapping[field])
+    except (KeyError, TypeError, ValueError):
+        return math.nan
+
+
+def encode_status(snap, node, sequence, now=None):
+    """Pack the chrony, gpsd and thermal values of a snapshot in a status datagram
+
+    :param snap: Snapshot
+    :param node: str node name, at most 16 bytes are sent
+    :param sequence: int
+    :param now: float unix time, the current time when None
+    :return: bytes
+    """
+    flags = 0
+
+    stderr, tracking = snap.get('chrony', ('', {}))
+    if tracking and not stderr:
+        flags |= CHRONY_UP
+    try:
+        stratum = min(int(tracking.get('stratum', 16)), 255)
+    except ValueError:
+        stratum = 16
+    leap = tracking.get('leap_status', 'Not synchronised')
+    leap = leap_status.index(leap) if leap in leap_status else len(leap_status) - 1
+
+    gps = snap.get('gpsd')
+    if gps is not None:
+        flags |= GPS_PRESENT
+        gps_mode, sats, sats_used = gps.mode, min(gps.sats, 255), min(gps.sats_valid, 255)
+    else:
+        gps_mode, sats, sats_used = 0, 0, 0
+
+    thermal = snap.get('thermal') or {}
+    temperature = thermal['cpu'].current if thermal.get('cpu') is not None else math.nan
+
+    return status_datagram.pack(
+        MAGIC, VERSION, flags, sequence & 0xffffffff, node.encode('utf-8')[:16], time.time() if now is None else now,
+        _float(tracking, 'system_time'), _float(tracking, 'last_offset'), _float(tracking, 'rms_offset'),
+        _float(tracking, 'frequency'), _float(tracking, 'skew'), _float(tracking, 'root_delay'), temperature,
+        stratum, leap, gps_mode, sats, sats_used)
+
+
+def decode_status(data, received=None):
+    """
+    :param data: bytes a status datagram
+    :param received: float monotonic time the datagram was received
+    :return: NodeStatus
+    :raise ValueError: on a datagram of another size, protocol or version
+    """
+    if len(data) != status_datagram.size:
+        raise ValueError('status datagram of {} bytes'.format(len(data)))
+    (magic, version, flags, sequence, node, sent, system_time, last_offset, rms_offset, frequency, skew, root_delay,
+     temperature, stratum, leap, gps_mode, sats, sats_used) = status_datagram.unpack(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not a version {} status datagram'.format(VERSION))
+
+    return NodeStatus(node.rstrip(b'\0').decode('utf-8', 'replace'), sequence, sent,
+                      time.monotonic() if received is None else received, flags, system_time, last_offset,
+                      rms_offset, frequency, skew, root_delay, temperature, stratum,
+                      leap_status[leap] if leap < len(leap_status) else '?', gps_mode, sats, sats_used)
+
+
+class FleetPublisher(object):
+    """Send the status of this node to the aggregators every ``interval`` seconds
+
+    The datagram is built from the latest snapshot, the publisher never waits on chronyd or gpsd.
+
+        publisher = FleetPublisher(screens.store, [('10.0.0.1', 9124)])
+        publisher.start()
+    """
+
+    def __init__(self, store, targets, node=None, interval=1.0):
+        """
+        :param store: SnapshotStore
+        :param targets: list of (host, port) aggregators, broadcast addresses are allowed
+        :param node: str name of this node, the host name when None
+        :param interval: float seconds between two datagrams
+        """
+        self.store = store
+        self.targets = list(targets)
+        self.node = node or socket.gethostname().split('.')[0]
+        self.interval = interval
+
+        self.sequence = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.sent = counter('fleet.sent')
+        self.errors = counter('fleet.send_errors')
+
+    def send(self):
+        self.sequence += 1
+        datagram = encode_status(self.store.snapshot(), self.node, self.sequence)
+        for target in self.targets:
+            try:
+                self.sock.sendto(datagram, target)
+                self.sent.inc()
+            except OSError as e:
+                self.errors.inc()
+                logger.debug('fleet status to {} failed: {}'.format(target, e))
+
+    def _run(self):
+        deadline = time.monotonic()
+        while not self._stop.is_set():
+            self.send()
+            deadline += self.interval
+            self._stop.wait(max(deadline - time.monotonic(), 0))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='fleet-publisher', daemon=True)
+        self._thread.start()
+        logger.info('Publishing the fleet status of {} to {}'.format(self.node, self.targets))
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.sock.close()
+
+
+class FleetView(object):
+    """Immutable summary of the fleet table, built by FleetCollector and read by the fleet screens
+
+    :var nodes: tuple[NodeStatus] every node heard from, by name
+    :var up: tuple[NodeStatus] the nodes heard from in the last ``stale_after`` seconds
+    :var worst: NodeStatus the up node with the largest absolute system time offset, None without one
+    :var no_fix: tuple[NodeStatus] the up nodes without a GPS fix
+    :var unsynced: tuple[NodeStatus] the up nodes with chrony down or not synchronised
+    """
+
+    __slots__ = ('nodes', 'up', 'worst', 'no_fix', 'unsynced')
+
+    def __init__(self, nodes=(), now=None, stale_after=5.0):
+        now = time.monotonic() if now is None else now
+
+        self.nodes = tuple(sorted(nodes, key=lambda status: status.node))
+        self.up = tuple(status for status in self.nodes if now - status.received <= stale_after)
+        self.no_fix = tuple(status for status in self.up if status.gps_mode < 2)
+        self.unsynced = tuple(status for status in self.up
+                              if not status.flags & CHRONY_UP or status.leap_status == 'Not synchronised')
+
+        offsets = [status for status in self.up if not math.isnan(status.system_time)]
+        self.worst = max(offsets, key=lambda status: abs(status.system_time)) if offsets else None
+
+
+class FleetTable(object):
+    """Latest status of every node, one dictionary assignment per datagram"""
+
+    def __init__(self, stale_after=5.0):
+        """
+        :param stale_after: float seconds without a datagram before a node is shown as down
+        """
+        self.stale_after = stale_after
+        self.nodes = {}
+
+        self.received = counter('fleet.received')
+        self.invalid = counter('fleet.invalid')
+        self.reordered = counter('fleet.reordered')
+
+    def receive(self, data, received=None):
+        """Decode a datagram and keep it when it is newer than the status known for its node
+
+        :param data: bytes
+        :param received: float monotonic time the datagram was received
+        :return: NodeStatus or None when the datagram was dropped
+        """
+        try:
+            status = decode_status(data, received)
+        except (ValueError, struct.error):
+            self.invalid.inc()
+            return None
+
+        self.received.inc()
+        known = self.nodes.get(status.node)
+        # a restarted publisher counts again from 1, its send time still moves forward
+        if known is not None and status.sequence <= known.sequence and status.sent <= known.sent:
+            self.reordered.inc()
+            return None
+
+        self.nodes[status.node] = status
+        return status
+
+    def view(self, now=None):
+        """
+        :param now: float monotonic time
+        :return: FleetView
+        """
+        return FleetView(list(self.nodes.values()), now, self.stale_after)
+
+
+class FleetProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, table):
+        self.table = table
+
+    def datagram_received(self, data, addr):
+        self.table.receive(data)
+
+
+class FleetCollector(Collector):
+    """Receive the status datagrams of the fleet and publish a FleetView every ``interval`` seconds"""
+
+    name = 'fleet'
+    interval = 1.0
+
+    def __init__(self, table, address='0.0.0.0', port=9124):
+        self.table = table
+        self.address = address
+        self.port = port
+
+        self.sock = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def collect(self):
+        return self.table.view()
+
+    def _bind(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.address, self.port))
+        return sock
+
+    def _receive(self):
+        receive = self.table.receive
+        while not self._stop.is_set():
+            try:
+                data = self.sock.recv(512)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            receive(data)
+
+    def start(self, store):
+        self.sock = self._bind()
+        self.sock.settimeout(0.5)
+        self._thread = threading.Thread(target=self._receive, name='fleet-receiver', daemon=True)
+        self._thread.start()
+        logger.info('Listening for the fleet status on {}:{}'.format(self.address, self.port))
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.sock.close()
+
+    async def acollect(self):
+        return self.collect()
+
+    async def arun(self, store):
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: FleetProtocol(self.table), sock=self._bind())
+        try:
+            await super().arun(store)
+        finally:
+            transport.close()
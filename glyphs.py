@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import math
+import time
+from collections import deque
+
+# Define digit pairs from 00 to 61 (yes 61 because of leap seconds)
+# every number is 5 cells wide, each decimal digit is the CGRAM slot of the custom character for that cell
+digits = [
+    [24341, 25351], [24120, 25120], [24161, 25370], [24161, 25171], [24301, 25141],
+    [24360, 25171], [24360, 25371], [24141, 25101], [24361, 25371], [24341, 25141],
+    [2241, 2251], [2020, 2020], [2061, 2270], [2061, 2071], [2201, 2041],
+    [2260, 2071], [2260, 2271], [2041, 2001], [2261, 2271], [2241, 2041],
+    [6341, 27251], [6120, 27020], [6161, 27270], [6161, 27071], [6301, 27041],
+    [6360, 27071], [6360, 27271], [6141, 27001], [6361, 27271], [6341, 27041],
+    [6341, 7351], [6120, 7120], [6161, 7370], [6161, 7171], [6301, 7141],
+    [6360, 7171], [6360, 7371], [6141, 7101], [6361, 7371], [6341, 7141],
+    [20341, 4351], [20120, 4120], [20161, 4370], [20161, 4171], [20301, 4141],
+    [20360, 4171], [20360, 4371], [20141, 4101], [20361, 4371], [20341, 4141],
+    [26241, 7351], [26020, 7120], [26061, 7370], [26061, 7171], [26201, 7141],
+    [26260, 7171], [26260, 7371], [26041, 7101], [26261, 7371], [26241, 7141],
+    [26241, 27351], [26020, 27120]]
+
+
+class BigDigitFont(object):
+    """Two rows big digits built from at most 8 CGRAM custom characters
+
+    The 62 glyphs (00 to 61) are converted once to the strings written on the LCD, rendering a number is a
+    tuple lookup.
+
+    :var self.bitmaps: the 8 custom characters, 5x8 pixels each
+    :var self.glyphs: (top row, bottom row) strings indexed by the number
+    """
+
+    glyph_width = 5
+
+    def __init__(self, name, bitmaps, table=None):
+        self.name = name
+        self.bitmaps = tuple(tuple(bitmap) for bitmap in bitmaps)
+        self.glyphs = tuple((self._cells(top), self._cells(bottom)) for top, bottom in (table or digits))
+
+    def __repr__(self):
+        return "<BigDigitFont {}>".format(self.name)
+
+    def _cells(self, value):
+        return ''.join(chr(int(cell)) for cell in str(value).zfill(self.glyph_width))
+
+
+fonts = {
+    # 2 pixels wide strokes
+    'block': BigDigitFont('block', [
+        (0, 0, 0, 0, 0, 0, 0, 0),
+        (16, 24, 24, 24, 24, 24, 24, 16),
+        (1, 3, 3, 3, 3, 3, 3, 1),
+        (17, 27, 27, 27, 27, 27, 27, 17),
+        (31, 31, 0, 0, 0, 0, 0, 0),
+        (0, 0, 0, 0, 0, 0, 31, 31),
+        (31, 31, 0, 0, 0, 0, 0, 31),
+        (31, 0, 0, 0, 0, 0, 31, 31),
+    ]),
+    # 1 pixel wide strokes, same cells layout. The two top and bottom bars cells of the block font are the same
+    # cell with thin strokes, 7 is drawn with 6
+    'thin': BigDigitFont('thin', [
+        (0, 0, 0, 0, 0, 0, 0, 0),
+        (16, 16, 16, 16, 16, 16, 16, 16),
+        (1, 1, 1, 1, 1, 1, 1, 1),
+        (17, 17, 17, 17, 17, 17, 17, 17),
+        (31, 0, 0, 0, 0, 0, 0, 0),
+        (0, 0, 0, 0, 0, 0, 0, 31),
+        (31, 0, 0, 0, 0, 0, 0, 31),
+    ], [[int(str(cells).replace('7', '6')) for cells in pair] for pair in digits]),
+}
+
+
+class BigClock(object):
+    """Big HH MM SS clock rendered from a BigDigitFont
+
+    One ``time.localtime()`` snapshot per render, the rows are concatenations of precomputed glyphs.
+
+    Layouts:
+        16x2: the clock on both rows
+        20x4: the clock centered on the first two rows and the date on the last one
+    """
+
+    layouts = {
+        '16x2': (16, 2),
+        '20x4': (20, 4),
+    }
+
+    date_format = '%a %d-%m-%Y'
+
+    def __init__(self, font='block', layout='16x2'):
+        self.font = fonts[font] if isinstance(font, str) else font
+        self.layout = layout
+        self.cols, self.rows = self.layouts[layout]
+
+        # blank cells around the clock, the first cell of the 16 columns layout is always blank
+        spare = self.cols - 3 * self.font.glyph_width
+        self._margin = (spare + 1) // 2
+        self._pad = chr(0) * (spare - self._margin)
+
+    def render(self, now=None):
+        """Render the clock
+
+        :param now: time.struct_time, defaults to time.localtime()
+        :return: list[str] one string per LCD row
+        """
+        now = now or time.localtime()
+        glyphs = self.font.glyphs
+        hrs, minutes, sec = glyphs[now.tm_hour], glyphs[now.tm_min], glyphs[now.tm_sec]
+
+        margin = chr(0) * self._margin
+        rows = [
+            margin + hrs[0] + minutes[0] + sec[0] + self._pad,
+            margin + hrs[1] + minutes[1] + sec[1] + self._pad,
+        ]
+        if self.rows > 2:
+            rows += [' ' * self.cols] * (self.rows - 3)
+            rows.append(time.strftime(self.date_format, now).center(self.cols))
+        return rows
+
+
+# vertical bars, 1 to 8 pixels high, used by the sparklines
+bar_bitmaps = tuple(tuple([0] * (8 - height) + [31] * height) for height in range(1, 9))
+
+# cell drawn for every bar level, level 0 is a blank cell
+bar_cells = ' ' + ''.join(chr(slot) for slot in range(len(bar_bitmaps)))
+
+
+class Sparkline(object):
+    """One LCD row history drawn with the 8 bar custom characters, newest sample on the right
+
+    Samples are grouped in columns of ``period`` seconds (0 starts a new column on every sample), a column keeps
+    the highest value of its period. A new column shifts the row by one cell, the cells are rebuilt only when the
+    scale changes.
+
+    :var self.bitmaps: the custom characters of the cells returned by render()
+    """
+
+    bitmaps = bar_bitmaps
+    levels = len(bar_bitmaps)
+
+    def __init__(self, width=16, period=0, low=0.0, high=None, minimum_range=0.0):
+        """
+        :param width: int columns
+        :param period: float seconds per column
+        :param low: float value drawn as an empty cell
+        :param high: float value drawn as a full cell, None to scale on the highest value shown
+        :param minimum_range: float smallest high - low when scaling automatically
+        """
+        self.width = width
+        self.period = period
+        self.low = low
+        self.high = high
+        self.minimum_range = minimum_range
+
+        self.values = deque(maxlen=width)
+        self._cells = deque(' ' * width, maxlen=width)
+        self._column_start = None
+        self._scale = None
+        self._text = ' ' * width
+
+    @property
+    def last(self):
+        return self.values[-1] if self.values else None
+
+    def update(self, value, now=None):
+        """Add a sample, in the current column if its period is not over, otherwise in a new one
+
+        :param value: float
+        :param now: float time.monotonic() of the sample
+        """
+        now = time.monotonic() if now is None else now
+        if self.values and self.period and now - self._column_start < self.period:
+            if value <= self.values[-1]:
+                return
+            self.values[-1] = value
+            self._cells.pop()
+        else:
+            self.values.append(value)
+            self._column_start = now
+
+        scale = self._range()
+        if scale != self._scale:
+            self._scale = scale
+            self._cells.extend(' ' * (self.width - len(self.values)))
+            self._cells.extend(self._cell(v) for v in self.values)
+        else:
+            self._cells.append(self._cell(value))
+        self._text = ''.join(self._cells)
+
+    def _range(self):
+        if self.high is not None:
+            return self.low, self.high
+        return self.low, max(max(self.values), self.low + self.minimum_range)
+
+    def _cell(self, value):
+        low, high = self._scale
+        if high <= low:
+            return bar_cells[0]
+        level = math.ceil((value - low) / (high - low) * self.levels)
+        return bar_cells[min(max(level, 0), self.levels)]
+
+    def render(self):
+        """
+        :return: str ``width`` cells, chr(n) is drawn with bitmaps[n]
+        """
+        return self._text
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import bisect
+import functools
+import logging
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+# bucket upper bounds in nanoseconds, 10us to 10s, the last bucket holds everything slower
+BUCKET_BOUNDS_NS = (
+    10000, 25000, 50000,
+    100000, 250000, 500000,
+    1000000, 2500000, 5000000,
+    10000000, 25000000, 50000000,
+    100000000, 250000000, 500000000,
+    1000000000, 2500000000, 5000000000,
+    10000000000,
+)
+
+
+class LatencyHistogram(object):
+    """Fixed buckets latency histogram, observing a value only updates preallocated counters"""
+
+    __slots__ = ('name', 'counts', 'count', 'total_ns', 'max_ns')
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = [0] * (len(BUCKET_BOUNDS_NS) + 1)
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def observe_ns(self, value):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS_NS, value)] += 1
+        self.count += 1
+        self.total_ns += value
+        if value > self.max_ns:
+            self.max_ns = value
+
+    def percentile_ns(self, pct):
+        """Upper bound of the bucket holding the percentile, never more than the slowest observation
+
+        :param pct: float 0..100
+        :return: int nanoseconds
+        """
+        if not self.count:
+            return 0
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for ndx, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(BUCKET_BOUNDS_NS[ndx], self.max_ns) if ndx < len(BUCKET_BOUNDS_NS) else self.max_ns
+        return self.max_ns
+
+    def reset(self):
+        for ndx in range(len(self.counts)):
+            self.counts[ndx] = 0
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'mean_ms': self.total_ns / self.count / 1e6 if self.count else 0.0,
+            'p50_ms': self.percentile_ns(50) / 1e6,
+            'p90_ms': self.percentile_ns(90) / 1e6,
+            'p99_ms': self.percentile_ns(99) / 1e6,
+            'max_ms': self.max_ns / 1e6,
+            'buckets': list(self.counts),
+        }
+
+
+class Counter(object):
+
+    __slots__ = ('name', 'value')
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+histograms = {}
+counters = {}
+
+
+def histogram(name):
+    """Get or create a histogram, call it once at setup time and keep the reference
+
+    :param name: str
+    :return: LatencyHistogram
+    """
+    if name not in histograms:
+        histograms[name] = LatencyHistogram(name)
+    return histograms[name]
+
+
+def counter(name):
+    """Get or create a counter
+
+    :param name: str
+    :return: Counter
+    """
+    if name not in counters:
+        counters[name] = Counter(name)
+    return counters[name]
+
+
+def timed(name):
+    """Record the run time of every call of the decorated function in the ``name`` histogram
+
+    :param name: str
+    :return:
+    """
+    hist = histogram(name)
+    perf_counter_ns = time.perf_counter_ns
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                hist.observe_ns(perf_counter_ns() - start)
+        return wrapper
+    return decorator
+
+
+def stats():
+    """All the histograms and counters
+
+    :return: dict
+    """
+    return {
+        'histograms': {name: hist.stats() for name, hist in sorted(histograms.items())},
+        'counters': {name: count.value for name, count in sorted(counters.items())},
+    }
+
+
+def format_stats():
+    """Human readable dump of the histograms and counters
+
+    :return: str
+    """
+    lines = ['{:<36} {:>8} {:>9} {:>9} {:>9} {:>9}'.format('name', 'count', 'mean ms', 'p50 ms', 'p99 ms',
+                                                          'max ms')]
+    for name, hist in sorted(histograms.items()):
+        values = hist.stats()
+        lines.append('{:<36} {:>8d} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+            name, values['count'], values['mean_ms'], values['p50_ms'], values['p99_ms'], values['max_ms']))
+    for name, count in sorted(counters.items()):
+        lines.append('{:<36} {:>8d}'.format(name, count.value))
+    return '\n'.join(lines)
+
+
+def reset():
+    for hist in histograms.values():
+        hist.reset()
+    for count in counters.values():
+        count.value = 0
+
+
+def install_signal_handler(signum=signal.SIGUSR1):
+    """Log the statistics every time the process receives ``signum`` (kill -USR1 <pid>)
+
+    :param signum: int
+    """
+    def dump(received, frame):
+        logger.warning('Latency statistics\n%s', format_stats())
+
+    signal.signal(signum, dump)
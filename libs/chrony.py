@@ -13,17 +13,560 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import math
+import os
 import re
+import socket
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_right
 
+from stability import ClockStability
 from tools import SubprocessShell, normalize_timespec
 
 
+class ChronyCmdmonError(Exception):
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class ChronyCmdmon(object):
+    """Minimal client for the chronyd command and monitoring protocol (cmdmon)
+
+    Speaks the same binary protocol as ``chronyc``, first on the local unix socket and then over UDP port 323,
+    so the tracking report can be read without forking ``bash`` and ``chronyc``.
+    """
+
+    PROTO_VERSION = 6
+    PKT_TYPE_CMD_REQUEST = 1
+    PKT_TYPE_CMD_REPLY = 2
+
+    REQ_TRACKING = 33
+    RPY_TRACKING = 5
+
+    STT_SUCCESS = 0
+
+    IPADDR_UNSPEC = 0
+    IPADDR_INET4 = 1
+    IPADDR_INET6 = 2
+
+    # version, pkt_type, res1, res2, command, attempt, sequence, pad1, pad2
+    request_header = struct.Struct('!BBBBHHIII')
+    # version, pkt_type, res1, res2, command, reply, status, pad1, pad2, pad3, sequence, pad4, pad5
+    reply_header = struct.Struct('!BBBBHHHHHHIII')
+    # ref_id, ip_addr(16), family, pad, stratum, leap_status, ref_time(sec_high, sec_low, nsec), 9 x Float
+    tracking_body = struct.Struct('!I16sHHHHIII9I')
+
+    leap_status = ['Normal', 'Insert second', 'Delete second', 'Not synchronised']
+
+    def __init__(self, socket_path='/var/run/chrony/chronyd.sock', host='127.0.0.1', port=323, timeout=1.0):
+        self.socket_path = socket_path
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sequence = 0
+
+    @staticmethod
+    def float_to_host(value):
+        """Decode the chrony network float, 7 bit signed exponent and 25 bit signed coefficient
+
+        :param value: int
+        :return: float
+        """
+        exp = value >> 25
+        if exp >= 1 << 6:
+            exp -= 1 << 7
+        exp -= 25
+        coef = value % (1 << 25)
+        if coef >= 1 << 24:
+            coef -= 1 << 25
+        return coef * 2.0 ** exp
+
+    def _request(self, command, padding):
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        # requests are padded up to the reply length, chronyd drops shorter ones
+        return self.request_header.pack(self.PROTO_VERSION, self.PKT_TYPE_CMD_REQUEST, 0, 0, command, 0,
+                                        self.sequence, 0, 0) + b'\x00' * padding
+
+    def _exchange_unix(self, request):
+        client_path = os.path.join(os.path.dirname(self.socket_path), 'chronyc.{}.sock'.format(os.getpid()))
+        if not os.access(os.path.dirname(client_path), os.W_OK):
+            client_path = os.path.join(tempfile.gettempdir(), 'chronyc.{}.sock'.format(os.getpid()))
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            if os.path.exists(client_path):
+                os.unlink(client_path)
+            sock.bind(client_path)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            sock.send(request)
+            return sock.recv(1024)
+        finally:
+            sock.close()
+            if os.path.exists(client_path):
+                os.unlink(client_path)
+
+    def _exchange_udp(self, request):
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect((self.host, self.port))
+            sock.send(request)
+            return sock.recv(1024)
+        finally:
+            sock.close()
+
+    def exchange(self, command, padding):
+        """Send one request, on the unix socket if it is reachable, otherwise over UDP
+
+        :param command: int request command
+        :param padding: int bytes of padding appended to the request
+        :return: bytes the reply payload after the header
+        """
+        request = self._request(command, padding)
+
+        errors = []
+        transports = []
+        if self.socket_path and os.path.exists(self.socket_path):
+            transports.append(self._exchange_unix)
+        if self.host:
+            transports.append(self._exchange_udp)
+
+        for transport in transports:
+            try:
+                reply = transport(request)
+            except OSError as e:
+                errors.append(str(e))
+                continue
+            return self._check_reply(reply, command)
+
+        raise ChronyCmdmonError('chronyd is not reachable: {}'.format('; '.join(errors) or 'no transport'))
+
+    def _check_reply(self, reply, command):
+        if len(reply) < self.reply_header.size:
+            raise ChronyCmdmonError('Short reply from chronyd')
+
+        version, pkt_type, _, _, rpy_command, _, status, _, _, _, sequence, _, _ = \
+            self.reply_header.unpack_from(reply)
+
+        if version != self.PROTO_VERSION or pkt_type != self.PKT_TYPE_CMD_REPLY:
+            raise ChronyCmdmonError('Unexpected reply from chronyd')
+        if rpy_command != command or sequence != self.sequence:
+            raise ChronyCmdmonError('Reply does not match the request')
+        if status != self.STT_SUCCESS:
+            raise ChronyCmdmonError('chronyd returned status {}'.format(status))
+
+        return reply[self.reply_header.size:]
+
+    def tracking(self):
+        """Fetch the tracking report, formatted the same way as ``chronyc -c tracking``
+
+        :return: list[str] in the ChronyParser.tracking_fields order
+        """
+        padding = self.reply_header.size + self.tracking_body.size - self.request_header.size
+        data = self.exchange(self.REQ_TRACKING, padding)
+
+        if len(data) < self.tracking_body.size:
+            raise ChronyCmdmonError('Short tracking reply from chronyd')
+
+        (ref_id, ip_addr, family, _, stratum, leap_status, sec_high, sec_low, nsec,
+         *floats) = self.tracking_body.unpack_from(data)
+
+        (current_correction, last_offset, rms_offset, freq_ppm, resid_freq_ppm, skew_ppm,
+         root_delay, root_dispersion, last_update_interval) = [self.float_to_host(f) for f in floats]
+
+        if family == self.IPADDR_INET4:
+            reference_name = socket.inet_ntop(socket.AF_INET, ip_addr[:4])
+        elif family == self.IPADDR_INET6:
+            reference_name = socket.inet_ntop(socket.AF_INET6, ip_addr)
+        else:
+            # reference clocks, the refid is the name (GPS, PPS, ...)
+            reference_name = ref_id.to_bytes(4, 'big').rstrip(b'\x00').decode('ascii', 'replace')
+
+        # 0x7fffffff in the high word means the field is only 32 bits wide
+        ref_time = (0 if sec_high == 0x7fffffff else sec_high << 32) + sec_low + nsec / 1e9
+
+        return [
+            '{:08X}'.format(ref_id),
+            reference_name,
+            '{:d}'.format(stratum),
+            '{:.9f}'.format(ref_time),
+            '{:.9f}'.format(current_correction),
+            '{:.9f}'.format(last_offset),
+            '{:.9f}'.format(rms_offset),
+            '{:.3f}'.format(freq_ppm),
+            '{:.3f}'.format(resid_freq_ppm),
+            '{:.3f}'.format(skew_ppm),
+            '{:.9f}'.format(root_delay),
+            '{:.9f}'.format(root_dispersion),
+            '{:.1f}'.format(last_update_interval),
+            self.leap_status[leap_status] if leap_status < len(self.leap_status) else '?',
+        ]
+
+
+class TrackingCache(object):
+    """Keeps one tracking report per chronyd clock update
+
+    chronyd refreshes the tracking data once every ``update_interval`` seconds, the report is kept until
+    ``ref_time_(utc) + update_interval`` and every read before that is served from memory.
+    """
+
+    # bounds for the time a report is kept, seconds
+    min_ttl = 1.0
+    max_ttl = 64.0
+
+    # extra time given to chronyd after the expected update
+    update_margin = 0.2
+
+    def __init__(self, fetch, history=None):
+        """
+        :param fetch: callable returning ``(stderr, indata)`` like ChronyParser.read_tracking
+        :param history: TrackingHistory every new report is recorded in
+        """
+        self.fetch = fetch
+        self.history = history
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+        self._value = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+
+    def ttl(self, indata, now=None):
+        """Seconds until chronyd is expected to publish a new tracking report
+
+        :param indata: dict tracking fields
+        :param now: float wall clock time, defaults to time.time()
+        :return: float
+        """
+        now = time.time() if now is None else now
+        try:
+            ref_time = float(indata['ref_time_(utc)'])
+            update_interval = float(indata['update_interval'])
+        except (KeyError, ValueError):
+            return self.min_ttl
+
+        ttl = ref_time + update_interval + self.update_margin - now
+        if ttl <= 0:
+            # the update is overdue (source lost or not synchronised yet), poll at a fraction of the interval
+            ttl = update_interval / 8
+        return min(max(ttl, self.min_ttl), self.max_ttl)
+
+    def get(self):
+        """Return the cached tracking report, refreshing it if chronyd had an update since
+
+        :return: (str, dict)
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._value is not None and now < self._expires:
+                self.hits += 1
+                return self._value
+
+            self.misses += 1
+            stderr, indata = self.fetch()
+            if stderr or not indata:
+                # keep errors out of the cache, the next read tries again
+                self.errors += 1
+                return stderr, indata
+
+            self._value = (stderr, indata)
+            self._expires = now + self.ttl(indata)
+            self._record(indata)
+            return self._value
+
+    def expired(self):
+        """True when chronyd should have a newer report than the cached one
+
+        :return: bool
+        """
+        return self._value is None or time.monotonic() >= self._expires
+
+    def put(self, stderr, indata):
+        """Store a tracking report fetched outside of the cache
+
+        :param stderr: str
+        :param indata: dict
+        """
+        with self._lock:
+            if stderr or not indata:
+                self.errors += 1
+                return
+            self._value = (stderr, indata)
+            self._expires = time.monotonic() + self.ttl(indata)
+            self._record(indata)
+
+    def _record(self, indata):
+        if self.history is not None:
+            self.history.add(indata)
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+            self._expires = 0.0
+
+    def stats(self):
+        """Cache counters
+
+        :return: dict
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'hit_ratio': self.hits / total if total else 0.0,
+        }
+
+
+class SampleRing(object):
+    """Fixed size ring of timestamped rows, one ``array('d')`` per column
+
+    The memory is allocated once, appending overwrites the oldest row. Timestamps must be increasing so a window
+    is found with a binary search and copied out with at most two slices.
+    """
+
+    def __init__(self, columns, capacity):
+        self.columns = tuple(columns)
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.values = {column: array('d', bytes(8 * capacity)) for column in self.columns}
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, ndx):
+        # timestamps in chronological order, used by bisect
+        return self.times[(self.head - self.count + ndx) % self.capacity]
+
+    @property
+    def first_time(self):
+        return self[0] if self.count else None
+
+    @property
+    def last_time(self):
+        return self[self.count - 1] if self.count else None
+
+    def append(self, timestamp, row):
+        """
+        :param timestamp: float
+        :param row: sequence of floats in the columns order
+        """
+        ndx = self.head
+        self.times[ndx] = timestamp
+        for column, value in zip(self.columns, row):
+            self.values[column][ndx] = value
+        self.head = (ndx + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def _slice(self, data, start):
+        first = (self.head - self.count + start) % self.capacity
+        size = self.count - start
+        if first + size <= self.capacity:
+            return data[first:first + size]
+        return data[first:] + data[:first + size - self.capacity]
+
+    def window(self, column, since):
+        """Rows with a timestamp > since, oldest first
+
+        :param column: str
+        :param since: float
+        :return: (array, array) timestamps and values
+        """
+        start = bisect_right(self, since, 0, self.count)
+        return self._slice(self.times, start), self._slice(self.values[column], start)
+
+
+class TrackingHistory(object):
+    """Constant memory history of the chrony tracking reports
+
+    Every chronyd clock update is kept in a raw ring, at least an hour at 1Hz, and folded into per minute buckets
+    (mean, min, max) covering a day. Windows that fit in the raw ring are answered from the raw samples, longer
+    ones from the buckets.
+    """
+
+    fields = ('last_offset', 'rms_offset', 'frequency', 'skew', 'root_delay')
+
+    # one hour at 1Hz plus a bucket, so the 1h window never falls back on the buckets
+    raw_capacity = 3660
+    bucket_seconds = 60
+    bucket_capacity = 1440
+
+    windows = {'1m': 60, '1h': 3600, '24h': 86400}
+
+    def __init__(self, fields=None):
+        self.fields = tuple(fields or self.fields)
+        self.raw = SampleRing(self.fields, self.raw_capacity)
+        bucket_columns = ['count']
+        for field in self.fields:
+            bucket_columns += [field, field + '.min', field + '.max']
+        self.buckets = SampleRing(bucket_columns, self.bucket_capacity)
+
+        # callables receiving (timestamp, indata) for every recorded report
+        self.listeners = []
+
+        self._bucket = None
+        self._lock = threading.Lock()
+
+    def add(self, indata, timestamp=None):
+        """Record one tracking report, reports older than or equal to the last recorded one are ignored
+
+        :param indata: dict tracking fields, as returned by ChronyParser.parse_tracking
+        :param timestamp: float defaults to the report ``ref_time_(utc)``
+        :return: bool True if the sample was recorded
+        """
+        try:
+            if timestamp is None:
+                timestamp = float(indata['ref_time_(utc)'])
+            row = [float(indata[field]) for field in self.fields]
+        except (KeyError, ValueError):
+            return False
+
+        with self._lock:
+            last = self.raw.last_time
+            if last is not None and timestamp <= last:
+                return False
+            self.raw.append(timestamp, row)
+            self._fold(timestamp, row)
+
+        for listener in self.listeners:
+            listener(timestamp, indata)
+        return True
+
+    def _fold(self, timestamp, row):
+        start = timestamp - timestamp % self.bucket_seconds
+        bucket = self._bucket
+        if bucket is not None and bucket[0] != start:
+            self._flush()
+            bucket = None
+        if bucket is None:
+            self._bucket = [start, 1, list(row), list(row), list(row)]
+            return
+        bucket[1] += 1
+        sums, lows, highs = bucket[2], bucket[3], bucket[4]
+        for ndx, value in enumerate(row):
+            sums[ndx] += value
+            if value < lows[ndx]:
+                lows[ndx] = value
+            if value > highs[ndx]:
+                highs[ndx] = value
+
+    def _flush(self):
+        start, count, sums, lows, highs = self._bucket
+        row = [count]
+        for ndx in range(len(self.fields)):
+            row += [sums[ndx] / count, lows[ndx], highs[ndx]]
+        self.buckets.append(start, row)
+        self._bucket = None
+
+    def _seconds(self, window):
+        return self.windows[window] if isinstance(window, str) else float(window)
+
+    def window(self, field, window, now=None):
+        """Samples of one field over the last ``window`` seconds
+
+        :param field: str
+        :param window: float seconds or one of the ``windows`` names
+        :param now: float end of the window, defaults to the last sample time
+        :return: (array, array) timestamps and values, oldest first
+        """
+        with self._lock:
+            now = self.raw.last_time if now is None else now
+            if now is None:
+                return array('d'), array('d')
+            since = now - self._seconds(window)
+            first = self.raw.first_time
+            if self.raw.count < self.raw.capacity or since >= first:
+                return self.raw.window(field, since)
+
+            times, values = self.buckets.window(field, since)
+            if self._bucket is not None:
+                # the bucket being filled, its mean so far
+                times.append(self._bucket[0])
+                values.append(self._bucket[2][self.fields.index(field)] / self._bucket[1])
+            return times, values
+
+    def downsample(self, field, window, points, now=None):
+        """Mean of the samples in ``points`` equal slices of the window, NaN for empty slices
+
+        :param field: str
+        :param window: float seconds or one of the ``windows`` names
+        :param points: int
+        :param now: float end of the window, defaults to the last sample time
+        :return: list[float]
+        """
+        seconds = self._seconds(window)
+        now = self.raw.last_time if now is None else now
+        if now is None:
+            return [float('nan')] * points
+
+        times, values = self.window(field, seconds, now)
+        since = now - seconds
+        step = seconds / points
+        sums = [0.0] * points
+        counts = [0] * points
+        for timestamp, value in zip(times, values):
+            ndx = min(int((timestamp - since) / step), points - 1)
+            sums[ndx] += value
+            counts[ndx] += 1
+        return [total / count if count else float('nan') for total, count in zip(sums, counts)]
+
+    def stats(self, field, window, percentiles=(50, 95), now=None):
+        """Count, min, max, mean and percentiles of one field over a window
+
+        Windows answered from the minute buckets compute the percentiles over the bucket means.
+
+        :param field: str
+        :param window: float seconds or one of the ``windows`` names
+        :param percentiles: iterable of int
+        :param now: float end of the window, defaults to the last sample time
+        :return: dict
+        """
+        _, values = self.window(field, window, now)
+        result = {'count': len(values)}
+        if not values:
+            result.update({'min': float('nan'), 'max': float('nan'), 'mean': float('nan')})
+            result.update({'p{}'.format(p): float('nan') for p in percentiles})
+            return result
+
+        ordered = sorted(values)
+        result['min'] = ordered[0]
+        result['max'] = ordered[-1]
+        result['mean'] = math.fsum(ordered) / len(ordered)
+        for p in percentiles:
+            rank = min(len(ordered) - 1, max(0, int(math.ceil(p / 100 * len(ordered))) - 1))
+            result['p{}'.format(p)] = ordered[rank]
+        return result
+
+    def memory(self):
+        """Bytes held by the sample arrays, constant once the history is created
+
+        :return: int
+        """
+        return sum(ring.times.buffer_info()[1] * ring.times.itemsize +
+                   sum(data.buffer_info()[1] * data.itemsize for data in ring.values.values())
+                   for ring in (self.raw, self.buckets))
+
+
 class ChronyParser(object):
 
     shell = SubprocessShell()
 
     chronyc_path = '/usr/bin/chronyc'
 
+    # read the tracking report through cmdmon, chronyc is only used as a fallback
+    use_cmdmon = True
+
     maximum_divergence_tolerated = float(1)
 
     tracking_fields = [
@@ -43,12 +586,31 @@ class ChronyParser(object):
         'leap_status',
     ]
 
-    def __init__(self):
-        pass
+    def __init__(self, cmdmon=None):
+        self.cmdmon = cmdmon or ChronyCmdmon()
+        self.history = TrackingHistory()
+        self.stability = ClockStability()
+        self.history.listeners.append(self.stability.add)
+        self.tracking_cache = TrackingCache(self.read_tracking, self.history)
 
     def chrony_tracking(self):
+        """Tracking report shared by all the chrony screens, refreshed once per chronyd update
 
-        indata = {}
+        :return: (str, dict)
+        """
+        return self.tracking_cache.get()
+
+    def read_tracking(self):
+        """Read the tracking report from chronyd, bypassing the cache
+
+        :return: (str, dict)
+        """
+
+        if self.use_cmdmon:
+            try:
+                return self.parse_tracking('', self.cmdmon.tracking())
+            except ChronyCmdmonError:
+                pass
 
         stderr, stdout = self.shell.shell_run(self.chronyc_path + ' -c tracking')
 
@@ -56,7 +618,17 @@ class ChronyParser(object):
 
         data_raw = data.strip()
 
-        clock_data = data_raw.split(',')
+        return self.parse_tracking(stderr.decode('UTF-8'), data_raw.split(','))
+
+    def parse_tracking(self, stderr, clock_data):
+        """Map the tracking values on tracking_fields and compute the clock status
+
+        :param stderr: str
+        :param clock_data: list[str] values in the ``chronyc -c tracking`` order
+        :return: (str, dict)
+        """
+
+        indata = {}
 
         if len(self.tracking_fields) == len(clock_data):
             for ndx, clock in enumerate(clock_data):
@@ -74,6 +646,6 @@ class ChronyParser(object):
                     co=int(clock_offset[0]), co_unit=clock_offset[1], mt=int(self.maximum_divergence_tolerated))
             indata['clock_status'] = clock_status
         else:
-            stderr = b'Unexpected error on Chrony tracking'
+            stderr = 'Unexpected error on Chrony tracking'
 
-        return stderr.decode('UTF-8'), indata
+        return stderr, indata
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import os
+import socket
+import time
+
+from libs.ntpq import NtpControl, NtpControlError
+
+
+class NtpDaemonDetector(object):
+    """Find out which NTP daemon is running without scanning the whole process table
+
+    Cheap checks first: the chronyd pidfile and command socket, the ntpd pidfile, then a mode 6 READSTAT probe on
+    the ntpd control port. ``psutil.process_iter`` is only used when none of those gives an answer. The result
+    is cached, ``detect(force=True)`` checks again.
+    """
+
+    CHRONYD = 'chronyd'
+    NTPD = 'ntpd'
+
+    pidfiles = {
+        CHRONYD: ['/run/chrony/chronyd.pid', '/var/run/chrony/chronyd.pid', '/var/run/chronyd.pid'],
+        NTPD: ['/run/ntpd.pid', '/var/run/ntpd.pid', '/run/ntp.pid', '/var/run/ntp.pid'],
+    }
+
+    chronyd_sockets = ['/run/chrony/chronyd.sock', '/var/run/chrony/chronyd.sock']
+
+    ntpd_control = ('127.0.0.1', 123)
+    probe_timeout = 0.2
+
+    # fall back to scanning the process table when the cheap checks find nothing
+    scan_processes = True
+
+    def __init__(self):
+        self.running = None
+        self.detected_at = None
+        self.method = None
+
+    @staticmethod
+    def _pid_alive(pidfile, name):
+        try:
+            with open(pidfile) as f:
+                pid = int(f.read().split()[0])
+        except (OSError, ValueError, IndexError):
+            return False
+
+        try:
+            with open('/proc/{}/comm'.format(pid)) as f:
+                return f.read().strip() == name
+        except OSError:
+            # no procfs, at least check that the pid exists
+            try:
+                os.kill(pid, 0)
+            except PermissionError:
+                return True
+            except OSError:
+                return False
+            return True
+
+    def _chronyd_socket(self):
+        for path in self.chronyd_sockets:
+            if not os.path.exists(path):
+                continue
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            try:
+                # a stale socket file left by a dead chronyd refuses the connection
+                sock.connect(path)
+                return True
+            except PermissionError:
+                # only root and the chrony user may talk to it, but somebody is listening
+                return True
+            except OSError:
+                continue
+            finally:
+                sock.close()
+        return False
+
+    def _ntpd_control(self):
+        control = NtpControl(*self.ntpd_control, timeout=self.probe_timeout)
+        try:
+            # any READSTAT reply, even an error, means ntpd is listening
+            control.exchange([(NtpControl.OP_READSTAT, 0)])
+        except NtpControlError:
+            return False
+        return True
+
+    def _scan_processes(self):
+        import psutil
+
+        for proc in psutil.process_iter(['name']):
+            if proc.info.get('name') in (self.CHRONYD, self.NTPD):
+                return proc.info.get('name')
+        return None
+
+    def _detect(self):
+        if any(self._pid_alive(pidfile, self.CHRONYD) for pidfile in self.pidfiles[self.CHRONYD]):
+            return self.CHRONYD, 'pidfile'
+        if self._chronyd_socket():
+            return self.CHRONYD, 'socket'
+        if any(self._pid_alive(pidfile, self.NTPD) for pidfile in self.pidfiles[self.NTPD]):
+            return self.NTPD, 'pidfile'
+        if self._ntpd_control():
+            return self.NTPD, 'control port'
+        if self.scan_processes:
+            return self._scan_processes(), 'process table'
+        return None, None
+
+    def detect(self, force=False):
+        """Name of the running NTP daemon
+
+        :param force: bool ignore the cached result
+        :return: str 'chronyd', 'ntpd' or None
+        """
+        if force or self.detected_at is None:
+            self.running, self.method = self._detect()
+            self.detected_at = time.monotonic()
+        return self.running
+
+
+# shared by everything that needs to know the daemon, the detection runs once per process
+ntp_daemon_detector = NtpDaemonDetector()
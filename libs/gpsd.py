@@ -18,6 +18,11 @@ import logging
 import socket
 import json
 import datetime
+import threading
+import time
+import types
+
+from instrumentation import timed
 
 logger = logging.getLogger(__name__)
 
@@ -28,9 +33,10 @@ class NoFixError(Exception):
         self.reason = reason
 
 
-class Gpsd(object):
+class GpsResponse(object):
     """ Class representing geo information returned by GPSD
         Use the attributes to get the raw gpsd data, use the methods to get parsed and corrected information.
+        Instances are immutable snapshots, they are safe to share between threads.
         :type mode: int
         :type sats: int
         :type sats_valid: int
@@ -66,10 +72,10 @@ class Gpsd(object):
                 be calculated from the satellite view.
         """
 
-    state = {}
+    __slots__ = ('mode', 'sats', 'sats_valid', 'hdop', 'vdop', 'pdop', 'lon', 'lat', 'alt',
+                 'track', 'hspeed', 'climb', 'time', 'error')
+
     gpsTimeFormat = '%Y-%m-%dT%H:%M:%S.%fZ'
-    gpsd_socket = None
-    gpsd_stream = None
 
     modes = {
         0: 'No mode',
@@ -78,66 +84,71 @@ class Gpsd(object):
         3: '3D fix'
     }
 
-    def __init__(self, host="127.0.0.1", port=2947):
-        self.mode = 0
-        self.sats = 0
-        self.sats_valid = 0
-        self.hdop = 0
-        self.pdop = 0
-        self.lon = 0.0
-        self.lat = 0.0
-        self.alt = 0.0
-        self.track = 0
-        self.hspeed = 0
-        self.climb = 0
-        self.time = ''
-        self.error = {}
-
-        self.connect(host, port)
+    def __init__(self, mode=0, sats=0, sats_valid=0, hdop=0.0, vdop=0.0, pdop=0.0, lon=0.0, lat=0.0, alt=0.0,
+                 track=0, hspeed=0, climb=0, time='', error=None):
+        values = dict(mode=mode, sats=sats, sats_valid=sats_valid, hdop=hdop, vdop=vdop, pdop=pdop,
+                      lon=lon, lat=lat, alt=alt, track=track, hspeed=hspeed, climb=climb, time=time,
+                      error=types.MappingProxyType(dict(error or {})))
+        for key, value in values.items():
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("GpsResponse snapshots are read-only")
 
     def __repr__(self):
 
         if self.mode < 2:
-            return "<Gpsd {}>".format(self.modes[self.mode])
+            return "<GpsResponse {}>".format(self.modes[self.mode])
         if self.mode == 2:
-            return "<Gpsd 2D Fix {} {}>".format(self.lat, self.lon)
+            return "<GpsResponse 2D Fix {} {}>".format(self.lat, self.lon)
         if self.mode == 3:
-            return "<Gpsd 3D Fix {} {} ({} m)>".format(self.lat, self.lon, self.alt)
+            return "<GpsResponse 3D Fix {} {} ({} m)>".format(self.lat, self.lon, self.alt)
 
     @classmethod
     def from_json(cls, packet):
-        """ Create GpsResponse instance based on the json data from GPSD
+        """ Create GpsResponse instance based on the json data of a gpsd POLL response
         :type packet: dict
         :param packet: JSON decoded GPSD response
         :return: GpsResponse
         """
-        result = cls()
         if not packet['active']:
             raise UserWarning('GPS not active')
-        last_tpv = packet['tpv'][-1]
-        last_sky = packet['sky'][-1]
+        last_tpv = packet['tpv'][-1] if packet['tpv'] else {}
+        last_sky = packet['sky'][-1] if packet['sky'] else {}
+
+        return cls.from_reports(last_tpv, last_sky)
+
+    @classmethod
+    def from_reports(cls, last_tpv, last_sky):
+        """ Create GpsResponse instance from the latest TPV and SKY reports
+        :type last_tpv: dict
+        :type last_sky: dict
+        :return: GpsResponse
+        """
+        result = {}
 
         if 'satellites' in last_sky:
-            result.sats = len(last_sky['satellites'])
-            result.sats_valid = len(
+            result['sats'] = len(last_sky['satellites'])
+            result['sats_valid'] = len(
                 [sat for sat in last_sky['satellites'] if sat['used']])
         else:
-            result.sats = 0
-            result.sats_valid = 0
-
-        result.hdop = last_sky['hdop'] if 'hdop' in last_sky else 0.0
-        result.vdop = last_sky['vdop'] if 'vdop' in last_sky else 0.0
-        result.pdop = last_sky['pdop'] if 'pdop' in last_sky else 0.0
-
-        result.mode = last_tpv['mode']
-
-        if last_tpv['mode'] >= 2:
-            result.lon = last_tpv['lon'] if 'lon' in last_tpv else 0.0
-            result.lat = last_tpv['lat'] if 'lat' in last_tpv else 0.0
-            result.track = last_tpv['track'] if 'track' in last_tpv else 0
-            result.hspeed = last_tpv['speed'] if 'speed' in last_tpv else 0
-            result.time = last_tpv['time'] if 'time' in last_tpv else ''
-            result.error = {
+            # gpsd >= 3.23 may only report the satellite counters
+            result['sats'] = last_sky.get('nSat', 0)
+            result['sats_valid'] = last_sky.get('uSat', 0)
+
+        result['hdop'] = last_sky['hdop'] if 'hdop' in last_sky else 0.0
+        result['vdop'] = last_sky['vdop'] if 'vdop' in last_sky else 0.0
+        result['pdop'] = last_sky['pdop'] if 'pdop' in last_sky else 0.0
+
+        result['mode'] = last_tpv.get('mode', 0)
+
+        if result['mode'] >= 2:
+            result['lon'] = last_tpv['lon'] if 'lon' in last_tpv else 0.0
+            result['lat'] = last_tpv['lat'] if 'lat' in last_tpv else 0.0
+            result['track'] = last_tpv['track'] if 'track' in last_tpv else 0
+            result['hspeed'] = last_tpv['speed'] if 'speed' in last_tpv else 0
+            result['time'] = last_tpv['time'] if 'time' in last_tpv else ''
+            result['error'] = {
                 # Estimated climb error in meters per second. Certainty unknown.
                 'c': 0,
                 # Ground speed uncertainty (meters/second) [eps]
@@ -151,82 +162,15 @@ class Gpsd(object):
                 'y': last_tpv['epy'] if 'epy' in last_tpv else 0
             }
 
-        if last_tpv['mode'] >= 3:
-            result.alt = last_tpv['alt'] if 'alt' in last_tpv else 0.0
-            result.climb = last_tpv['climb'] if 'climb' in last_tpv else 0
+        if result['mode'] >= 3:
+            result['alt'] = last_tpv['alt'] if 'alt' in last_tpv else 0.0
+            result['climb'] = last_tpv['climb'] if 'climb' in last_tpv else 0
             # Estimated climb error in meters per second. Certainty unknown.
-            result.error['c'] = last_tpv['epc'] if 'epc' in last_tpv else 0
+            result['error']['c'] = last_tpv['epc'] if 'epc' in last_tpv else 0
             # Estimated vertical error in meters. Certainty unknown.
-            result.error['v'] = last_tpv['epv'] if 'epv' in last_tpv else 0
-
-        return result
-
-    def connect(self, host, port):
-        """ Connect to a GPSD instance
-        :param host: hostname for the GPSD server
-        :param port: port for the GPSD server
-        """
-        if self.gpsd_socket or self.gpsd_stream:
-            self.disconnect()
-            print('get disconnect')
-            logger.debug('Previous connection detected. Reconnecting')
-
-        logger.debug("Connecting to gpsd socket at {}:{}".format(host, port))
-        self.gpsd_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.gpsd_socket.connect((host, port))
-        self.gpsd_stream = self.gpsd_socket.makefile(mode="rw")
-        logger.debug("Waiting for welcome message")
-        welcome_raw = self.gpsd_stream.readline()
-        welcome = json.loads(welcome_raw)
-        if welcome['class'] != "VERSION":
-            raise Exception(
-                "Unexpected data received as welcome. Is the server a gpsd 3 server?")
-        logger.debug("Enabling gps")
-        self.gpsd_stream.write('?WATCH={"enable":true}\n')
-        self.gpsd_stream.flush()
-
-        for i in range(0, 2):
-            raw = self.gpsd_stream.readline()
-            parsed = json.loads(raw)
-            self._parse_state_packet(parsed)
-
-    def disconnect(self):
-        """ Disconnect to a GPSD
-        """
-        logger.debug('Disconnecting')
-        if self.gpsd_socket:
-            self.gpsd_socket.shutdown(socket.SHUT_RDWR)
-            self.gpsd_socket.close()
-            self.gpsd_socket = None
-        if self.gpsd_stream:
-            self.gpsd_stream.close()
-            self.gpsd_stream = None
-        self.state = {}
-
-    def _parse_state_packet(self, json_data):
-        if json_data['class'] == 'DEVICES':
-            if not json_data['devices']:
-                logger.warning('No gps devices found')
-            self.state['devices'] = json_data
-        elif json_data['class'] == 'WATCH':
-            self.state['watch'] = json_data
-        else:
-            raise Exception(
-                "Unexpected message received from gps: {}".format(json_data['class']))
+            result['error']['v'] = last_tpv['epv'] if 'epv' in last_tpv else 0
 
-    def get_current(self):
-        """ Poll gpsd for a new position
-        :return: GpsResponse
-        """
-        logger.debug("Polling gps")
-        self.gpsd_stream.write("?POLL;\n")
-        self.gpsd_stream.flush()
-        raw = self.gpsd_stream.readline()
-        response = json.loads(raw)
-        if response['class'] != 'POLL':
-            raise Exception(
-                "Unexpected message received from gps: {}".format(response['class']))
-        return Gpsd.from_json(response)
+        return cls(**result)
 
     def position(self):
         """ Get the latitude and longtitude as tuple.
@@ -324,6 +268,181 @@ class Gpsd(object):
         if self.mode == 3:
             return "3D Fix"
 
+
+class Gpsd(object):
+    """ Long lived GPSD client
+        A single ``?WATCH`` stream is opened and consumed line by line from a background reader thread, which keeps
+        the latest TPV and SKY reports in memory. :meth:`get_current` hands out the last :class:`GpsResponse`
+        snapshot, it never touches the network. The reader reconnects on its own if gpsd goes away.
+    """
+
+    state = {}
+    gpsd_socket = None
+    gpsd_stream = None
+
+    # seconds to wait before reconnecting, doubled on each failure up to reconnect_delay_max
+    reconnect_delay = 1.0
+    reconnect_delay_max = 30.0
+
+    # a snapshot older than this (seconds) is reported as "No mode", gpsd sends a TPV at least every cycle
+    max_age = 10.0
+
+    def __init__(self, host="127.0.0.1", port=2947, autostart=True):
+        self.host = host
+        self.port = port
+
+        self.state = {}
+        self._tpv = {}
+        self._sky = {}
+        self._empty = GpsResponse()
+        self._current = self._empty
+        self._received = 0.0
+
+        self._running = False
+        self._thread = None
+        self._lock = threading.Lock()
+        self.connected = threading.Event()
+
+        # callables receiving every new GpsResponse, called from the reader
+        self.listeners = []
+
+        # counters, used to check that the stream is not reconnecting in a loop
+        self.connects = 0
+        self.packets = 0
+
+        if autostart:
+            self.start()
+
+    def __repr__(self):
+        return "<Gpsd {}:{} {}>".format(self.host, self.port, self.get_current())
+
+    def start(self):
+        """ Start the background reader thread
+        """
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._reader, name='gpsd-reader', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the reader thread and close the connection
+        """
+        self._running = False
+        self.disconnect()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def connect(self, host, port):
+        """ Connect to a GPSD instance and enable the watch stream
+        :param host: hostname for the GPSD server
+        :param port: port for the GPSD server
+        """
+        if self.gpsd_socket or self.gpsd_stream:
+            self.disconnect()
+            logger.debug('Previous connection detected. Reconnecting')
+
+        logger.debug("Connecting to gpsd socket at {}:{}".format(host, port))
+        self.gpsd_socket = socket.create_connection((host, port))
+        self.gpsd_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.gpsd_stream = self.gpsd_socket.makefile(mode="rw")
+        logger.debug("Waiting for welcome message")
+        welcome_raw = self.gpsd_stream.readline()
+        welcome = json.loads(welcome_raw)
+        if welcome['class'] != "VERSION":
+            raise Exception(
+                "Unexpected data received as welcome. Is the server a gpsd 3 server?")
+        logger.debug("Enabling gps")
+        self.gpsd_stream.write('?WATCH={"enable":true,"json":true}\n')
+        self.gpsd_stream.flush()
+        self.connects += 1
+        self.connected.set()
+
+    def disconnect(self):
+        """ Disconnect to a GPSD
+        """
+        logger.debug('Disconnecting')
+        self.connected.clear()
+        # the reader thread and stop() may both get here, detach first
+        gpsd_socket, self.gpsd_socket = self.gpsd_socket, None
+        gpsd_stream, self.gpsd_stream = self.gpsd_stream, None
+        if gpsd_socket:
+            try:
+                gpsd_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            gpsd_socket.close()
+        if gpsd_stream:
+            try:
+                gpsd_stream.close()
+            except OSError:
+                pass
+        self.state = {}
+
+    def _reader(self):
+        delay = self.reconnect_delay
+        while self._running:
+            try:
+                self.connect(self.host, self.port)
+                delay = self.reconnect_delay
+                for raw in self.gpsd_stream:
+                    if not self._running:
+                        break
+                    self.feed(json.loads(raw))
+            except Exception as e:
+                logger.debug("gpsd stream error: {}".format(e))
+
+            self.disconnect()
+            self.reset()
+            if self._running:
+                time.sleep(delay)
+                delay = min(delay * 2, self.reconnect_delay_max)
+
+    def reset(self):
+        """ Forget the last reports, used when the stream is lost, the listeners get the empty response
+        """
+        with self._lock:
+            self._tpv = {}
+            self._sky = {}
+            self._current = self._empty
+        for listener in self.listeners:
+            listener(self._empty)
+
+    def feed(self, json_data):
+        """ Update the in-memory state with a decoded gpsd report
+        :param json_data: dict
+        """
+        self.packets += 1
+        packet_class = json_data.get('class')
+        if packet_class in ('TPV', 'SKY'):
+            with self._lock:
+                if packet_class == 'TPV':
+                    self._tpv = json_data
+                    self._received = time.monotonic()
+                else:
+                    # SKY reports may be partial, keep the satellites list from the previous ones
+                    self._sky = dict(self._sky, **json_data)
+                self._current = GpsResponse.from_reports(self._tpv, self._sky)
+                current = self._current
+            for listener in self.listeners:
+                listener(current)
+        elif packet_class == 'DEVICES':
+            if not json_data['devices']:
+                logger.warning('No gps devices found')
+            self.state['devices'] = json_data
+        elif packet_class == 'WATCH':
+            self.state['watch'] = json_data
+
+    @timed('gpsd.get_current')
+    def get_current(self):
+        """ Get the latest position received from the watch stream
+        :return: GpsResponse
+        """
+        if time.monotonic() - self._received > self.max_age:
+            return self._empty
+        return self._current
+
     def device(self):
         """ Get information about current gps device
         :return: dict
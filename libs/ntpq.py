@@ -15,10 +15,320 @@
 
 from typing import Tuple
 import re
-import sys
+import select
+import socket
+import struct
+import threading
+import time
 
 from tools import SubprocessShell
 
+# seconds between the NTP era 0 (1900) and the unix epoch
+NTP_EPOCH_OFFSET = 2208988800
+
+# start of every name= of a mode 6 variable list, a value runs up to the next one
+name_pattern = re.compile(r'(?:^|[,\s])\s*([A-Za-z_][\w.]*)=')
+integer_pattern = re.compile(r'-?\d+$')
+
+
+def convert_value(value):
+    """Type a mode 6 variable value: quoted strings, integers, hex words, NTP timestamps (as unix time), floats
+
+    :param value: str
+    :return: str, int or float
+    """
+    value = value.strip()
+    if value.startswith('"'):
+        return value.strip('"')
+    if integer_pattern.match(value):
+        return int(value)
+    if value.startswith('0x'):
+        try:
+            if '.' in value:
+                seconds, fraction = value[2:].split('.', 1)
+                return int(seconds, 16) - NTP_EPOCH_OFFSET + int(fraction[:8], 16) / 2.0 ** 32
+            return int(value, 16)
+        except ValueError:
+            return value
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def parse_variables(text):
+    """Parse a mode 6 variable list, ``ntpq -c rv`` prints the same format
+
+    :param text: str
+    :return: dict name -> typed value
+    """
+    matches = list(name_pattern.finditer(text))
+    ends = [match.start() for match in matches[1:]] + [len(text)]
+    return {match.group(1): convert_value(text[match.end():end].strip().rstrip(','))
+            for match, end in zip(matches, ends)}
+
+
+class NtpControlError(Exception):
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class NtpControl(object):
+    """NTP mode 6 (control message) client, the protocol ``ntpq`` speaks with ntpd
+
+    Requests are pipelined: a batch is sent back to back and the replies, possibly fragmented, are matched back
+    by sequence number, so the system variables and every peer cost a single round trip once the association
+    list is known.
+    """
+
+    # LI 0, VN 2, mode 6
+    LI_VN_MODE = 0x16
+
+    OP_READSTAT = 1
+    OP_READVAR = 2
+
+    RESPONSE = 0x80
+    ERROR = 0x40
+    MORE = 0x20
+
+    # li_vn_mode, r/e/m/opcode, sequence, status, association id, offset, count
+    header = struct.Struct('!BBHHHHH')
+
+    # peer status word select field -> ntpq tally code
+    tally = ' x.-+#*o'
+    # peer host mode -> ntpq type
+    modes = {1: 's', 2: 's', 3: 'u', 4: 'u', 5: 'b', 6: 'B'}
+
+    def __init__(self, host='127.0.0.1', port=123, timeout=1.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sequence = 0
+
+        # association ids seen on the last exchange, their variables are requested along the system ones
+        self.associations = []
+
+    def _request(self, opcode, association=0, data=b''):
+        self.sequence = self.sequence % 0xFFFF + 1
+        padding = b'\x00' * (-len(data) % 4)
+        return self.sequence, self.header.pack(self.LI_VN_MODE, opcode, self.sequence, 0, association, 0,
+                                               len(data)) + data + padding
+
+    def exchange(self, requests):
+        """Send a batch of requests and collect every reply
+
+        :param requests: list[(int, int)] opcode and association id
+        :return: list[(int, bytes)] status word and data of every request, None for the ones answered with an error
+        """
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            sock.connect((self.host, self.port))
+            pending = {}
+            order = []
+            for opcode, association in requests:
+                sequence, packet = self._request(opcode, association)
+                pending[sequence] = {'opcode': opcode, 'fragments': {}, 'end': None, 'status': 0, 'error': False}
+                order.append(sequence)
+                sock.send(packet)
+
+            deadline = time.monotonic() + self.timeout
+            waiting = set(order)
+            while waiting:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select([sock], [], [], remaining)[0]:
+                    raise NtpControlError('ntpd did not answer {} of {} requests'.format(len(waiting), len(order)))
+                self._receive(sock.recv(2048), pending, waiting)
+        except OSError as e:
+            raise NtpControlError('ntpd is not reachable: {}'.format(e))
+        finally:
+            sock.close()
+
+        replies = []
+        for sequence in order:
+            reply = pending[sequence]
+            if reply['error']:
+                replies.append(None)
+                continue
+            data = b''.join(reply['fragments'][offset] for offset in sorted(reply['fragments']))
+            replies.append((reply['status'], data))
+        return replies
+
+    def _receive(self, packet, pending, waiting):
+        if len(packet) < self.header.size:
+            return
+        li_vn_mode, flags, sequence, status, _, offset, count = self.header.unpack_from(packet)
+        reply = pending.get(sequence)
+        if li_vn_mode & 0x07 != 6 or reply is None or not flags & self.RESPONSE or \
+                flags & 0x1F != reply['opcode'] or sequence not in waiting:
+            # late reply of an earlier batch or not a control message
+            return
+
+        if flags & self.ERROR:
+            reply['error'] = True
+            waiting.discard(sequence)
+            return
+
+        reply['status'] = status
+        reply['fragments'][offset] = packet[self.header.size:self.header.size + count]
+        if not flags & self.MORE:
+            reply['end'] = offset + count
+
+        # complete once the fragments cover the data without gaps
+        if reply['end'] is not None:
+            position = 0
+            for offset in sorted(reply['fragments']):
+                if offset != position:
+                    return
+                position += len(reply['fragments'][offset])
+            if position == reply['end']:
+                waiting.discard(sequence)
+
+    def read_status(self):
+        """Association ids and peer status words
+
+        :return: list[(int, int)]
+        """
+        reply = self.exchange([(self.OP_READSTAT, 0)])[0]
+        if reply is None:
+            raise NtpControlError('ntpd refused the status request')
+        return self._statuses(reply[1])
+
+    @staticmethod
+    def _statuses(data):
+        return [struct.unpack_from('!HH', data, ndx) for ndx in range(0, len(data) - 3, 4)]
+
+    def system_and_peers(self):
+        """System variables and the variables of every peer, in one batch
+
+        :return: (dict, list[dict]) the peers carry their association id and status word
+        """
+        associations = list(self.associations)
+        replies = self.exchange([(self.OP_READVAR, 0), (self.OP_READSTAT, 0)] +
+                                [(self.OP_READVAR, association) for association in associations])
+        if replies[0] is None or replies[1] is None:
+            raise NtpControlError('ntpd refused the system variables request')
+
+        system = parse_variables(replies[0][1].decode('ascii', 'replace'))
+        statuses = self._statuses(replies[1][1])
+        peer_data = {association: reply for association, reply in zip(associations, replies[2:])}
+
+        # associations created since the last batch
+        missing = [association for association, _ in statuses if association not in peer_data]
+        if missing:
+            for association, reply in zip(missing, self.exchange([(self.OP_READVAR, a) for a in missing])):
+                peer_data[association] = reply
+
+        self.associations = [association for association, _ in statuses]
+
+        peers = []
+        for association, status in statuses:
+            reply = peer_data.get(association)
+            if reply is None:
+                continue
+            peer = parse_variables(reply[1].decode('ascii', 'replace'))
+            peer['associd'] = association
+            peer['status'] = status
+            peers.append(peer)
+        return system, peers
+
+    @classmethod
+    def peer_row(cls, peer, now=None):
+        """Format one peer like a row of ``ntpq -pn``
+
+        :param peer: dict peer variables
+        :param now: float unix time, defaults to time.time()
+        :return: dict keyed by the ``ntpq -pn`` header
+        """
+        now = time.time() if now is None else now
+        srcadr = str(peer.get('srcadr', ''))
+        refid = str(peer.get('refid', ''))
+        if srcadr.startswith('127.127.') or refid.isalpha():
+            refid = '.{}.'.format(refid.strip('.'))
+
+        last = peer.get('rec') or peer.get('reftime') or 0
+        when = int(now - last) if isinstance(last, float) and last > 0 else '-'
+
+        poll = min(peer.get('ppoll', 6), peer.get('hpoll', 6))
+
+        return {
+            'remote': cls.tally[(peer.get('status', 0) >> 8) & 0x07] + srcadr,
+            'refid': refid,
+            'st': str(peer.get('stratum', 16)),
+            't': 'l' if srcadr.startswith('127.127.') else cls.modes.get(peer.get('hmode'), '-'),
+            'when': str(when),
+            'poll': str(1 << poll),
+            'reach': '{:o}'.format(peer.get('reach', 0)),
+            'delay': '{:.3f}'.format(peer.get('delay', 0.0)),
+            'offset': '{:.3f}'.format(peer.get('offset', 0.0)),
+            'jitter': '{:.3f}'.format(peer.get('jitter', peer.get('dispersion', 0.0))),
+        }
+
+
+class ControlCache(object):
+    """Keeps one system_and_peers() batch for a collection cycle
+
+    The peers and the system variables are read from the same batch, ntpd is only asked again once ``ttl`` seconds
+    have passed.
+    """
+
+    def __init__(self, fetch, ttl=1.0):
+        """
+        :param fetch: callable returning ``(system, peers)`` like NtpControl.system_and_peers
+        :param ttl: float seconds a batch is kept, the interval of the collection cycle
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+        self._value = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the cached batch, fetching a new one when it is older than ``ttl``
+
+        :raise: NtpControlError, errors are not cached and the next read tries again
+        :return: (dict, list[dict])
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._value is not None and now < self._expires:
+                self.hits += 1
+                return self._value
+
+            self.misses += 1
+            try:
+                self._value = self.fetch()
+            except NtpControlError:
+                self.errors += 1
+                self._value = None
+                raise
+            self._expires = now + self.ttl
+            return self._value
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+            self._expires = 0.0
+
+    def stats(self):
+        """Cache counters
+
+        :return: dict
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+            'hit_ratio': self.hits / total if total else 0.0,
+        }
+
 
 class NtpqParser(object):
 
@@ -26,8 +336,16 @@ class NtpqParser(object):
 
     shell = SubprocessShell()
 
-    def __init__(self):
-        pass
+    # read ntpd through mode 6 control messages, ntpq is only used as a fallback
+    use_control = True
+
+    def __init__(self, control=None, ttl=1.0):
+        """
+        :param control: NtpControl, ntpd on localhost when None
+        :param ttl: float seconds the peers and system variables of one batch are shared for
+        """
+        self.control = control or NtpControl()
+        self.control_cache = ControlCache(lambda: self.control.system_and_peers(), ttl)
 
     def parse_row(self, row):
         entry = row.split()
@@ -40,10 +358,17 @@ class NtpqParser(object):
         return result
 
     def ntpq_pn(self) -> Tuple[str, list]:
-        """Get the stdout of "ntpq -pn"
+        """Peers, same rows as "ntpq -pn"
 
         :return:
         """
+        if self.use_control:
+            try:
+                _, peers = self.control_cache.get()
+                return '', [self.control.peer_row(peer) for peer in peers]
+            except NtpControlError:
+                pass
+
         indata = []
 
         stderr, stdout = self.shell.shell_run("ntpq -pn")
@@ -68,6 +393,21 @@ class NtpqParser(object):
                 indata.append(self.parse_row(row))
         return stderr.decode("UTF-8"), indata
 
+    def read_variables(self) -> Tuple[str, dict]:
+        """System variables, typed
+
+        :return:
+        """
+        if self.use_control:
+            try:
+                system, _ = self.control_cache.get()
+                return '', system
+            except NtpControlError:
+                pass
+
+        stderr, stdout = self.shell.shell_run('ntpq -c rv')
+        return stderr.decode('UTF-8'), parse_variables(stdout.decode('UTF-8'))
+
     def ntpq_rv(self) -> Tuple[str, dict]:
         """Calculate and display the NTPD accuracy
         Retrieve the precision and clock_jitter from the ntp server
@@ -75,40 +415,21 @@ class NtpqParser(object):
         :return:
         """
         indata = {}
-        stderr, stdout = self.shell.shell_run('ntpq -c rv')
-
-        data = stdout.decode("UTF-8")
-
-        precision_search = re.search(r'precision=(.*?),', data, re.S)
-        precision = precision_search.group(1)
-
-        clock_jitter_search = re.search(r'.*clk_jitter=(.*?),', data, re.S)
-        clock_jitter = clock_jitter_search.group(1)
+        stderr, variables = self.read_variables()
 
-        rootdisp_search = re.search(r'.*rootdisp=(.*?),', data, re.S)
-        rootdisp = rootdisp_search.group(1)
-
-        offset_search = re.search(r'.*offset=(.*?),', data, re.S)
-        offset = offset_search.group(1)
-
-        frequency_search = re.search(r'.*frequency=(.*?),', data, re.S)
-        frequency = frequency_search.group(1)
-
-        sys_jitter_search = re.search(r'.*sys_jitter=(.*?),', data, re.S)
-        sys_jitter = sys_jitter_search.group(1)
-
-        if all([precision, clock_jitter, rootdisp, sys_jitter, frequency, sys_jitter]):
-            precision = (1 / 2.0 ** abs(float(precision))) * 1000000.0
+        fields = ('precision', 'clk_jitter', 'rootdisp', 'offset', 'frequency', 'sys_jitter')
+        if all(field in variables for field in fields):
+            precision = (1 / 2.0 ** abs(float(variables['precision']))) * 1000000.0
             indata.update({
                 'precision': "{:.5f} {}s".format(precision, chr(0xE4)),
-                'clock_jitter': "{:>4} ms".format(clock_jitter),
-                'rootdisp': rootdisp,
-                'offset': "{:>6}".format(offset),
-                'frequency': "{:>3}".format(frequency),
-                'sys_jitter': "{:>6} ms".format(sys_jitter)
+                'clock_jitter': "{:>4} ms".format(variables['clk_jitter']),
+                'rootdisp': str(variables['rootdisp']),
+                'offset': "{:>6}".format(variables['offset']),
+                'frequency': "{:>3}".format(variables['frequency']),
+                'sys_jitter': "{:>6} ms".format(variables['sys_jitter'])
             })
 
-        return stderr.decode('UTF-8'), indata
+        return stderr, indata
 
     def ntptime(self) -> Tuple[str, dict]:
         """Statistics from ntptime command
@@ -116,14 +437,14 @@ class NtpqParser(object):
         :return:
         """
         indata = {}
-        stdout, stderr = self.shell.asyncio_run("/usr/sbin/ntptime")
+        stderr, stdout = self.shell.shell_run("/usr/sbin/ntptime")
 
         data = stdout.decode("UTF-8")
 
         precision_tolerance = re.search(r'precision (.* us).*tolerance (.* ppm)', data, re.M | re.S)
         frequency_search = re.search(r'frequency (.* ppm).*interval (.* s),', data, re.S)
 
-        if all([precision_tolerance]):
+        if all([precision_tolerance, frequency_search]):
             indata.update({
                 'precision': "{:>8}".format(precision_tolerance.group(1)),
                 'tolerance': "{:>7}".format(precision_tolerance.group(2)),
@@ -132,5 +453,3 @@ class NtpqParser(object):
             })
 
         return stderr.decode('UTF-8'), indata
-
-
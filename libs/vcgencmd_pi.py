@@ -13,10 +13,151 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import array
+import collections
+import fcntl
+import glob
+import logging
+import os
 import re
+import struct
 
 from tools import SubprocessShell
 
+logger = logging.getLogger(__name__)
+
+# same fields as psutil.sensors_temperatures() entries
+Temperature = collections.namedtuple('Temperature', ['label', 'current', 'high', 'critical'])
+
+
+class ThermalZones(object):
+    """Temperatures of the kernel thermal zones, read through file descriptors kept open
+
+    ``thermal_zone*/temp`` is opened once and re-read with ``os.pread``, a read costs one system call instead of
+    the open/read/close of every hwmon and thermal file done by ``psutil.sensors_temperatures()``. The trip
+    points do not change and are read once.
+    """
+
+    root = '/sys/class/thermal'
+
+    # zone types of the SoC sensor, Raspberry Pi kernels first
+    cpu_types = ('cpu-thermal', 'cpu_thermal', 'soc_thermal', 'x86_pkg_temp')
+
+    high_trips = ('hot', 'passive')
+    critical_trips = ('critical', )
+
+    def __init__(self, root=None):
+        """
+        :param root: str thermal class directory, a fake tree can be used outside of the Pi
+        """
+        self.root = root or self.root
+        self.zones = None
+
+    @staticmethod
+    def _read(path):
+        with open(path) as f:
+            return f.read().strip()
+
+    def _trip(self, zone, types):
+        for type_path in sorted(glob.glob(os.path.join(zone, 'trip_point_*_type'))):
+            try:
+                if self._read(type_path) in types:
+                    return int(self._read(type_path[:-len('type')] + 'temp')) / 1000.0
+            except (OSError, ValueError):
+                continue
+        return None
+
+    def open(self):
+        """Open every zone, called on the first read
+
+        :return: int number of zones
+        """
+        self.close()
+        zones = []
+        for zone in sorted(glob.glob(os.path.join(self.root, 'thermal_zone*'))):
+            try:
+                label = self._read(os.path.join(zone, 'type'))
+                fd = os.open(os.path.join(zone, 'temp'), os.O_RDONLY)
+            except OSError:
+                continue
+            zones.append((label, fd, self._trip(zone, self.high_trips), self._trip(zone, self.critical_trips)))
+        self.zones = zones
+        return len(zones)
+
+    def close(self):
+        for _, fd, _, _ in self.zones or ():
+            os.close(fd)
+        self.zones = None
+
+    def read(self):
+        """
+        :return: dict zone type -> Temperature
+        """
+        if self.zones is None:
+            self.open()
+
+        temperatures = {}
+        for label, fd, high, critical in self.zones:
+            try:
+                current = int(os.pread(fd, 16, 0)) / 1000.0
+            except (OSError, ValueError):
+                # the zone went away (driver unloaded), look for the zones again on the next read
+                self.close()
+                break
+            temperatures[label] = Temperature(label, current, high, critical)
+        return temperatures
+
+    def cpu(self):
+        """The SoC temperature, the first zone when none has a known type
+
+        :return: Temperature or None
+        """
+        temperatures = self.read()
+        for cpu_type in self.cpu_types:
+            if cpu_type in temperatures:
+                return temperatures[cpu_type]
+        return next(iter(temperatures.values()), None)
+
+
+class VideoCoreMailbox(object):
+    """GPU temperature from the VideoCore firmware, the property request ``vcgencmd measure_temp`` sends"""
+
+    path = '/dev/vcio'
+
+    # _IOWR(100, 0, char *)
+    IOCTL_MBOX_PROPERTY = (3 << 30) | (struct.calcsize('P') << 16) | (100 << 8)
+
+    TAG_GET_TEMPERATURE = 0x00030006
+    RESPONSE_SUCCESS = 0x80000000
+
+    def __init__(self, path=None):
+        self.path = path or self.path
+        self.fd = None
+
+    def temperature(self):
+        """
+        :return: float degrees Celsius
+        :raises OSError: no mailbox or the firmware refused the request
+        """
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR)
+
+        # size, request code, tag, value buffer size, request size, temperature id, value, end tag
+        buffer = array.array('I', [8 * 4, 0, self.TAG_GET_TEMPERATURE, 8, 0, 0, 0, 0])
+        try:
+            fcntl.ioctl(self.fd, self.IOCTL_MBOX_PROPERTY, buffer, True)
+        except OSError:
+            self.close()
+            raise
+        if buffer[1] != self.RESPONSE_SUCCESS:
+            raise OSError('VideoCore mailbox request failed: {:#x}'.format(buffer[1]))
+        return buffer[6] / 1000.0
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
 
 class VcgencmdParser(object):
 
@@ -24,16 +165,53 @@ class VcgencmdParser(object):
 
     vcgencmd_bin = '/usr/bin/vcgencmd'
 
+    # ask the firmware through the mailbox, vcgencmd is only used as a fallback
+    use_mailbox = True
+
+    def __init__(self, mailbox=None, thermal_zones=None):
+        self.mailbox = mailbox or VideoCoreMailbox()
+        self.thermal_zones = thermal_zones or ThermalZones()
+
+    def gpu_temp(self):
+        """GPU temperature from the mailbox
+
+        :return: (str, dict) or None when the mailbox is not available
+        """
+        if not self.use_mailbox:
+            return None
+        try:
+            return '', {'measure_temp': self.mailbox.temperature()}
+        except (FileNotFoundError, PermissionError) as e:
+            # not a Raspberry Pi kernel or not in the video group, do not try again
+            self.use_mailbox = False
+            logger.info('VideoCore mailbox disabled, using {}: {}'.format(self.vcgencmd_bin, e))
+            return None
+        except OSError:
+            return None
+
     def measure_temp(self):
         """
 
         :return:
         """
-
-        indata = {}
+        gpu_temp = self.gpu_temp()
+        if gpu_temp is not None:
+            return gpu_temp
 
         stderr, stdout = self.shell.shell_run(self.vcgencmd_bin + ' measure_temp')
 
+        return self.parse_measure_temp(stderr, stdout)
+
+    def parse_measure_temp(self, stderr, stdout):
+        """Parse the ``vcgencmd measure_temp`` output
+
+        :param stderr: bytes
+        :param stdout: bytes
+        :return: (str, dict)
+        """
+
+        indata = {}
+
         data = stdout.decode('utf-8')
         measure_temp = re.search(r'-?\d+\.?\d*', data)
 
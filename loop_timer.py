@@ -15,7 +15,14 @@
 # Original created by terryltang.
 # Modified by Wavky since 2018/2/8.
 
+import collections
+import logging
 import threading
+import time
+
+from instrumentation import histogram
+
+logger = logging.getLogger(__name__)
 
 
 class LoopyTimer(object):
@@ -130,3 +137,122 @@ class LoopyTimer(object):
 
     def is_running(self):
         return self.running
+
+
+class TickStats(object):
+    """Lateness of the timed calls of a loop, how late (seconds) a call started after the time it asked for
+
+    The values are also observed in the ``<name>.lateness`` histogram.
+
+            timing = TickStats('display0')
+            timing.record(time.monotonic() - deadline)
+            timing.stats()
+    """
+
+    def __init__(self, name, history=60):
+        """
+        :param name: str loop name, the histogram is named after it
+        :param history: int latest lateness values kept
+        """
+        self.count = 0
+        self.lateness = collections.deque(maxlen=history)
+        self.max_lateness = 0.0
+        self.jitter = 0.0
+        self._lateness_sum = 0.0
+        self._prev_lateness = None
+        self._histogram = histogram('{}.lateness'.format(name))
+
+    def record(self, lateness):
+        """
+        :param lateness: float seconds
+        :return:
+        """
+        self.count += 1
+        self.lateness.append(lateness)
+        self._lateness_sum += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        if self._prev_lateness is not None:
+            # RFC 3550 interarrival jitter estimator
+            self.jitter += (abs(lateness - self._prev_lateness) - self.jitter) / 16
+        self._prev_lateness = lateness
+        self._histogram.observe_ns(max(int(lateness * 1e9), 0))
+
+    def stats(self):
+        """Lateness statistics, all values in seconds
+
+        :return: dict
+        """
+        return {
+            'last_lateness': self.lateness[-1] if self.lateness else 0.0,
+            'mean_lateness': self._lateness_sum / self.count if self.count else 0.0,
+            'max_lateness': self.max_lateness,
+            'jitter': self.jitter,
+        }
+
+
+class WakeupTimer(object):
+    """Runs a handler when it asks to, or earlier when woken up, instead of on a fixed period
+
+    After every call ``next_wakeup()`` gives the monotonic time of the next call, :meth:`wake` runs the handler
+    right away from any thread. Between two calls the thread sleeps, an idle display costs no wake-up.
+
+    The lateness of the timed calls is kept in a :class:`TickStats`, the calls started by :meth:`wake` have no
+    deadline and are only counted. A call is never repeated for a missed wake-up time, ``next_wakeup()`` is asked
+    again after a late call and the screens it drives work out what is due from the current time.
+
+            timer = WakeupTimer(screens.loop_screens, screens.next_wakeup)
+            screens.wakeup_listeners.append(timer.wake)
+            timer.start()
+
+            timer.cancel()
+    """
+
+    def __init__(self, timer_handler, next_wakeup, name='wakeup-timer', history=60):
+        self.timer_handler = timer_handler
+        self.next_wakeup = next_wakeup
+        self.name = name
+
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        # statistics, lateness is how late (seconds) a timed call started after its wake-up time
+        self.ticks = 0
+        self.woken = 0
+        self.timing = TickStats(name, history)
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            try:
+                self.timer_handler()
+                deadline = self.next_wakeup()
+            except Exception:
+                logger.exception('Timer handler failed')
+                deadline = time.monotonic() + 1.0
+            self.ticks += 1
+
+            if self._wakeup.wait(max(deadline - time.monotonic(), 0)):
+                self.woken += 1
+            else:
+                self.timing.record(time.monotonic() - deadline)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        self._thread.start()
+
+    def cancel(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def stats(self):
+        """Call timing statistics, the lateness values in seconds
+
+        :return: dict
+        """
+        return dict(self.timing.stats(), ticks=self.ticks, woken=self.woken)
@@ -21,9 +21,10 @@ import sys
 import time
 import signal
 
-from loop_timer import LoopyTimer
+from loop_timer import WakeupTimer
 from LCDScreen import LCDScreen
-from Screens import Screens
+from Screens import Screens, FleetScreens
+import instrumentation
 
 LOGGING_LEVELS = {'critical': logging.CRITICAL,
                   'error': logging.ERROR,
@@ -31,22 +32,154 @@ LOGGING_LEVELS = {'critical': logging.CRITICAL,
                   'info': logging.INFO,
                   'debug': logging.DEBUG}
 
+
+def display_config(value):
+    """Parse ``ADDRESS[:BUS[:COLSxROWS[:INTERVAL]]]``, for example ``0x27:1:16x2:1.0``
+
+    :param value: str
+    :return: dict LCDScreen arguments and the refresh interval
+    """
+    parts = value.split(':')
+    try:
+        cols, rows = (int(n) for n in (parts[2] if len(parts) > 2 else '16x2').lower().split('x'))
+        return {
+            'i2c_addr': int(parts[0], 0),
+            'i2c_bus': int(parts[1]) if len(parts) > 1 else 1,
+            'lcd_width': cols,
+            'lcd_rows': rows,
+            'refresh_interval': float(parts[3]) if len(parts) > 3 else 1.0,
+        }
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected ADDRESS[:BUS[:COLSxROWS[:INTERVAL]]], got {}'.format(value))
+
+
+def udp_address(value, default_host=None):
+    """Parse ``HOST:PORT`` or ``PORT`` when a default host is given
+
+    :param value: str
+    :param default_host: str
+    :return: (str, int)
+    """
+    host, _, port = value.rpartition(':')
+    try:
+        return host or default_host, int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected HOST:PORT, got {}'.format(value))
+
+
+def build_displays(configs, screens_class=Screens, **kwargs):
+    """One Screens per display, all sharing the collectors of the first one
+
+    :param configs: list[dict] from display_config
+    :param screens_class: Screens or FleetScreens
+    :param kwargs: extra arguments of the screens class
+    :return: list[Screens]
+    """
+    displays = []
+    for config in configs:
+        config = dict(config)
+        refresh_interval = config.pop('refresh_interval')
+        displays.append(screens_class(LCDScreen("Atomic Clock NTP", **config),
+                                      shared=displays[0] if displays else None,
+                                      refresh_interval=refresh_interval, **kwargs))
+    return displays
+
+
+def start_fleet_publisher(screens, args):
+    if not args.fleet_publish:
+        return None
+
+    from fleet import FleetPublisher
+
+    publisher = FleetPublisher(screens.store, args.fleet_publish, node=args.fleet_node)
+    publisher.start()
+    return publisher
+
+
+def start_exporter(screens, args):
+    if args.metrics_port is None:
+        return None
+
+    from exporter import MetricsExporter
+
+    exporter = MetricsExporter(screens.store, args.metrics_address, args.metrics_port)
+    exporter.start()
+    return exporter
+
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Raspberry PI LCD status for NTP Server Help')
+    parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread',
+                        help='runtime used to collect the data and refresh the display')
+    parser.add_argument('--display', type=display_config, action='append',
+                        metavar='ADDRESS[:BUS[:COLSxROWS[:INTERVAL]]]',
+                        help='I2C LCD to drive, repeat it for several displays (default 0x27:1:16x2:1.0)')
+    parser.add_argument('--fleet-publish', type=udp_address, action='append', metavar='HOST:PORT',
+                        help='send the status of this node to a fleet aggregator, repeat it for several aggregators')
+    parser.add_argument('--fleet-node', default=None,
+                        help='name of this node in the fleet status, the host name by default')
+    parser.add_argument('--fleet-listen', type=lambda value: udp_address(value, '0.0.0.0'), default=None,
+                        metavar='[ADDRESS:]PORT',
+                        help='run as fleet aggregator, the displays show the status received from the nodes')
+    parser.add_argument('--alert-stratum', type=int, default=15, metavar='STRATUM',
+                        help='highest stratum shown without an alert, 15 alerts only when chronyd is unsynchronised')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve the collected data in the Prometheus format on this port')
+    parser.add_argument('--metrics-address', default='0.0.0.0',
+                        help='address the metrics endpoint listens on')
+    parser.add_argument('--log-level', choices=sorted(LOGGING_LEVELS), default='warning',
+                        help='messages logged on stderr, the latency statistics are logged as warnings')
 
-    parser.parse_args()
+    args = parser.parse_args()
 
-    screens = Screens()
+    logging.basicConfig(level=LOGGING_LEVELS[args.log_level],
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
 
-    _timer = LoopyTimer(1.0, screens.loop_screens, args=[], kwargs={})
+    # kill -USR1 <pid> logs the latency histograms
+    instrumentation.install_signal_handler()
 
-    try:
-        _timer.start()
-    except (KeyboardInterrupt, SystemExit, EOFError):
-        print("CTRL+C break command")
-        screens.lcd_screen.lcd.clear()
-        _timer.cancel()
-        sys.exit(0)
-    finally:
-        pass
+    if args.fleet_listen:
+        displays = build_displays(args.display or [display_config('0x27')], FleetScreens,
+                                  address=args.fleet_listen[0], port=args.fleet_listen[1])
+    else:
+        displays = build_displays(args.display or [display_config('0x27')], maximum_stratum=args.alert_stratum)
+    screens = displays[0]
+
+    if args.engine == 'asyncio':
+        from async_engine import AsyncEngine
+
+        start_exporter(screens, args)
+        start_fleet_publisher(screens, args)
+        try:
+            AsyncEngine(displays).run()
+        except (KeyboardInterrupt, SystemExit, EOFError):
+            print("CTRL+C break command")
+            for display in displays:
+                display.lcd_screen.clear()
+            sys.exit(0)
+    else:
+        screens.collectors.start()
+        start_exporter(screens, args)
+        start_fleet_publisher(screens, args)
+
+        # one timer thread per display, a slow bus only delays its own display. A display runs when its screen
+        # has to change or a source it shows is published and sleeps otherwise
+        _timers = []
+        for ndx, display in enumerate(displays):
+            _timer = WakeupTimer(display.loop_screens, display.next_wakeup, name='display{}'.format(ndx))
+            display.wakeup_listeners.append(_timer.wake)
+            _timers.append(_timer)
+
+        try:
+            for _timer in _timers:
+                _timer.start()
+        except (KeyboardInterrupt, SystemExit, EOFError):
+            print("CTRL+C break command")
+            for _timer, display in zip(_timers, displays):
+                _timer.cancel()
+                display.lcd_screen.clear()
+            screens.collectors.stop()
+            sys.exit(0)
+        finally:
+            pass
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import heapq
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def weighted_sequence(screens):
+    """Spread every screen over one rotation cycle as many times as its weight, smooth weighted round robin.
+
+    Weights 3, 1, 1 give ``a b a c a``, the appearances of a screen are spread over the cycle instead of shown back
+    to back. Ties go to the lowest order, the sequence is the same on every run.
+
+    :param screens: list of (name, options) in order, ``options['weight']`` defaults to 1
+    :return: list[str]
+    """
+    weights = [(name, options.get('weight', 1)) for name, options in screens if options.get('weight', 1) > 0]
+    total = sum(weight for _, weight in weights)
+    current = [0] * len(weights)
+
+    sequence = []
+    for _ in range(total):
+        for ndx, (_, weight) in enumerate(weights):
+            current[ndx] += weight
+        best = max(range(len(weights)), key=lambda ndx: (current[ndx], -ndx))
+        current[best] -= total
+        sequence.append(weights[best][0])
+    return sequence
+
+
+class RotationScheduler(object):
+    """Screen rotation of one display.
+
+    The screens come up in order, as many times per cycle as their ``weight``, a weight of 0 keeps a screen out of
+    the rotation and it is only shown as an alert. Skipped screens are kept in a dictionary of remaining
+    appearances, permanently skipped and ``flash`` screens are dropped from the sequence, :meth:`next` costs a
+    dictionary lookup per screen.
+
+    A raised alert pre-empts the rotation, the highest ``priority`` first and the oldest alert on a tie. The
+    rotation does not move while an alert is shown and resumes on the screen it was showing.
+
+        scheduler = RotationScheduler(Screens.methods_ordered)
+        scheduler.next()                    # 'big_time_view'
+        scheduler.raise_alert('alert_view')
+        scheduler.alert()                   # 'alert_view' until clear_alert('alert_view')
+    """
+
+    def __init__(self, screens=()):
+        """
+        :param screens: list of (name, options) registered screens, ``Class.method`` names are accepted
+        """
+        self.options = {}
+        self.sequence = []
+        self.position = -1
+        self.current = None
+
+        # screen name: appearances left to skip, -1 for ever
+        self.skips = {}
+
+        # (-priority, serial, name), alerts cleared since they were pushed stay until they reach the top
+        self._alerts = []
+        self._raised = {}
+        self._serial = 0
+        self._lock = threading.Lock()
+
+        self.set_screens(screens)
+
+    def set_screens(self, screens):
+        """Replace the screens in rotation, the rotation continues after the current screen when it is kept
+
+        :param screens: list of (name, options)
+        :return:
+        """
+        self.options = {name.rpartition('.')[2]: options for name, options in screens}
+        self._rebuild()
+
+    def _rebuild(self):
+        sequence = weighted_sequence([(name, options) for name, options in self.options.items()
+                                      if self.skips.get(name) != -1])
+        if self.current in sequence:
+            position = sequence.index(self.current)
+        else:
+            # the current screen was dropped, continue with the screen that followed it
+            position = max(min(self.position, len(sequence)) - 1, -1)
+        self.sequence, self.position = sequence, position
+
+    def skip(self, name, cycles=-1):
+        """Leave a screen out of the next ``cycles`` rotations, for ever when negative
+
+        :param name: str screen method name
+        :param cycles: int
+        :return:
+        """
+        if cycles < 0:
+            self.skips[name] = -1
+            self._rebuild()
+        elif cycles > 0 and self.skips.get(name) != -1:
+            self.skips[name] = cycles
+
+    def unskip(self, name):
+        if self.skips.pop(name, None) == -1:
+            self._rebuild()
+
+    def next(self):
+        """Move the rotation to the next screen that is not skipped
+
+        :return: str screen method name or None when every screen is skipped
+        """
+        sequence, skips = self.sequence, self.skips
+        size = len(sequence)
+
+        position = self.position
+        for _ in range(size):
+            position = (position + 1) % size
+            name = sequence[position]
+            remaining = skips.get(name)
+            if remaining is None:
+                break
+            if remaining > 1:
+                skips[name] = remaining - 1
+            else:
+                del skips[name]
+        else:
+            return None
+
+        self.position = position
+        self.current = name
+        if self.options[name].get('flash', False):
+            # shown once
+            self.skip(name)
+        return name
+
+    def raise_alert(self, name, priority=None):
+        """Show a screen before the rotation until it is cleared, raising an alert again keeps its place
+
+        :param name: str screen method name
+        :param priority: int the priority registered with the screen when None
+        :return:
+        """
+        if priority is None:
+            priority = self.options.get(name, {}).get('priority', 0)
+
+        with self._lock:
+            if name in self._raised:
+                return
+            self._serial += 1
+            self._raised[name] = self._serial
+            heapq.heappush(self._alerts, (-priority, self._serial, name))
+
+    def clear_alert(self, name):
+        with self._lock:
+            self._raised.pop(name, None)
+
+    def alert(self):
+        """
+        :return: str the screen of the most important raised alert, None without one
+        """
+        with self._lock:
+            alerts, raised = self._alerts, self._raised
+            while alerts and raised.get(alerts[0][2]) != alerts[0][1]:
+                heapq.heappop(alerts)
+            return alerts[0][2] if alerts else None
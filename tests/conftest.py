@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+"""The tests run the parsers against the fakes of benchmarks.fakes, no hardware nor daemon is needed.
+
+    python3 -m pytest tests
+"""
+
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import fakes
+
+try:
+    import RPLCD.i2c
+except ImportError:
+    # no RPLCD outside of the Pi, the fake LCD does not need it
+    sys.modules['RPLCD'] = types.ModuleType('RPLCD')
+    sys.modules['RPLCD.i2c'] = types.ModuleType('RPLCD.i2c')
+    sys.modules['RPLCD.i2c'].CharLCD = fakes.CharLCD
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import pytest
+
+from alerts import AlertEngine, Rule, default_rules
+from benchmarks import fakes
+
+
+def rules(*names, **kwargs):
+    return {rule.name: rule for rule in default_rules(**kwargs) if not names or rule.name in names}
+
+
+def tracking(**fields):
+    return '', dict({'system_time': '0.000001', 'stratum': '1', 'leap_status': 'Normal'}, **fields)
+
+
+def thermal(current, high=80.0, critical=90.0):
+    return {'cpu': fakes.FakeTemperature('cpu-thermal', current, high, critical)}
+
+
+def states(rule, values):
+    return [(rule.check(value), rule.active) for value in values]
+
+
+def test_rule_high_values_are_bad():
+    rule = Rule('load', 'psutil', lambda value: value, raise_at=10, clear_at=5, text='{}')
+
+    # fires on the threshold, stays active until the value is back to clear_at
+    assert states(rule, [4, 9, 10, 11, 7, 6, 5, 9, 12]) == [
+        (False, False), (False, False), (True, True), (False, True), (False, True), (False, True),
+        (True, False), (False, False), (True, True)]
+    assert rule.describe() == '12'
+
+
+def test_rule_low_values_are_bad():
+    rule = Rule('sats', 'gpsd', lambda value: value, raise_at=3, clear_at=6, text='{}')
+
+    assert states(rule, [8, 4, 3, 2, 5, 6, 4]) == [
+        (False, False), (False, False), (True, True), (False, True), (False, True), (True, False), (False, False)]
+
+
+def test_rule_ignores_samples_without_value():
+    rule = Rule('stratum', 'chrony', lambda value: int(value[1]['stratum']), raise_at=16, clear_at=15, text='{}')
+
+    assert rule.check(('', {'stratum': '16'}))
+    # no value, a broken sample or one that says nothing keep the state
+    for value in (('', {}), None, ('', {'stratum': 'x'})):
+        assert not rule.check(value)
+        assert rule.active
+    assert rule.value == 16
+
+
+def test_gps_fix_armed_by_a_first_fix():
+    rule = rules('gps_fix')['gps_fix']
+
+    # no gpsd or a receiver that never had a fix says nothing
+    assert states(rule, [None, fakes.FakeGpsFix(0, 0, 0), fakes.FakeGpsFix(1, 4, 0)]) == [(False, False)] * 3
+
+    assert states(rule, [fakes.FakeGpsFix(3, 11, 9), fakes.FakeGpsFix(1, 11, 0), fakes.FakeGpsFix(2, 5, 3),
+                         fakes.FakeGpsFix(3, 11, 9), fakes.FakeGpsFix(0, 0, 0), None]) == [
+        (False, False), (True, True), (False, True), (True, False), (True, True), (False, True)]
+    assert rule.describe() == 'GPS mode 0'
+
+
+def test_temperature_margins():
+    crit, high = rules('temp_crit', 'temp_high').values()
+
+    assert states(high, [thermal(79.9), thermal(80.0), thermal(76.0), thermal(75.0)]) == [
+        (False, False), (True, True), (False, True), (True, False)]
+    assert states(crit, [thermal(89.0), thermal(91.5), thermal(86.0), thermal(84.0)]) == [
+        (False, False), (True, True), (False, True), (True, False)]
+    assert high.describe() == 'CPU -5.0' + chr(223) + 'C high'
+
+    # a sensor without limits or no sensor at all
+    assert not high.check(thermal(120.0, high=None, critical=None))
+    assert not crit.check({'cpu': None})
+    assert not crit.active
+
+
+@pytest.mark.parametrize('maximum_stratum, stratum, active', [
+    (15, '15', False), (15, '16', True), (3, '3', False), (3, '4', True),
+])
+def test_maximum_stratum(maximum_stratum, stratum, active):
+    rule = rules('stratum', maximum_stratum=maximum_stratum)['stratum']
+
+    rule.check(tracking(stratum=stratum))
+    assert rule.active is active
+
+
+def test_engine_update():
+    engine = AlertEngine(default_rules(maximum_offset=0.5))
+    transitions = []
+    engine.listeners.append(lambda rule, active: transitions.append((rule.name, active)))
+
+    engine.update('chrony', tracking(system_time='-0.6', stratum='16'))
+    assert transitions == [('offset', True), ('stratum', True)]
+    engine.update('thermal', thermal(95.0))
+    assert [rule.name for rule in engine.active()] == ['temp_crit', 'offset', 'temp_high', 'stratum']
+
+    # unchanged states and sources without rules call no listener
+    del transitions[:]
+    engine.update('chrony', tracking(system_time='0.3', stratum='16'))
+    engine.update('psutil', {'loadavg': (9.0, 9.0, 9.0)})
+    assert transitions == []
+
+    engine.update('chrony', tracking(system_time='0.2', stratum='1'))
+    assert transitions == [('offset', False), ('stratum', False)]
+    assert [rule.name for rule in engine.active()] == ['temp_crit', 'temp_high']
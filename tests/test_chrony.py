@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import pytest
+
+from benchmarks import fakes
+from libs.chrony import ChronyCmdmon, ChronyCmdmonError, ChronyParser
+
+chronyc_tracking = fakes.recorded_commands['/usr/bin/chronyc -c tracking'].decode('utf-8').strip().split(',')
+
+
+@pytest.fixture
+def chronyd():
+    server = fakes.FakeChronyd().start()
+    yield server
+    server.stop()
+
+
+def parser(cmdmon):
+    chrony = ChronyParser(cmdmon)
+    chrony.shell = fakes.FakeShell()
+    return chrony
+
+
+def test_cmdmon_decodes_like_chronyc(chronyd):
+    cmdmon = ChronyCmdmon(socket_path=None, port=chronyd.port)
+
+    assert cmdmon.tracking() == chronyc_tracking
+    assert chronyd.requests == 1
+
+
+def test_read_tracking_over_cmdmon(chronyd):
+    chrony = parser(ChronyCmdmon(socket_path=None, port=chronyd.port))
+    fakes.counters.reset()
+
+    stderr, tracking = chrony.read_tracking()
+
+    assert stderr == ''
+    assert tracking['reference_name'] == 'GPS'
+    assert tracking['stratum'] == '1'
+    assert tracking['leap_status'] == 'Normal'
+    assert tracking['clock_status'].endswith('OK')
+    assert fakes.counters.subprocesses == 0
+
+
+def test_shell_fallback_without_socket():
+    # no unix socket and no UDP, chronyc is run instead
+    chrony = parser(ChronyCmdmon(socket_path='/nonexistent/chronyd.sock', host=None))
+    fakes.counters.reset()
+
+    stderr, tracking = chrony.read_tracking()
+
+    assert fakes.counters.subprocesses == 1
+    assert stderr == ''
+    assert [tracking[field] for field in ChronyParser.tracking_fields] == chronyc_tracking
+
+
+def test_shell_fallback_when_chronyd_is_down(chronyd):
+    port = chronyd.port
+    chronyd.stop()
+    chrony = parser(ChronyCmdmon(socket_path=None, port=port, timeout=0.1))
+    fakes.counters.reset()
+
+    stderr, tracking = chrony.read_tracking()
+
+    assert fakes.counters.subprocesses == 1
+    assert tracking['reference_name'] == 'GPS'
+
+
+def test_short_reply():
+    server = fakes.FakeChronyd(reply=fakes.recorded_tracking_reply[:20]).start()
+    try:
+        with pytest.raises(ChronyCmdmonError):
+            ChronyCmdmon(socket_path=None, port=server.port).tracking()
+    finally:
+        server.stop()
+
+
+def test_cmdmon_disabled(chronyd):
+    chrony = parser(ChronyCmdmon(socket_path=None, port=chronyd.port))
+    chrony.use_cmdmon = False
+
+    stderr, tracking = chrony.read_tracking()
+
+    assert chronyd.requests == 0
+    assert tracking['update_interval'] == '16.0'
+
+
+@pytest.mark.parametrize('chrony', [None, ('chronyc failed', {})])
+def test_root_screens_without_tracking(chrony):
+    pytest.importorskip('psutil')
+    from Screens import Screens
+
+    display = Screens()
+    if chrony is not None:
+        display.store.publish('chrony', chrony)
+    snap = display.store.snapshot()
+
+    assert display.chrony_root_delay(snap)[1][0] == '--'
+    assert display.chrony_root_dispersion(snap)[1][0] == '--'
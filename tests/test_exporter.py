@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import collections
+import urllib.error
+import urllib.request
+
+import pytest
+
+from benchmarks import fakes
+from collectors import SnapshotStore
+from exporter import CONTENT_TYPE, MetricsExporter, MetricsRenderer
+from libs.gpsd import GpsResponse
+
+CpuFreq = collections.namedtuple('CpuFreq', ['current', 'min', 'max'])
+
+tracking = {
+    'reference_id': '50505300', 'reference_name': 'PPS', 'stratum': '1', 'ref_time_(utc)': '1633036800.5',
+    'system_time': '-0.000000153', 'last_offset': '0.000000012', 'rms_offset': '0.000000210',
+    'frequency': '-2.345', 'residual_freq': '0.001', 'skew': '0.012', 'root_delay': '0.000000001',
+    'root_dispersion': '0.000012', 'update_interval': '16.0', 'leap_status': 'Normal',
+}
+
+
+@pytest.fixture
+def store():
+    return SnapshotStore()
+
+
+def metrics(store):
+    lines = MetricsRenderer(store).render(store.snapshot()).splitlines()
+    return {line.rsplit(' ', 1)[0]: line.rsplit(' ', 1)[1] for line in lines if not line.startswith('#')}, lines
+
+
+def test_missing_sources(store):
+    samples, lines = metrics(store)
+
+    assert samples == {'rplcd_snapshot_version': '0.0'}
+    assert '# TYPE rplcd_source_updated_seconds gauge' in lines
+    assert not any(line.startswith(('rplcd_chrony', 'rplcd_gps', 'rplcd_load')) for line in lines)
+
+
+def test_sources(store):
+    store.publish('chrony', ('', tracking))
+    store.publish('gpsd', GpsResponse(mode=3, sats=12, sats_valid=9, hdop=0.8, vdop=1.1, pdop=1.4))
+    store.publish('thermal', {'cpu': fakes.FakeTemperature('cpu-thermal', 47.2, 80.0, 90.0),
+                              'gpu': ('', {'measure_temp': 46.5})})
+    store.publish('psutil', {'loadavg': (0.5, 0.25, 0.0), 'cpu_freq': CpuFreq(1500.0, 600.0, 1800.0),
+                             'net_io': (1024, 2048), 'boot_time': 1633000000.0})
+    samples, lines = metrics(store)
+
+    assert samples['rplcd_snapshot_version'] == '4.0'
+    assert set(key for key in samples if key.startswith('rplcd_source_updated_seconds')) == {
+        'rplcd_source_updated_seconds{source="%s"}' % source for source in ('chrony', 'gpsd', 'psutil', 'thermal')}
+
+    assert samples['rplcd_chrony_up'] == '1.0'
+    assert samples['rplcd_chrony_stratum'] == '1.0'
+    assert samples['rplcd_chrony_system_time_seconds'] == '-1.53e-07'
+    assert samples['rplcd_chrony_update_interval_seconds'] == '16.0'
+    assert samples['rplcd_chrony_reference_info{reference_id="50505300",reference_name="PPS"}'] == '1.0'
+    assert samples['rplcd_chrony_leap_status{status="Normal"}'] == '1.0'
+
+    assert samples['rplcd_gps_mode'] == '3.0'
+    assert samples['rplcd_gps_satellites{state="used"}'] == '9.0'
+    assert samples['rplcd_gps_dop{type="p"}'] == '1.4'
+
+    assert samples['rplcd_temperature_celsius{sensor="cpu"}'] == '47.2'
+    assert samples['rplcd_temperature_celsius{sensor="gpu"}'] == '46.5'
+
+    assert samples['rplcd_load_average{period="5m"}'] == '0.25'
+    assert samples['rplcd_cpu_frequency_mhz{type="max"}'] == '1800.0'
+    assert samples['rplcd_network_receive_bytes_total{interface="eth0"}'] == '2048.0'
+    assert '# TYPE rplcd_network_receive_bytes_total counter' in lines
+    assert samples['rplcd_boot_time_seconds'] == '1633000000.0'
+
+
+def test_partial_sources(store):
+    # chronyc failed, no CPU sensor, not a number and infinite values
+    store.publish('chrony', ('506 Cannot talk to daemon', {}))
+    store.publish('thermal', {'cpu': None, 'gpu': ('', {'measure_temp': float('nan')})})
+    store.publish('psutil', {'loadavg': (0.5, 0.25, 0.0), 'cpu_freq': None, 'net_io': None,
+                             'boot_time': float('inf')})
+    samples, lines = metrics(store)
+
+    assert samples['rplcd_chrony_up'] == '0.0'
+    assert 'rplcd_chrony_stratum' not in samples
+    assert 'rplcd_temperature_celsius{sensor="cpu"}' not in samples
+    assert samples['rplcd_temperature_celsius{sensor="gpu"}'] == 'NaN'
+    assert samples['rplcd_boot_time_seconds'] == '+Inf'
+    assert not any(key.startswith(('rplcd_cpu_frequency', 'rplcd_network')) for key in samples)
+
+
+def test_label_escaping(store):
+    store.publish('chrony', ('', dict(tracking, reference_name='a "b"\\c\nd', stratum='?')))
+    samples, lines = metrics(store)
+
+    assert 'rplcd_chrony_reference_info{reference_id="50505300",reference_name="a \\"b\\"\\\\c\\nd"} 1.0' in lines
+    # a field that is not a number is left out
+    assert 'rplcd_chrony_stratum' not in samples
+
+
+def test_body_cached_per_version(store):
+    renderer = MetricsRenderer(store)
+    store.publish('chrony', ('', tracking))
+
+    body = renderer.body()
+    assert renderer.body() is body
+    assert (renderer.renders, renderer.scrapes) == (1, 2)
+
+    store.publish('chrony', ('', dict(tracking, stratum='2')))
+    assert b'rplcd_chrony_stratum 2.0' in renderer.body()
+    assert renderer.renders == 2
+
+
+def test_http_metrics(store):
+    store.publish('chrony', ('', tracking))
+    exporter = MetricsExporter(store, address='127.0.0.1', port=0)
+    exporter.start()
+    try:
+        url = 'http://127.0.0.1:{}'.format(exporter.port)
+        with urllib.request.urlopen(url + '/metrics', timeout=5) as response:
+            assert response.headers['Content-Type'] == CONTENT_TYPE
+            body = response.read()
+        assert body == exporter.renderer.body()
+        assert b'rplcd_chrony_stratum 1.0\n' in body
+
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url + '/other', timeout=5)
+        assert error.value.code == 404
+    finally:
+        exporter.stop()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import math
+import time
+
+import pytest
+
+from benchmarks import fakes
+from collectors import SnapshotStore
+from fleet import FleetCollector, FleetTable, FleetView, decode_status, encode_status, status_datagram
+
+
+def datagram(node='ts01', sequence=1, sent=1000.0, **kwargs):
+    fake = fakes.FakeFleetNode(node, 0, **kwargs)
+    fake.sock.close()
+    return encode_status(fake.snapshot(), node, sequence, now=sent)
+
+
+def test_round_trip():
+    status = decode_status(datagram(offset=2.5e-6, stratum=2, gps_mode=2, sats=9), received=5.0)
+
+    assert status.node == 'ts01'
+    assert status.sent == 1000.0
+    assert status.received == 5.0
+    assert status.system_time == pytest.approx(2.5e-6)
+    assert status.stratum == 2
+    assert status.leap_status == 'Normal'
+    assert (status.gps_mode, status.sats, status.sats_used) == (2, 9, 7)
+    assert status.temperature == pytest.approx(47.2)
+
+
+def test_empty_snapshot():
+    status = decode_status(encode_status({}, 'ts01', 1))
+
+    assert status.flags == 0
+    assert status.stratum == 16
+    assert status.leap_status == 'Not synchronised'
+    assert math.isnan(status.system_time)
+
+
+@pytest.mark.parametrize('data', [b'', b'RPTS', b'XXXX' + datagram()[4:], datagram()[:4] + b'\x09' + datagram()[5:]])
+def test_invalid_datagrams(data):
+    table = FleetTable()
+    invalid = table.invalid.value
+
+    assert table.receive(data) is None
+    assert table.invalid.value == invalid + 1
+    assert not table.nodes
+
+
+def test_reordered_datagrams_are_dropped():
+    table = FleetTable()
+    reordered = table.reordered.value
+
+    assert table.receive(datagram(sequence=2, sent=1001.0, offset=2e-6))
+    # sent before the one already known, delivered late
+    assert table.receive(datagram(sequence=1, sent=1000.0, offset=1e-6)) is None
+    # duplicated
+    assert table.receive(datagram(sequence=2, sent=1001.0, offset=2e-6)) is None
+
+    assert table.reordered.value == reordered + 2
+    assert table.nodes['ts01'].sequence == 2
+    assert table.nodes['ts01'].system_time == pytest.approx(2e-6)
+
+
+def test_restarted_publisher_is_kept():
+    table = FleetTable()
+    table.receive(datagram(sequence=500, sent=1000.0))
+
+    # counts again from 1 after a restart, its clock moved on
+    status = table.receive(datagram(sequence=1, sent=1060.0))
+
+    assert status is not None
+    assert table.nodes['ts01'].sequence == 1
+
+
+def test_stale_nodes():
+    table = FleetTable(stale_after=5.0)
+    table.receive(datagram('ts01', offset=1e-6), received=100.0)
+    table.receive(datagram('ts02', offset=-3e-6, gps_mode=1), received=103.0)
+    table.receive(datagram('ts03', offset=9e-3), received=90.0)
+
+    view = table.view(now=106.0)
+
+    assert [status.node for status in view.nodes] == ['ts01', 'ts02', 'ts03']
+    assert [status.node for status in view.up] == ['ts02']
+    assert view.worst.node == 'ts02'
+    assert [status.node for status in view.no_fix] == ['ts02']
+    assert view.unsynced == ()
+
+    assert table.view(now=200.0).worst is None
+
+
+def test_worst_and_unsynced():
+    table = FleetTable()
+    table.receive(datagram('ts01', offset=1e-6), received=100.0)
+    table.receive(datagram('ts02', offset=-4e-3), received=100.0)
+    table.receive(encode_status({}, 'ts03', 1, now=1000.0), received=100.0)
+
+    view = table.view(now=100.0)
+
+    assert view.worst.node == 'ts02'
+    assert [status.node for status in view.unsynced] == ['ts03']
+    assert [status.node for status in view.no_fix] == ['ts03']
+
+
+def test_collector_receives_fake_nodes():
+    table = FleetTable()
+    collector = FleetCollector(table, '127.0.0.1', 0)
+    store = SnapshotStore()
+    collector.start(store)
+    port = collector.sock.getsockname()[1]
+    nodes = [fakes.FakeFleetNode('ts{:02d}'.format(n), port, interval=0.01).start() for n in range(3)]
+    try:
+        deadline = time.monotonic() + 5.0
+        while len(table.nodes) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        for node in nodes:
+            node.stop()
+        collector.stop()
+
+    view = collector.collect()
+    assert isinstance(view, FleetView)
+    assert [status.node for status in view.up] == ['ts00', 'ts01', 'ts02']
+    assert all(status.sequence >= 1 for status in view.up)
+
+
+def test_datagram_size():
+    assert status_datagram.size == len(datagram()) == 67
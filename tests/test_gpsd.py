@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import socket
+import time
+
+import pytest
+
+from benchmarks import fakes
+from libs.gpsd import Gpsd, GpsResponse
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+@pytest.fixture
+def server():
+    server = fakes.FakeGpsd(rate=20).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def gpsd(server):
+    gpsd = Gpsd(port=server.port, autostart=False)
+    gpsd.reconnect_delay = 0.05
+    yield gpsd
+    gpsd.stop()
+
+
+def test_from_reports():
+    sky, tpv = fakes.gpsd_reports
+    response = GpsResponse.from_reports(tpv, sky)
+
+    assert response.mode == 3
+    assert response.sats == 11
+    assert response.sats_valid == sum(1 for satellite in sky['satellites'] if satellite['used'])
+    assert response.hdop == 0.92
+    assert response.get_time().year == 2021
+
+
+def test_snapshot(gpsd):
+    published = []
+    gpsd.listeners.append(published.append)
+    gpsd.start()
+
+    assert gpsd.connected.wait(2)
+    assert wait_for(lambda: gpsd.get_current().mode == 3)
+    assert gpsd.get_current().sats == 11
+    assert gpsd.device()['driver'] == 'u-blox'
+    assert published and published[-1].mode == 3
+
+
+def test_stale_snapshot(gpsd, server):
+    gpsd.start()
+    assert wait_for(lambda: gpsd.get_current().mode == 3)
+
+    gpsd.max_age = 0.0
+    assert gpsd.get_current().mode == 0
+
+
+def test_reconnect_after_socket_loss(gpsd, server):
+    published = []
+    gpsd.listeners.append(published.append)
+    gpsd.start()
+    assert wait_for(lambda: gpsd.get_current().mode == 3)
+    assert gpsd.connects == 1
+
+    # the connection drops under the reader
+    gpsd.gpsd_socket.shutdown(socket.SHUT_RDWR)
+
+    assert wait_for(lambda: gpsd.connects == 2)
+    assert server.connections == 2
+    # the lost stream was published as no fix before the new reports
+    assert any(response.mode == 0 for response in published)
+    assert wait_for(lambda: gpsd.get_current().mode == 3)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import threading
+import time
+
+import pytest
+
+from loop_timer import TickStats, WakeupTimer
+
+
+def test_tick_stats():
+    timing = TickStats('test-tick-stats', history=2)
+    assert timing.stats() == {'last_lateness': 0.0, 'mean_lateness': 0.0, 'max_lateness': 0.0, 'jitter': 0.0}
+
+    for lateness in (0.001, 0.003, 0.002):
+        timing.record(lateness)
+
+    stats = timing.stats()
+    assert list(timing.lateness) == [0.003, 0.002]
+    assert stats['last_lateness'] == 0.002
+    assert stats['mean_lateness'] == pytest.approx(0.002)
+    assert stats['max_lateness'] == 0.003
+    # (0.002 / 16) then (0.001 - 0.002 / 16) / 16
+    assert stats['jitter'] == pytest.approx(0.002 / 16 + (0.001 - 0.002 / 16) / 16)
+    assert timing._histogram.count == 3
+
+
+def test_wakeup_timer_sleeps_until_woken():
+    calls = []
+    called = threading.Event()
+
+    def handler():
+        calls.append(time.monotonic())
+        called.set()
+
+    # the first call asks for a short sleep, the next ones to never be called again
+    timer = WakeupTimer(handler, lambda: time.monotonic() + (0.01 if len(calls) == 1 else 60),
+                        name='test-wakeup-timer')
+    timer.start()
+    try:
+        deadline = time.monotonic() + 5
+        while len(calls) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(calls) == 2
+
+        called.clear()
+        timer.wake()
+        assert called.wait(5)
+    finally:
+        timer.cancel()
+
+    stats = timer.stats()
+    assert stats['ticks'] == 3
+    # woken up once by wake() and once by cancel()
+    assert stats['woken'] == 2
+    assert timer.timing.count == 1
+    assert stats['max_lateness'] >= 0.0
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import pytest
+
+from benchmarks import fakes
+from libs.ntpq import NtpControl, NtpControlError, NtpqParser, parse_variables
+
+
+class LossyNtpd(fakes.FakeNtpd):
+    """Drops the second fragment of every reply"""
+
+    def _replies(self, opcode, sequence, association):
+        packets = super()._replies(opcode, sequence, association)
+        return packets[:1] + packets[2:] if len(packets) > 1 else packets
+
+
+@pytest.fixture
+def ntpd():
+    server = fakes.FakeNtpd()
+    # a few hundred bytes replies, in many fragments
+    server.fragment_size = 64
+    server.start()
+    yield server
+    server.stop()
+
+
+def test_parse_variables():
+    variables = parse_variables(fakes.recorded_ntpd_variables[0])
+
+    assert variables['version'] == 'ntpd 4.2.8p15@1.3728-o'
+    assert variables['stratum'] == 1
+    assert variables['offset'] == -0.001812
+    assert variables['peer'] == 38121
+    assert variables['leapsec'] == 0xdcf2ac00
+
+
+def test_reassembles_out_of_order_fragments(ntpd):
+    control = NtpControl(port=ntpd.port)
+
+    (status, data), = control.exchange([(NtpControl.OP_READVAR, 0)])
+
+    assert status == 0x0615
+    assert data.decode('ascii') == fakes.recorded_ntpd_variables[0]
+
+
+def test_system_and_peers(ntpd):
+    control = NtpControl(port=ntpd.port)
+
+    system, peers = control.system_and_peers()
+
+    assert system == parse_variables(fakes.recorded_ntpd_variables[0])
+    assert [(peer['associd'], peer['status']) for peer in peers] == list(fakes.recorded_ntpd_statuses.items())
+    assert peers[1]['srcadr'] == '192.168.1.10'
+
+    # the associations are known, the next batch is one round trip
+    requests = ntpd.requests
+    control.system_and_peers()
+    assert ntpd.requests - requests == 2 + len(peers)
+
+
+def test_error_reply(ntpd):
+    control = NtpControl(port=ntpd.port)
+
+    assert control.exchange([(NtpControl.OP_READVAR, 1234)]) == [None]
+
+
+def test_missing_fragment():
+    server = LossyNtpd().start()
+    server.fragment_size = 64
+    try:
+        with pytest.raises(NtpControlError):
+            NtpControl(port=server.port, timeout=0.2).exchange([(NtpControl.OP_READVAR, 0)])
+    finally:
+        server.stop()
+
+
+def test_ntpq_fallback_on_missing_fragment():
+    server = LossyNtpd().start()
+    server.fragment_size = 64
+    ntpq = NtpqParser(NtpControl(port=server.port, timeout=0.2))
+    ntpq.shell = fakes.FakeShell()
+    fakes.counters.reset()
+    try:
+        stderr, variables = ntpq.read_variables()
+    finally:
+        server.stop()
+
+    assert fakes.counters.subprocesses == 1
+    assert variables['stratum'] == 1
+
+
+def test_peers_and_variables_share_one_batch(ntpd):
+    ntpq = NtpqParser(NtpControl(port=ntpd.port), ttl=60)
+    ntpq.shell = fakes.FakeShell()
+    fakes.counters.reset()
+
+    stderr, peers = ntpq.ntpq_pn()
+    requests = ntpd.requests
+    stderr, variables = ntpq.ntpq_rv()
+    ntpq.read_variables()
+
+    assert ntpd.requests == requests
+    assert len(peers) == len(fakes.recorded_ntpd_statuses)
+    system = parse_variables(fakes.recorded_ntpd_variables[0])
+    assert variables['sys_jitter'].strip() == '{} ms'.format(system['sys_jitter'])
+    assert ntpq.control_cache.stats()['hits'] == 2
+    assert fakes.counters.subprocesses == 0
+
+    # the next collection cycle asks ntpd again
+    ntpq.control_cache.invalidate()
+    ntpq.ntpq_rv()
+    assert ntpd.requests - requests == 2 + len(peers)
+
+
+def test_batch_errors_are_not_cached():
+    server = LossyNtpd().start()
+    server.fragment_size = 64
+    ntpq = NtpqParser(NtpControl(port=server.port, timeout=0.2), ttl=60)
+    ntpq.shell = fakes.FakeShell()
+    try:
+        ntpq.read_variables()
+        ntpq.read_variables()
+    finally:
+        server.stop()
+
+    assert ntpq.control_cache.stats() == {'hits': 0, 'misses': 2, 'errors': 2, 'hit_ratio': 0.0}
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import time
+
+import pytest
+
+from scheduler import RotationScheduler, weighted_sequence
+
+
+def screens(*names, **options):
+    return [('Screens.{}'.format(name), dict(options.get(name, {}))) for name in names]
+
+
+def rotation(scheduler, count):
+    return [scheduler.next() for _ in range(count)]
+
+
+def test_weighted_sequence():
+    sequence = weighted_sequence([('a', {'weight': 3}), ('b', {}), ('c', {}), ('d', {'weight': 0})])
+
+    assert sequence == ['a', 'b', 'a', 'c', 'a']
+
+
+def test_rotation_in_order():
+    scheduler = RotationScheduler(screens('a', 'b', 'c'))
+
+    assert rotation(scheduler, 4) == ['a', 'b', 'c', 'a']
+    assert scheduler.current == 'a'
+
+
+def test_skip_cycles():
+    scheduler = RotationScheduler(screens('a', 'b', 'c'))
+    scheduler.skip('b', 2)
+
+    assert rotation(scheduler, 7) == ['a', 'c', 'a', 'c', 'a', 'b', 'c']
+    assert 'b' not in scheduler.skips
+
+
+def test_skip_for_ever_and_unskip():
+    scheduler = RotationScheduler(screens('a', 'b', 'c'))
+    assert scheduler.next() == 'a'
+
+    scheduler.skip('b')
+    assert rotation(scheduler, 3) == ['c', 'a', 'c']
+    # a permanent skip wins over a counted one
+    scheduler.skip('b', 3)
+    assert scheduler.skips['b'] == -1
+
+    scheduler.unskip('b')
+    assert rotation(scheduler, 3) == ['a', 'b', 'c']
+
+
+def test_skip_current_screen():
+    scheduler = RotationScheduler(screens('a', 'b', 'c'))
+    rotation(scheduler, 2)
+
+    scheduler.skip('b')
+
+    assert scheduler.next() == 'c'
+
+
+def test_every_screen_skipped():
+    scheduler = RotationScheduler(screens('a', 'b'))
+    scheduler.skip('a')
+    scheduler.skip('b')
+
+    assert scheduler.next() is None
+
+
+def test_flash_screen_shown_once():
+    scheduler = RotationScheduler(screens('a', 'b', 'c', b={'flash': True}))
+
+    assert rotation(scheduler, 6) == ['a', 'b', 'c', 'a', 'c', 'a']
+    assert scheduler.skips == {'b': -1}
+
+
+def test_alert_priority():
+    scheduler = RotationScheduler(screens('a', 'low', 'high', 'other', high={'priority': 5, 'weight': 0}))
+    assert scheduler.alert() is None
+
+    scheduler.raise_alert('low', priority=1)
+    scheduler.raise_alert('high')
+    scheduler.raise_alert('other', priority=1)
+    assert scheduler.alert() == 'high'
+
+    scheduler.clear_alert('high')
+    # the oldest of the same priority
+    assert scheduler.alert() == 'low'
+
+    scheduler.raise_alert('low', priority=1)
+    scheduler.clear_alert('low')
+    assert scheduler.alert() == 'other'
+    scheduler.clear_alert('other')
+    assert scheduler.alert() is None
+
+
+def test_alert_does_not_move_the_rotation():
+    scheduler = RotationScheduler(screens('a', 'b', 'c'))
+    rotation(scheduler, 2)
+
+    scheduler.raise_alert('c')
+    assert scheduler.alert() == 'c'
+    scheduler.clear_alert('c')
+
+    assert scheduler.current == 'b'
+    assert scheduler.next() == 'c'
+
+
+def test_set_screens_keeps_the_position():
+    scheduler = RotationScheduler(screens('a', 'b', 'c', 'd'))
+    rotation(scheduler, 3)
+
+    scheduler.set_screens(screens('a', 'c', 'd'))
+    assert scheduler.next() == 'd'
+
+    # the current screen is dropped, the rotation goes on with the one that followed it
+    scheduler.set_screens(screens('a', 'b', 'c', 'd', 'e'))
+    assert scheduler.current == 'd'
+    scheduler.set_screens(screens('a', 'b', 'c', 'e'))
+    assert scheduler.next() == 'e'
+
+
+def test_screens_resume_the_rotation_after_an_alert():
+    pytest.importorskip('psutil')
+    from Screens import Screens
+
+    display = Screens()
+    now = time.monotonic()
+    display.next_frame(now)
+    assert display.screen_method == 'big_time_view'
+
+    # not synchronised, the alert pre-empts the rotation and blinks
+    display.store.publish('chrony', ('', {'leap_status': 'Not synchronised', 'stratum': '16'}))
+    frame = display.next_frame(now + 1)
+    assert display.screen_method == 'alert_view'
+    assert frame[0][0].startswith('ALERT ')
+    assert display.screen_blink
+
+    # the alert screen time is over, the rotation goes on and the standing alert comes back every alert_every screens
+    shown = []
+    at = display.screen_until
+    for _ in range(display.alert_every + 1):
+        display.next_frame(at)
+        shown.append(display.screen_method)
+        at = display.screen_until
+    assert shown[0] == 'gps_time'
+    assert 'alert_view' not in shown[:-1]
+    assert shown[-1] == 'alert_view'
+
+    # cleared while it is shown, the rotation resumes on the screen it interrupted
+    display.store.publish('chrony', ('', {'leap_status': 'Normal', 'stratum': '1'}))
+    display.next_frame(at - 1)
+    assert display.screen_method == shown[-2]
+    assert not display.screen_blink
+
+    display.next_frame(display.screen_until)
+    assert display.screen_method not in shown
+
+
+def test_screens_keep_rotating_without_gpsd():
+    pytest.importorskip('psutil')
+    from Screens import Screens
+    from libs.gpsd import GpsResponse
+
+    display = Screens()
+    now = time.monotonic()
+    shown = set()
+    for ndx in range(20):
+        # gpsd refuses every connection, the reader publishes an empty response after each attempt
+        display.store.publish('gpsd', GpsResponse())
+        display.next_frame(now)
+        shown.add(display.screen_method)
+        now = display.screen_until
+
+    assert not display.alerts.active()
+    assert 'alert_view' not in shown
+    assert len(shown) > 10
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#   Copyright 2021 Constantin Zaharia <constantin.zaharia@progeek.ro>
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+import logging
+import os
+import shutil
+
+import pytest
+
+from benchmarks import fakes
+from libs.vcgencmd_pi import ThermalZones, VcgencmdParser, VideoCoreMailbox
+
+
+class RefusedMailbox(VideoCoreMailbox):
+    """/dev/vcio without the video group"""
+
+    def __init__(self):
+        super().__init__()
+        self.requests = 0
+
+    def temperature(self):
+        self.requests += 1
+        raise PermissionError(13, 'Permission denied', self.path)
+
+
+@pytest.fixture
+def sysfs(tmp_path):
+    return fakes.thermal_tree(str(tmp_path), zones=(('gpu-thermal', 40000), ('cpu-thermal', 47236)))
+
+
+def write_temp(root, zone, millidegrees):
+    with open(os.path.join(root, 'thermal_zone{}'.format(zone), 'temp'), 'w') as f:
+        f.write('{}\n'.format(millidegrees))
+
+
+def test_read_zones(sysfs):
+    zones = ThermalZones(sysfs)
+
+    temperatures = zones.read()
+
+    assert sorted(temperatures) == ['cpu-thermal', 'gpu-thermal']
+    cpu = temperatures['cpu-thermal']
+    assert cpu.current == pytest.approx(47.236)
+    assert cpu.high == 80.0
+    assert cpu.critical == 110.0
+    assert zones.cpu() == cpu
+
+
+def test_reread_without_reopening(sysfs):
+    zones = ThermalZones(sysfs)
+    assert zones.cpu().current == pytest.approx(47.236)
+    descriptors = [fd for _, fd, _, _ in zones.zones]
+
+    write_temp(sysfs, 1, 51000)
+
+    assert zones.cpu().current == 51.0
+    assert [fd for _, fd, _, _ in zones.zones] == descriptors
+    zones.close()
+
+
+def test_unknown_zone_types(tmp_path):
+    zones = ThermalZones(fakes.thermal_tree(str(tmp_path), zones=(('acpitz', 30000), )))
+
+    assert zones.cpu().label == 'acpitz'
+
+
+def test_zone_removed(sysfs):
+    zones = ThermalZones(sysfs)
+    assert len(zones.read()) == 2
+
+    shutil.rmtree(os.path.join(sysfs, 'thermal_zone1'))
+    write_temp(sysfs, 0, 'garbage')
+
+    # the failed read closes the zones, the next one looks for them again
+    zones.read()
+    assert zones.zones is None
+    write_temp(sysfs, 0, 42000)
+    assert list(zones.read()) == ['gpu-thermal']
+    assert zones.cpu().current == 42.0
+
+
+def test_no_thermal_zones(tmp_path):
+    assert ThermalZones(str(tmp_path)).cpu() is None
+
+
+def test_measure_temp_without_mailbox():
+    vcgencmd = VcgencmdParser(VideoCoreMailbox('/nonexistent/vcio'))
+    vcgencmd.shell = fakes.FakeShell()
+
+    assert vcgencmd.measure_temp() == ('', {'measure_temp': 47.2})
+    assert vcgencmd.use_mailbox is False
+
+
+def test_mailbox_permission_denied(caplog):
+    mailbox = RefusedMailbox()
+    vcgencmd = VcgencmdParser(mailbox)
+    vcgencmd.shell = fakes.FakeShell()
+
+    with caplog.at_level(logging.INFO, logger='libs.vcgencmd_pi'):
+        for _ in range(3):
+            assert vcgencmd.measure_temp() == ('', {'measure_temp': 47.2})
+
+    assert mailbox.requests == 1
+    assert vcgencmd.use_mailbox is False
+    assert len([record for record in caplog.records if 'mailbox disabled' in record.getMessage()]) == 1
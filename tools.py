@@ -12,11 +12,19 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import asyncio
+import concurrent.futures
 import math
 import datetime
+import shlex
 import subprocess
+import threading
+import time
+import weakref
 from typing import Tuple
 
+from instrumentation import timed, counter, histogram
+
 nsec_per_sec = 1000000000
 
 
@@ -142,23 +150,168 @@ def human_time(*args, **kwargs):
 
 
 class SubprocessShell(object):
-    """
+    """Runs commands without a shell, bounded in time and in number
 
+    The argv is executed directly, no bash in between. Every command is killed after ``timeout`` seconds, at most
+    ``max_concurrency`` commands run at the same time (per API, threads and asyncio have their own limit) and a
+    command already running is not started twice: the callers asking for the same argv meanwhile share the
+    result of the running one (single flight). Both are shared by all the instances.
+
+    A command that fails to start or times out returns the error as stderr and an empty stdout, the callers
+    parse an empty output as they did before.
     """
-    platform_settings = {'executable': '/bin/bash'}
 
-    def shell_run(self, cmd):
+    timeout = 5.0
+    max_concurrency = 2
+
+    # shared by every instance
+    _lock = threading.Lock()
+    _semaphore = None
+    _in_flight = {}
+    _async_state = weakref.WeakKeyDictionary()
+
+    spawned = counter('commands.spawned')
+    coalesced = counter('commands.coalesced')
+    timeouts = counter('commands.timeouts')
+    errors = counter('commands.errors')
+    wall_time = histogram('commands.wall_time')
+
+    started_at = time.monotonic()
+
+    def __init__(self, timeout=None):
+        if timeout is not None:
+            self.timeout = timeout
+
+    @classmethod
+    def _thread_semaphore(cls):
+        with cls._lock:
+            if cls._semaphore is None:
+                cls._semaphore = threading.BoundedSemaphore(cls.max_concurrency)
+            return cls._semaphore
+
+    @timed('shell_run')
+    def shell_run(self, cmd, timeout=None):
+        """Run a command line, split like a shell would but without one
+
+        :param cmd: str
+        :param timeout: float seconds, defaults to the instance timeout
+        :return: (bytes, bytes) stderr, stdout
         """
+        return self.run(*shlex.split(cmd), timeout=timeout)
 
-        :param cmd:
-        :return:
-        """
+    def run(self, *argv, timeout=None):
+        """Run a command, or wait for the identical one already running
 
-        proc = subprocess.run(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE, shell=True, **self.platform_settings)
-        return proc.stderr, proc.stdout
+        :param argv: program and arguments
+        :param timeout: float seconds, defaults to the instance timeout
+        :return: (bytes, bytes) stderr, stdout
+        """
+        key = ('thread', ) + argv
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = concurrent.futures.Future()
+
+        if not leader:
+            self.coalesced.inc()
+            return future.result()
+
+        try:
+            with self._thread_semaphore():
+                result = self._spawn(argv, self.timeout if timeout is None else timeout)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def _spawn(self, argv, timeout):
+        start = time.perf_counter_ns()
+        self.spawned.inc()
+        try:
+            proc = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+            return proc.stderr, proc.stdout
+        except subprocess.TimeoutExpired:
+            self.timeouts.inc()
+            return '{} timed out'.format(argv[0]).encode('utf-8'), b''
+        except OSError as e:
+            self.errors.inc()
+            return str(e).encode('utf-8'), b''
+        finally:
+            self.wall_time.observe_ns(time.perf_counter_ns() - start)
+
+    @classmethod
+    def _loop_state(cls):
+        loop = asyncio.get_running_loop()
+        state = cls._async_state.get(loop)
+        if state is None:
+            state = cls._async_state[loop] = (asyncio.Semaphore(cls.max_concurrency), {})
+        return state
+
+    async def arun(self, *argv, timeout=None):
+        """asyncio version of :meth:`run`
+
+        :param argv: program and arguments
+        :param timeout: float seconds, defaults to the instance timeout
+        :return: (bytes, bytes) stderr, stdout
+        """
+        semaphore, in_flight = self._loop_state()
+        task = in_flight.get(argv)
+        if task is not None:
+            self.coalesced.inc()
+        else:
+            task = in_flight[argv] = asyncio.ensure_future(
+                self._ashared(semaphore, in_flight, argv, self.timeout if timeout is None else timeout))
+        # every caller waits on the shared run, a cancelled caller leaves it running for the others
+        return await asyncio.shield(task)
+
+    async def _ashared(self, semaphore, in_flight, argv, timeout):
+        try:
+            async with semaphore:
+                return await self._aspawn(argv, timeout)
+        finally:
+            in_flight.pop(argv, None)
+
+    async def _aspawn(self, argv, timeout):
+        start = time.perf_counter_ns()
+        self.spawned.inc()
+        try:
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *argv, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            except OSError as e:
+                self.errors.inc()
+                return str(e).encode('utf-8'), b''
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+            except asyncio.TimeoutError:
+                self.timeouts.inc()
+                proc.kill()
+                await proc.wait()
+                return '{} timed out'.format(argv[0]).encode('utf-8'), b''
+            return stderr, stdout
+        finally:
+            self.wall_time.observe_ns(time.perf_counter_ns() - start)
+
+    @classmethod
+    def stats(cls):
+        """Commands counters, shared by every instance
+
+        :return: dict
+        """
+        elapsed = time.monotonic() - cls.started_at
+        return {
+            'spawned': cls.spawned.value,
+            'spawn_rate': cls.spawned.value / elapsed if elapsed > 0 else 0.0,
+            'coalesced': cls.coalesced.value,
+            'timeouts': cls.timeouts.value,
+            'errors': cls.errors.value,
+            'wall_time': cls.wall_time.stats(),
+        }
 
 
 def humanize_file_size(filesize):